@@ -0,0 +1,76 @@
+import argparse
+import os
+import sys
+import time
+import numpy as np
+
+from scipy.optimize import linear_sum_assignment
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+
+"""
+Fit time and quality of the ICA fitted on decimated and/or subsampled epochs.
+
+Every configuration (ica_decim, ica_fit_epochs) is compared to the ICA fitted on
+all the samples of all the epochs: the components are matched one to one on the
+absolute correlation of their scalp patterns and the mean and minimum matched
+correlation are reported.
+
+    python benchmarks/bench_ica.py results/derivatives/baseline/022/cache/1/autoreject-<key>/epochs-epo.fif
+"""
+
+
+def match_components(ica_reference, ica):
+    # Absolute correlation of the best one to one matching of the scalp patterns
+    reference = ica_reference.get_components()
+    patterns = ica.get_components()
+    n_components = reference.shape[1]
+    correlation = np.abs(np.corrcoef(reference.T, patterns.T)[:n_components, n_components:])
+    rows, cols = linear_sum_assignment(-correlation)
+    return correlation[rows, cols]
+
+
+def benchmark(epochs, decims, fit_epochs, n_components=15, method='picard', max_iter=512, random_state=42):
+    from utils.pipeline import fit_ica
+
+    results = []
+    reference = None
+    for decim in decims:
+        for fraction in fit_epochs:
+            start = time.perf_counter()
+            ica = fit_ica(epochs, n_components, method, max_iter, random_state, decim, fraction)
+            fit_time = time.perf_counter() - start
+            if reference is None:
+                reference = ica
+            correlation = match_components(reference, ica)
+            results.append((decim, fraction, fit_time, correlation.mean(), correlation.min()))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the ICA fit on decimated / subsampled epochs')
+    parser.add_argument('path', help='epochs file (-epo.fif) cleaned by AutoReject')
+    parser.add_argument('--decims', nargs='+', type=int, default=[1, 2, 4])
+    parser.add_argument('--fit-epochs', nargs='+', type=float, default=[1.0, 0.5, 0.25])
+    parser.add_argument('--n-components', type=int, default=15)
+    args = parser.parse_args()
+
+    import mne
+    mne.set_log_level('ERROR')
+    epochs = mne.read_epochs(args.path, preload=True)
+    epochs.drop_bad()
+
+    # the first configuration is the reference: all the samples of all the epochs
+    decims = [1] + [decim for decim in args.decims if decim != 1]
+    # fit_ica refuses a decimation that aliases the low-passed data
+    max_decim = epochs.info['sfreq'] / (2 * epochs.info['lowpass'])
+    if any(decim > max_decim for decim in decims):
+        print(f"skipped decim {[decim for decim in decims if decim > max_decim]}, above {max_decim:.2f}")
+        decims = [decim for decim in decims if decim <= max_decim]
+    fit_epochs = [None] + [fraction for fraction in args.fit_epochs if fraction != 1]
+    results = benchmark(epochs, decims, fit_epochs, args.n_components)
+    print(f"{'decim':>6}{'epochs':>8}{'fit time (s)':>14}{'mean |r|':>10}{'min |r|':>10}")
+    for decim, fraction, fit_time, mean_corr, min_corr in results:
+        fraction = 1.0 if fraction is None else fraction
+        print(f"{decim:>6}{fraction:>8.2f}{fit_time:>14.2f}{mean_corr:>10.3f}{min_corr:>10.3f}")
@@ -0,0 +1,61 @@
+import argparse
+import os
+import subprocess
+import sys
+
+
+"""
+Startup time of the pipeline modules, measured with python -X importtime in a
+fresh interpreter (what every pool worker pays before its first recording).
+
+For every module it reports the total import time, the time spent in each
+package (sum of the self time of its modules) and which of the heavy optional
+dependencies were imported.
+
+    python benchmarks/bench_import.py
+    python benchmarks/bench_import.py utils.pipeline utils.bad_channels --top 5
+"""
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+MODULES = ['run_preprocessing', 'utils.pipeline', 'utils.preprocessing_helpers']
+
+# dependencies that should only be imported by the stage that needs them
+HEAVY_PACKAGES = ['autoreject', 'pyprep', 'mne_icalabel', 'torch', 'onnxruntime', 'matplotlib.pyplot', 'sklearn']
+
+
+def import_times(module):
+    # Total import time of `module`, import time of every package it imports in seconds
+    # and the heavy packages present in sys.modules afterwards
+    code = f"import sys, {module}; print(','.join(m for m in {HEAVY_PACKAGES!r} if m in sys.modules))"
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=ROOT,
+                            capture_output=True, text=True, check=True)
+    total = 0
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_time, cumulative, name = line[len('import time:'):].split('|')
+        name = name.strip()
+        if name == module:
+            total = int(cumulative) / 1e6
+        package = name.split('.')[0]
+        times[package] = times.get(package, 0) + int(self_time) / 1e6
+    heavy = [name for name in result.stdout.strip().split(',') if name]
+    return total, times, heavy
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the import time of the pipeline modules')
+    parser.add_argument('modules', nargs='*', default=MODULES)
+    parser.add_argument('--top', type=int, default=8, help='number of heaviest packages to show')
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    for module in args.modules:
+        # the fastest run is the one least affected by the file system cache
+        runs = [import_times(module) for _ in range(args.repeats)]
+        total, times, heavy = min(runs, key=lambda run: run[0])
+        print(f"{module}: {total:.3f} s, heavy dependencies imported: {', '.join(heavy) or 'none'}")
+        for name, seconds in sorted(times.items(), key=lambda item: -item[1])[:args.top]:
+            print(f"    {name:<40}{seconds:>8.3f} s")
@@ -0,0 +1,207 @@
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+from queue import Empty
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from synthetic_akonic import make_recording
+
+
+"""
+Time and peak memory of every stage of the preprocessing on synthetic Akonic
+recordings (see benchmarks/synthetic_akonic.py), for several recording lengths
+and numbers of cores, without patient data.
+
+Every (duration, n_jobs) runs preprocess_subject (manual='skip', no stage cache)
+in a fresh process with n_jobs joblib jobs and BLAS threads, and reads the
+'stage_profile' it logs (see utils/profiling.py). The windows of the pipeline
+are scaled to the duration (baseline from 3% to 20% and dosis from 39% to 99%
+of the recording, the default windows of a 30 minutes recording).
+The report gives, for every stage, the wall time of every run, the exponent of
+the wall time against the duration (1 for a linear stage) and the speedup with
+the most cores. The results are saved as JSON and can be compared to a
+previous run to catch regressions:
+
+    python benchmarks/bench_pipeline.py --durations 10 20 40 --n-jobs 1 4 --output bench.json
+    python benchmarks/bench_pipeline.py --durations 10 20 40 --n-jobs 1 4 --compare bench.json
+"""
+
+# default windows of utils/pipeline.DEFAULT_PARAMS for a recording of this many seconds
+REFERENCE_DURATION = 1800
+WINDOW_PARAMS = ['t_min_baseline', 't_max_baseline', 't_0_dosis', 't_max_dosis']
+
+
+def scaled_params(duration, params=None):
+    from utils.pipeline import DEFAULT_PARAMS
+
+    scaled = {name: DEFAULT_PARAMS[name] * duration / REFERENCE_DURATION for name in WINDOW_PARAMS}
+    scaled.update(params or {})
+    return scaled
+
+
+def _run(raw_file, root_path, duration, n_jobs, params, queue):
+    # BLAS threads are set before numpy is imported by the pipeline
+    for var in ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS']:
+        os.environ[var] = str(n_jobs)
+    os.environ.setdefault('MPLBACKEND', 'Agg')
+    import mne
+    from utils.pipeline import preprocess_subject
+    mne.set_log_level('ERROR')
+
+    start = time.perf_counter()
+    details = preprocess_subject(raw_file, 'bench', '1', 'synthetic', params=scaled_params(duration, params),
+                                 manual='skip', root_path=root_path,
+                                 json_path=os.path.join(root_path, 'log.json'), n_jobs=n_jobs)
+    wall_time = time.perf_counter() - start
+    # the components found by the EOG scores (or labelled eye blink), Fp1 has to be a good channel
+    eog_components = [row['component'] for row in details.get('ica_scores') or [] if row.get('eog')]
+    queue.put({'stages': details['stage_profile'], 'wall': wall_time,
+               'bad_channels': details.get('bad_channels'), 'eog_components': eog_components})
+
+
+def get_result(process, queue, timeout):
+    # The result a benchmark process puts in queue. An error instead of waiting forever when the process
+    # exits without a result (it crashed or was killed) or runs for more than timeout seconds
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            return queue.get(timeout=1)
+        except Empty:
+            if process.exitcode is not None:
+                # the result may have arrived since
+                try:
+                    return queue.get(timeout=1)
+                except Empty:
+                    raise RuntimeError(f'the benchmark process exited with code {process.exitcode} '
+                                       'without a result') from None
+            if time.monotonic() > deadline:
+                process.terminate()
+                raise RuntimeError(f'the benchmark process did not finish in {timeout} s')
+
+
+def benchmark(durations, n_jobs_list, work_dir, params=None, repeats=1, seed=0, timeout=3600):
+    """One result per (duration in seconds, n_jobs), the best of repeats runs.
+
+    A run that crashes or takes more than timeout seconds stops the benchmark with an error.
+    """
+    context = multiprocessing.get_context('spawn')
+    results = []
+    for duration in durations:
+        raw_file, = make_recording(work_dir, 'synthetic', f'{int(duration)}s', '1', duration, seed=seed)
+        for n_jobs in n_jobs_list:
+            runs = []
+            for _ in range(repeats):
+                # every run starts from scratch: the ICA and AutoReject files of the previous run would be reused
+                shutil.rmtree(os.path.join(work_dir, 'derivatives'), ignore_errors=True)
+                queue = context.Queue()
+                process = context.Process(target=_run, args=(raw_file, work_dir, duration, n_jobs, params, queue))
+                process.start()
+                runs.append(get_result(process, queue, timeout))
+                process.join()
+            best = min(runs, key=lambda run: run['wall'])
+            results.append({'duration': duration, 'n_jobs': n_jobs, **best})
+    return results
+
+
+def to_frame(results, column='wall'):
+    # (stage) x (duration, n_jobs) table of column
+    import pandas as pd
+
+    table = pd.DataFrame({(result['duration'] / 60, result['n_jobs']): {stage: profile[column]
+                                                                        for stage, profile in result['stages'].items()}
+                          for result in results})
+    table.columns.names = ['minutes', 'n_jobs']
+    return table
+
+
+def scaling(results):
+    # Exponent of the wall time against the duration with the fewest jobs, speedup of the most jobs
+    # at the longest duration
+    import pandas as pd
+
+    table = to_frame(results)
+    minutes = sorted(table.columns.get_level_values('minutes').unique())
+    n_jobs = sorted(table.columns.get_level_values('n_jobs').unique())
+    summary = pd.DataFrame(index=table.index)
+    if len(minutes) > 1:
+        walls = table.xs(n_jobs[0], level='n_jobs', axis=1)[minutes]
+        summary['duration_exponent'] = [np.polyfit(np.log(minutes), np.log(np.maximum(row, 1e-3)), 1)[0]
+                                        for row in walls.to_numpy()]
+    if len(n_jobs) > 1:
+        summary[f'speedup_{n_jobs[-1]}_jobs'] = table[(minutes[-1], n_jobs[0])] / table[(minutes[-1], n_jobs[-1])]
+    return summary
+
+
+def compare(results, reference, tolerance=0.2, min_seconds=0.5):
+    # Stages slower than reference by more than tolerance (only stages above min_seconds)
+    reference = {(result['duration'], result['n_jobs']): result['stages'] for result in reference}
+    regressions = []
+    for result in results:
+        stages = reference.get((result['duration'], result['n_jobs']))
+        if stages is None:
+            continue
+        for stage, profile in result['stages'].items():
+            if stage in stages and stages[stage]['wall'] >= min_seconds \
+                    and profile['wall'] > stages[stage]['wall'] * (1 + tolerance):
+                regressions.append((result['duration'] / 60, result['n_jobs'], stage,
+                                    stages[stage]['wall'], profile['wall']))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the preprocessing stages on synthetic recordings')
+    parser.add_argument('--durations', nargs='+', type=float, default=[10, 20, 40], help='minutes')
+    parser.add_argument('--n-jobs', nargs='+', type=int, default=[1, os.cpu_count()])
+    parser.add_argument('--repeats', type=int, default=1)
+    parser.add_argument('--timeout', type=float, default=3600, help='seconds after which a run is stopped')
+    parser.add_argument('--report', choices=['full', 'light', 'none'], default='light')
+    parser.add_argument('--params', default=None, help='JSON of other parameters of the pipeline')
+    parser.add_argument('--work-dir', default=None, help='folder of the recordings and outputs (default: temporary)')
+    parser.add_argument('--output', default=None, help='save the results to this JSON file')
+    parser.add_argument('--compare', default=None, help='JSON results of a previous run to compare to')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='slowdown reported as a regression')
+    args = parser.parse_args()
+
+    params = {'report': args.report, **(json.loads(args.params) if args.params else {})}
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='bench_pipeline_')
+    try:
+        results = benchmark([minutes * 60 for minutes in args.durations], sorted(set(args.n_jobs)), work_dir,
+                            params, args.repeats, timeout=args.timeout)
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    import pandas as pd
+    float_format = lambda value: f'{value:.2f}'
+    table = to_frame(results)
+    table.loc['total'] = [result['wall'] for result in results]
+    print('Wall time (s)')
+    print(table.to_string(float_format=float_format))
+    print('\nPeak RSS (MB)')
+    print(to_frame(results, 'peak_rss').to_string(float_format=lambda value: f'{value:.0f}'))
+    summary = scaling(results)
+    if not summary.empty:
+        print('\nScaling')
+        print(summary.to_string(float_format=float_format))
+    print(f"\nBad channels found: {sorted({ch for result in results for ch in result['bad_channels'] or []})}")
+    print(f"EOG components found: {[result.get('eog_components') for result in results]}")
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump({'cpu_count': os.cpu_count(), 'params': params, 'results': results}, f, indent=4)
+    if args.compare is not None:
+        with open(args.compare, 'r') as f:
+            regressions = compare(results, json.load(f)['results'], args.tolerance)
+        if regressions:
+            print(f'\nSlower than {args.compare} by more than {args.tolerance:.0%}:')
+            print(pd.DataFrame(regressions, columns=['minutes', 'n_jobs', 'stage', 'reference', 'wall'])
+                  .to_string(index=False, float_format=float_format))
+            raise SystemExit(1)
+        print(f'\nNo stage slower than {args.compare} by more than {args.tolerance:.0%}')
@@ -0,0 +1,75 @@
+import argparse
+import multiprocessing
+import os
+import resource
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from bench_pipeline import get_result
+
+
+"""
+Peak memory and wall time of reading an Akonic EDF file:
+    old: mne.io.read_raw_edf + copy into a RawArray + set_chs_montage (read_edf_akonic_mne)
+    new: memory mapped reader that decodes only the kept channels (read_edf_akonic) + set_chs_montage
+    layout: the same reader building the Raw with the channels of AKONIC_LAYOUT in one step
+
+Every method runs in a fresh process so that the peak RSS of one does not hide the other.
+
+    python benchmarks/bench_read_edf.py results/raw/baseline/022/022_1.EDF
+"""
+
+
+def _peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _run(method, path, queue):
+    import mne
+    import utils.preprocessing_helpers as preprocessing_helpers
+    mne.set_log_level('ERROR')
+
+    rss_before = _peak_rss_mb()
+    start = time.perf_counter()
+    if method == 'old':
+        raw = preprocessing_helpers.set_chs_montage(preprocessing_helpers.read_edf_akonic_mne(path))
+    elif method == 'new':
+        raw = preprocessing_helpers.set_chs_montage(preprocessing_helpers.read_edf_akonic(path))
+    else:
+        raw = preprocessing_helpers.read_edf_akonic(path, layout=preprocessing_helpers.AKONIC_LAYOUT)
+    wall_time = time.perf_counter() - start
+    data_mb = len(raw.ch_names) * raw.n_times * 8 / 1024 ** 2
+    queue.put((wall_time, _peak_rss_mb() - rss_before, data_mb))
+
+
+def benchmark(path, repeats=3, timeout=600):
+    context = multiprocessing.get_context('spawn')
+    results = {}
+    for method in ['old', 'new', 'layout']:
+        runs = []
+        for _ in range(repeats):
+            queue = context.Queue()
+            process = context.Process(target=_run, args=(method, path, queue))
+            process.start()
+            runs.append(get_result(process, queue, timeout))
+            process.join()
+        results[method] = runs
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the EDF readers')
+    parser.add_argument('path')
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--timeout', type=float, default=600, help='seconds after which a run is stopped')
+    args = parser.parse_args()
+
+    results = benchmark(args.path, args.repeats, args.timeout)
+    print(f"{'method':<8}{'wall time (s)':>16}{'peak RSS (MB)':>16}{'final data (MB)':>18}")
+    for method, runs in results.items():
+        wall_time = min(run[0] for run in runs)
+        peak_rss = min(run[1] for run in runs)
+        print(f"{method:<8}{wall_time:>16.3f}{peak_rss:>16.1f}{runs[0][2]:>18.1f}")
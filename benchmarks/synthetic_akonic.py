@@ -0,0 +1,275 @@
+import argparse
+import datetime
+import os
+import sys
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+
+"""
+Synthetic recordings with the layout of the Akonic files, to benchmark the
+pipeline without patient data:
+    EDF: the 32 signals renamed by set_chs_montage, ECG recorded on EMG-0,
+         in uV (read_edf_akonic / read_edf_akonic_mne)
+    text export: a text header and one line per sample with the 32 columns of
+                 utils/ReadRawAkonic.CH_NAMES, in uV as written (read_raw_akonic)
+
+The EEG is a mix of 1/f sources with smooth topographies (standard_1020 positions),
+a posterior alpha rhythm, blinks on Fp1 and Fp2 (and the frontal channels), a leak of the
+ECG, 50 Hz line noise and some bad channels (flat or noisy), at 256 Hz.
+The recordings are written in the layout of run_preprocessing.py:
+
+    python benchmarks/synthetic_akonic.py synthetic --subjects 001 002 --weeks 1 2 --duration 32
+    python run_preprocessing.py --root-path synthetic --manual skip
+
+The default windows of the pipeline end at 1780 s, use at least 30 minutes or
+scale them (see benchmarks/bench_pipeline.py).
+"""
+
+SFREQ = 256
+LINE_FREQ = 50
+
+# EEG channels of the simulation, with their standard_1020 names (after set_chs_montage)
+EEG_CH_NAMES = ['Fp1', 'Fp2', 'Fpz', 'F3', 'F4', 'F7', 'F8', 'Fz', 'C3', 'C4', 'Cz',
+                'T7', 'T8', 'P7', 'P8', 'P3', 'P4', 'Pz', 'O1', 'O2', 'A1', 'A2']
+
+# Signals of the EDF files in the order of set_chs_montage, with the signal simulated on each
+EDF_CHANNELS = {
+    'EEG Fp1-Ref': 'Fp1', 'EEG Fp2-Ref': 'Fp2', 'EEG F3-Ref': 'F3', 'EEG F4-Ref': 'F4',
+    'EEG C3-Ref': 'C3', 'EEG C4-Ref': 'C4', 'EEG P3-Ref': 'P3', 'EEG P4-Ref': 'P4',
+    'EEG O1-Ref': 'O1', 'EEG O2-Ref': 'O2', 'EEG F7-Ref': 'F7', 'EEG F8-Ref': 'F8',
+    'EEG T3-Ref': 'T7', 'EEG T4-Ref': 'T8', 'EEG T5-Ref': 'P7', 'EEG T6-Ref': 'P8',
+    'EEG A1-Ref': 'A1', 'EEG A2-Ref': 'A2', 'EEG Fz-Ref': 'Fz', 'EEG Cz-Ref': 'Cz', 'EEG Pz-Ref': 'Pz',
+    # the ECG input is not connected, the ECG is recorded on EMG-0
+    'ECG': 'noise', 'Resp oro-nasal': 'resp', 'TORAXIC BELT': 'resp', 'ABDOMINAL BELT': 'resp',
+    'MICROPHONE': 'noise', 'EMG-0': 'ecg', 'EMG-1': 'noise', 'EMG-2': 'noise', 'EMG-3': 'noise',
+    'EXT1': 'zero', 'EXT2': 'zero',
+}
+
+# Columns of the text export (utils/ReadRawAkonic.CH_NAMES) with the signal simulated on each
+ASCII_CHANNELS = {
+    'Fp1': 'Fp1', 'F3': 'F3', 'C3': 'C3', 'P3': 'P3', 'O1': 'O1', 'F7': 'F7', 'T3': 'T7', 'T5': 'P7',
+    'A1': 'A1', 'Fp2': 'Fp2', 'F4': 'F4', 'C4': 'C4', 'P4': 'P4', 'O2': 'O2', 'F8': 'F8', 'T4': 'T8',
+    'T6': 'P8', 'A2': 'A2', 'Fpz': 'Fpz', 'Fz': 'Fz', 'Cz': 'Cz',
+    'EKG': 'ecg', 'AF': 'resp', 'TOR': 'resp', 'ABD': 'resp', 'MIC': 'noise',
+    'EMG1': 'noise', 'EMG2': 'noise', 'EMG3': 'noise', 'EMG4': 'noise', 'EXT1': 'zero', 'EXT2': 'zero',
+}
+
+# Bad channels of the simulation (standard_1020 names): 'flat' or 'noisy'
+BAD_CHANNELS = {'T8': 'noisy', 'P4': 'flat'}
+
+# Physical range of every EDF signal in uV (resolution of 0.1 uV with 16 bits)
+PHYSICAL_RANGE = 3200.
+
+
+def _electrode_positions(ch_names):
+    # Unit vectors of the standard_1020 positions
+    import mne
+
+    positions = mne.channels.make_standard_montage('standard_1020').get_positions()['ch_pos']
+    positions = np.array([positions[ch] for ch in ch_names])
+    return positions / np.linalg.norm(positions, axis=1, keepdims=True)
+
+
+def _topography(positions, center, width):
+    # Smooth topography: gaussian of the distance on the unit sphere to center
+    return np.exp(-np.sum((positions - center) ** 2, axis=1) / (2 * width ** 2))
+
+
+def pink_noise(n_signals, n_times, exponent, rng, fmin=0.5):
+    # Unit variance signals with a power spectrum in 1 / f ** exponent (flat below fmin)
+    freqs = np.fft.rfftfreq(n_times, 1 / SFREQ)
+    spectrum = rng.standard_normal((n_signals, freqs.size)) + 1j * rng.standard_normal((n_signals, freqs.size))
+    spectrum *= np.maximum(freqs, fmin) ** (-exponent / 2)
+    spectrum[:, 0] = 0
+    signals = np.fft.irfft(spectrum, n_times)
+    signals /= signals.std(axis=1, keepdims=True)
+    return signals
+
+
+def _pulses(times, width, n_times, rng, amplitude_sd=0.2):
+    # Sum of sin**2 pulses of width seconds starting at times (seconds)
+    length = int(width * SFREQ)
+    pulse = np.sin(np.linspace(0, np.pi, length)) ** 2
+    signal = np.zeros(n_times)
+    for start in (np.asarray(times) * SFREQ).astype(int):
+        if start + length <= n_times:
+            signal[start:start + length] += pulse * (1 + amplitude_sd * rng.standard_normal())
+    return signal
+
+
+def simulate_ecg(n_times, rng, heart_rate=70):
+    # ECG in uV: P wave, QRS complex and T wave of every beat, with some heart rate variability
+    intervals = 60 / heart_rate * (1 + 0.05 * rng.standard_normal(int(n_times / SFREQ * heart_rate / 60) + 2))
+    beats = np.cumsum(intervals)
+    t = np.arange(int(0.8 * SFREQ)) / SFREQ
+    # (delay, width, amplitude in uV) of the waves of a beat
+    waves = [(0.1, 0.025, 150), (0.24, 0.008, -100), (0.26, 0.01, 1000), (0.28, 0.008, -200), (0.5, 0.04, 300)]
+    beat = sum(amplitude * np.exp(-(t - delay) ** 2 / (2 * width ** 2)) for delay, width, amplitude in waves)
+    ecg = np.zeros(n_times)
+    for start in (beats * SFREQ).astype(int):
+        if start + beat.size <= n_times:
+            ecg[start:start + beat.size] += beat
+    return ecg
+
+
+def simulate_recording(duration, bad_channels=None, n_sources=12, exponent=1.5, blink_rate=0.2, blink_amplitude=100,
+                       seed=0):
+    """Signals of a synthetic recording of duration seconds, in uV.
+
+    Returns ({signal: (n_times,) array}, eeg) with the 'ecg', 'resp', 'noise' and 'zero'
+    signals and the (n_channels, n_times) EEG of EEG_CH_NAMES.
+    bad_channels: {standard_1020 name: 'flat' or 'noisy'}, default BAD_CHANNELS.
+    """
+    rng = np.random.default_rng(seed)
+    n_times = int(duration * SFREQ)
+    bad_channels = BAD_CHANNELS if bad_channels is None else bad_channels
+    positions = _electrode_positions(EEG_CH_NAMES)
+
+    # background: 1/f sources at random positions, about 10 uV per channel
+    centers = rng.standard_normal((n_sources, 3))
+    centers /= np.linalg.norm(centers, axis=1, keepdims=True)
+    centers[:, 2] = np.abs(centers[:, 2])
+    mixing = np.column_stack([_topography(positions, center, 0.5) for center in centers])
+    mixing /= np.sqrt((mixing ** 2).sum(axis=1, keepdims=True))
+    eeg = 10 * mixing @ pink_noise(n_sources, n_times, exponent, rng)
+
+    # posterior alpha rhythm with a slowly changing amplitude
+    times = np.arange(n_times) / SFREQ
+    envelope = 1 + 0.5 * pink_noise(1, n_times, 2, rng)[0]
+    alpha = 8 * np.clip(envelope, 0, None) * np.sin(2 * np.pi * (10 + 0.3 * rng.standard_normal()) * times)
+    eeg += np.outer(_topography(positions, positions[EEG_CH_NAMES.index('Pz')] - [0, 0.3, 0], 0.5), alpha)
+
+    # blinks: blink_amplitude uV at Fpz, about 80% of it on Fp1 and Fp2 and decreasing on the frontal channels.
+    # Narrower or larger blinks make Fp1 a bad channel (deviation, RANSAC), then it is interpolated and the
+    # EOG scores of the ICA (correlation with Fp1) are not computed
+    n_blinks = rng.poisson(blink_rate * duration)
+    blinks = _pulses(np.sort(rng.uniform(0, duration, n_blinks)), 0.3, n_times, rng)
+    eeg += np.outer(blink_amplitude * _topography(positions, positions[EEG_CH_NAMES.index('Fpz')], 0.5), blinks)
+
+    # the ECG leaks into the EEG, mostly on the ears and the temporal channels
+    ecg = simulate_ecg(n_times, rng)
+    leak = 0.005 * (_topography(positions, positions[EEG_CH_NAMES.index('A1')], 0.6)
+                    + 0.5 * _topography(positions, positions[EEG_CH_NAMES.index('A2')], 0.6))
+    eeg += np.outer(leak, ecg)
+
+    # line noise with a different amplitude and phase on every channel, and sensor noise
+    line = np.sin(2 * np.pi * LINE_FREQ * times + rng.uniform(0, 2 * np.pi, (len(EEG_CH_NAMES), 1)))
+    eeg += rng.uniform(1, 4, (len(EEG_CH_NAMES), 1)) * line
+    eeg += rng.standard_normal(eeg.shape)
+
+    for ch, kind in bad_channels.items():
+        idx = EEG_CH_NAMES.index(ch)
+        if kind == 'flat':
+            eeg[idx] = 0
+        elif kind == 'noisy':
+            eeg[idx] += 80 * rng.standard_normal(n_times) + 40 * line[idx]
+        else:
+            raise ValueError(f"bad channels are 'flat' or 'noisy', got {kind} for {ch}")
+
+    signals = {
+        'ecg': ecg + 10 * rng.standard_normal(n_times),
+        'resp': 200 * np.sin(2 * np.pi * 0.25 * times) + 20 * rng.standard_normal(n_times),
+        'noise': 5 * rng.standard_normal(n_times),
+        'zero': np.zeros(n_times),
+    }
+    return signals, eeg
+
+
+def _channel_data(signals, eeg, source):
+    if source in signals:
+        return signals[source]
+    return eeg[EEG_CH_NAMES.index(source)]
+
+
+def write_edf(path, signals, eeg, start=datetime.datetime(2023, 1, 1, 10, 0, 0), block_records=60):
+    # EDF with one record per second and the signals of EDF_CHANNELS in uV,
+    # written block_records records at a time
+    ch_names = list(EDF_CHANNELS)
+    n_records = eeg.shape[1] // SFREQ
+    n_signals = len(ch_names)
+    digital_min, digital_max = -32768, 32767
+    scale = (digital_max - digital_min) / (2 * PHYSICAL_RANGE)
+
+    def field(value, width):
+        return str(value)[:width].ljust(width).encode('latin-1')
+
+    header = b''.join([
+        field('0', 8), field('X X X Synthetic', 80), field(f'Startdate {start:%d-%b-%Y} X X Akonic', 80),
+        field(f'{start:%d.%m.%y}', 8), field(f'{start:%H.%M.%S}', 8), field(256 * (n_signals + 1), 8),
+        field('', 44), field(n_records, 8), field(1, 8), field(n_signals, 4),
+    ])
+    signal_fields = [
+        [field(ch, 16) for ch in ch_names],
+        [field('AgAgCl electrode', 80)] * n_signals,
+        [field('uV', 8)] * n_signals,
+        [field(-PHYSICAL_RANGE, 8)] * n_signals,
+        [field(PHYSICAL_RANGE, 8)] * n_signals,
+        [field(digital_min, 8)] * n_signals,
+        [field(digital_max, 8)] * n_signals,
+        [field('', 80)] * n_signals,
+        [field(SFREQ, 8)] * n_signals,
+        [field('', 32)] * n_signals,
+    ]
+
+    with open(path, 'wb') as f:
+        f.write(header + b''.join(b''.join(values) for values in signal_fields))
+        for first in range(0, n_records, block_records):
+            last = min(first + block_records, n_records)
+            block = np.stack([_channel_data(signals, eeg, source)[first * SFREQ:last * SFREQ]
+                              for source in EDF_CHANNELS.values()])
+            digital = np.clip(np.round((block + PHYSICAL_RANGE) * scale + digital_min), digital_min, digital_max)
+            # (n_signals, n_records * SFREQ) -> records of the SFREQ samples of every signal
+            records = digital.astype('<i2').reshape(n_signals, last - first, SFREQ).transpose(1, 0, 2)
+            f.write(records.tobytes())
+    return path
+
+
+def write_ascii(path, signals, eeg, block_seconds=60):
+    # Text export: a header and one line per sample with the columns of ASCII_CHANNELS in uV
+    n_times = eeg.shape[1]
+    with open(path, 'w') as f:
+        f.write('Akonic BIO-PC text export\nPatient: synthetic\n')
+        f.write(f"Sampling rate: {SFREQ} Hz\nChannels: {' '.join(ASCII_CHANNELS)}\n")
+        for start in range(0, n_times, block_seconds * SFREQ):
+            block = np.stack([_channel_data(signals, eeg, source)[start:start + block_seconds * SFREQ]
+                              for source in ASCII_CHANNELS.values()])
+            np.savetxt(f, block.T, fmt='%.2f')
+    return path
+
+
+def make_recording(root_path, condition, id, week, duration, ascii=False, bad_channels=None, seed=0):
+    # results/raw/<condition>/<id>/<id>_<week>.EDF (and <id>_<week>.txt with ascii)
+    folder = os.path.join(root_path, 'raw', condition, str(id))
+    os.makedirs(folder, exist_ok=True)
+    signals, eeg = simulate_recording(duration, bad_channels, seed=seed)
+    paths = [write_edf(os.path.join(folder, f'{id}_{week}.EDF'), signals, eeg)]
+    if ascii:
+        paths.append(write_ascii(os.path.join(folder, f'{id}_{week}.txt'), signals, eeg))
+    return paths
+
+
+def make_cohort(root_path, conditions, subjects, weeks, duration, ascii=False, bad_channels=None, seed=0):
+    # Every recording gets its own seed, derived from seed
+    paths = []
+    for n, (condition, id, week) in enumerate((condition, id, week) for condition in conditions
+                                              for id in subjects for week in weeks):
+        paths += make_recording(root_path, condition, id, week, duration, ascii, bad_channels, seed + n)
+    return paths
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write synthetic Akonic recordings')
+    parser.add_argument('root_path', help='folder in which raw/<condition>/<id>/<id>_<week>.EDF are written')
+    parser.add_argument('--conditions', nargs='+', default=['baseline'])
+    parser.add_argument('--subjects', nargs='+', default=['001'])
+    parser.add_argument('--weeks', nargs='+', default=['1'])
+    parser.add_argument('--duration', type=float, default=32, help='duration of every recording in minutes')
+    parser.add_argument('--ascii', action='store_true', help='also write the text export')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    for path in make_cohort(args.root_path, args.conditions, args.subjects, args.weeks, args.duration * 60,
+                            args.ascii, seed=args.seed):
+        print(path)
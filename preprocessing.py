@@ -15,12 +15,10 @@ from autoreject import AutoReject, get_rejection_threshold
 from pyprep import NoisyChannels
 
 
-# tag automatically ICA components
-# requires pytorch
-from mne_icalabel import label_components
-
 # Import helper functions for preprocessing
 import utils.preprocessing_helpers as preprocessing_helpers
+# tag automatically ICA components (ICLabel requires pytorch or onnxruntime)
+import utils.ica_scoring as ica_scoring
 from utils.log_preprocessing import LogPreprocessingDetails
 
 
@@ -77,10 +75,8 @@ log_preprocessing = LogPreprocessingDetails(json_path, id, condition, week)
 
 # Construct the full file path and read the raw EEG data file
 raw_file = os.path.join(root_path,  raw_folder, condition, str(id),filename)
-raw =   preprocessing_helpers.read_edf_akonic(raw_file)
-
-# Set the montage (electrode positions)
-raw = preprocessing_helpers.set_chs_montage(raw)
+# with the channel names, types and montage (electrode positions) of the Akonic layout
+raw =   preprocessing_helpers.read_edf_akonic(raw_file, layout=preprocessing_helpers.AKONIC_LAYOUT)
 
 print(raw.info)
 
@@ -218,55 +214,27 @@ ica = mne.preprocessing.ICA(n_components=n_components, method=method, max_iter=m
 # Fit the ICA model to the cleaned epochs
 ica.fit(epochs_clean)
 
-# find EOG artifacts in the data via pattern matching, and exclude the EOG-related ICA components
-eog_components, eog_scores = ica.find_bads_eog(
-    inst=epochs_clean,
-    ch_name="Fp1",  # a channel close to the eye
-    # threshold=1  # lower than the default threshold
-)
-print(f"EOG components detected: {eog_components}")
-
-# find ECG artifacts in the data via pattern matching, and exclude the ECG-related ICA components
-ecg_components, ecg_scores = ica.find_bads_ecg(
-    inst=epochs_clean,
-    ch_name="ECG",  # a channel close to the eye
-    # threshold=1  # lower than the default threshold
-)
-print(f"ECG components detected: {ecg_components}")
-
-# find muscle artifacts in the data via pattern matching, and exclude the muscle-related ICA components
-muscle_components, muscle_scores = ica.find_bads_muscle(epochs_clean, threshold=0.7)
-print(f"Muscle components detected: {muscle_components}")
-# ica.plot_scores(muscle_scores, exclude=muscle_components)
-
-##### Classify the components using ICLabel model #######
-# run the model on the ICA components
-ic_labels = label_components(epochs_clean, ica, method="iclabel")
-# print labels of each component
-print("Classification of all ICA components. Results:")
-print(ic_labels["labels"])
-
-# Extract ICA component labels
-label_names = ic_labels['labels']
-# Combine all artifact components from the pattern matching methods
-pattern_matching_artifacts = np.unique(ecg_components + eog_components + muscle_components)
-
-# Identify the ICA components that correspond to a 'channel noise' in ICLabel
-channel_artifact_indices = [i for i, label in enumerate(label_names) if label == 'channel noise']
+# Score every component once from its source time courses (see utils/ica_scoring.py):
+# correlation with Fp1 (a channel close to the eye) for EOG, cross-trial phase statistics
+# for ECG, the spectral slope / focus / smoothness for muscle and the ICLabel probabilities
+scores = ica_scoring.score_components(ica, epochs_clean, eog_ch='Fp1', ecg_ch='ECG')
 
 # Find components that coincide between pattern matching and ICLabel output for exclusion
-# We'll only exclude components that match the artifacts found via pattern matching 
-# and are classified as 'muscle artifact', 'eye blink', 'heart beat', or 'channel noise'
-to_exclude = []
-for idx in pattern_matching_artifacts:
-    if label_names[idx] in ['muscle artifact', 'eye blink', 'heart beat', 'channel noise']:
-        to_exclude.append(idx)
-
-# Also ensure to include 'channel noise' components that were found only by ICLabel
-to_exclude = np.unique(to_exclude + channel_artifact_indices)
+# We'll only exclude components that match the artifacts found via pattern matching
+# and are classified as 'muscle artifact', 'eye blink', 'heart beat', or 'channel noise',
+# plus the 'channel noise' components that were found only by ICLabel
+# (e.g. {'eog_threshold': 2.5} for a lower threshold than the default)
+ica_decisions = ica_scoring.decide(scores, {'muscle_threshold': 0.7})
+ica_scoring.set_labels(ica, ica_decisions, eog_ch='Fp1', ecg_ch='ECG')
+print(f"EOG components detected: {ica_decisions.attrs['found_by_scores']['eog']}")
+print(f"ECG components detected: {ica_decisions.attrs['found_by_scores']['ecg']}")
+print(f"Muscle components detected: {ica_decisions.attrs['found_by_scores']['muscle']}")
+# print labels of each component
+print("Classification of all ICA components. Results:")
+print(ica_decisions[['label', 'eog', 'ecg', 'muscle', 'exclude', 'reason']])
 
 # Exclude the selected components
-ica.exclude = to_exclude.tolist()
+ica.exclude = ica_decisions.index[ica_decisions['exclude']].tolist()
 
 # (Optional) Plot the ICA components for visual inspection
 # ica.plot_components(inst=epochs_clean, picks=range(15))
@@ -288,6 +256,8 @@ epochs_ica = ica.apply(inst=epochs_clean)
 
 # Log the ICA parameters and excluded components
 log_preprocessing.log_detail('ica_components', ica.exclude)
+# the decisions of this log were taken by hand, see utils/manual_decisions.decisions_from_log
+log_preprocessing.log_detail('manual_mode', 'interactive')
 log_preprocessing.log_detail('ica_method', method)
 log_preprocessing.log_detail('ica_max_iter', max_iter)
 log_preprocessing.log_detail('ica_random_state', random_state)
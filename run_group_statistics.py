@@ -0,0 +1,54 @@
+import argparse
+
+
+"""
+Per channel group statistics (mean, variance, quantiles, epoch counts) of the
+preprocessed epochs of the cohort, read as memory maps (or from the views of
+the -prepro_eeg.h5 stores) in a pool of processes (see utils/cohort.py), and
+the recordings that are missing or stale relative to the preprocessing log.
+
+Examples:
+    python run_group_statistics.py --n-jobs 8 --output group_statistics.csv
+    python run_group_statistics.py --group-by condition window --include ok stale
+"""
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Group statistics of the preprocessed epochs')
+    parser.add_argument('--root-path', default='results', help='folder containing raw/ and derivatives/')
+    parser.add_argument('--json-path', default='logs_preprocessing_details_all_subjects.db')
+    parser.add_argument('--windows', nargs='+', default=['baseline', 'dosis'])
+    parser.add_argument('--conditions', nargs='+', default=None)
+    parser.add_argument('--subjects', nargs='+', default=None)
+    parser.add_argument('--group-by', nargs='+', default=['condition', 'week', 'window'])
+    parser.add_argument('--include', nargs='+', default=['ok'],
+                        help='statuses of the files included in the statistics (ok, stale, not_logged)')
+    parser.add_argument('--n-jobs', type=int, default=1)
+    parser.add_argument('--output', default=None, help='statistics to this .csv or .parquet file')
+    parser.add_argument('--status-file', default=None, help='status of every recording to this .csv file')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    import time
+    from utils.cohort import check_derivatives, group_statistics
+
+    report = check_derivatives(args.root_path, args.json_path, args.windows, args.conditions, args.subjects)
+    print(report['status'].value_counts().to_string())
+    problems = report[report['status'] != 'ok']
+    if not problems.empty:
+        print(problems[['condition', 'subject', 'week', 'window', 'status', 'reason']].to_string(index=False))
+    if args.status_file is not None:
+        report.to_csv(args.status_file, index=False)
+
+    start = time.perf_counter()
+    files = report[report['status'].isin(args.include)]
+    statistics = group_statistics(files, args.group_by, n_jobs=args.n_jobs)
+    print(f"{len(files)} files in {time.perf_counter() - start:.1f} s")
+    if args.output is None:
+        print(statistics.to_string())
+    elif args.output.endswith('.parquet'):
+        statistics.to_parquet(args.output)
+    else:
+        statistics.to_csv(args.output)
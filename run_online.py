@@ -0,0 +1,93 @@
+import argparse
+import json
+import time
+
+
+"""
+Online preprocessing of a recording while it is acquired (see utils/online.py),
+with the frozen model (AutoReject thresholds, ICA, bad channels) of a preprocessed
+recording of the subject. One line per epoch with its quality flags.
+
+Examples:
+    # EDF file written by the acquisition, the model of week 1
+    python run_online.py --edf live.EDF --condition baseline --subject 022 --model-week 1
+    # samples sent on a socket, here by a stand-in for the amplifier replaying an EDF file
+    python run_online.py --serve-edf results/raw/baseline/022/022_2.EDF --port 5555 --speed 10 &
+    python run_online.py --socket localhost:5555 --condition baseline --subject 022 --model-week 1
+"""
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Preprocess a recording while it is acquired')
+    parser.add_argument('--edf', default=None, help='EDF file being written')
+    parser.add_argument('--socket', default=None, help='host:port sending float32 samples (see socket_stream)')
+    parser.add_argument('--serve-edf', default=None,
+                        help='send this EDF file on --port in real time (stand-in for the amplifier) and exit')
+    parser.add_argument('--port', type=int, default=5555)
+    parser.add_argument('--sfreq', type=float, default=256, help='sampling frequency of the --socket samples')
+    parser.add_argument('--speed', type=float, default=1., help='--serve-edf speed relative to real time')
+    parser.add_argument('--root-path', default='results', help='folder containing derivatives/')
+    parser.add_argument('--json-path', default='logs_preprocessing_details_all_subjects.db',
+                        help='preprocessing log with the bad channels and ICA components of the model')
+    parser.add_argument('--condition', default=None)
+    parser.add_argument('--subject', default=None)
+    parser.add_argument('--model-week', default=None, help='week of the preprocessed recording used as model')
+    parser.add_argument('--filter', choices=['fir', 'iir'], default='fir',
+                        help='filters of the offline pipeline (delayed) or IIR filters (no delay)')
+    parser.add_argument('--timeout', type=float, default=10., help='stop when the EDF file does not grow for this long')
+    parser.add_argument('--flags-file', default=None, help='append the flags of every epoch to this JSON lines file')
+    parser.add_argument('--save-epochs', default=None,
+                        help='save the epochs that are not rejected to parts of this -epo.fif (see EpochsWriter)')
+    parser.add_argument('--epochs-per-file', type=int, default=300,
+                        help='epochs of every part of --save-epochs, the ones kept in memory')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    import mne
+    import utils.preprocessing_helpers as preprocessing_helpers
+    from utils.log_preprocessing import LogPreprocessingDetails
+    from utils.online import (EpochsWriter, OnlinePreprocessor, edf_stream_info, load_online_model, serve_edf,
+                              socket_stream, tail_edf)
+    from utils.pipeline import get_output_prefix, get_save_folder
+    mne.set_log_level('ERROR')
+
+    if args.serve_edf is not None:
+        serve_edf(args.serve_edf, args.port, speed=args.speed)
+        raise SystemExit
+
+    log = LogPreprocessingDetails(args.json_path, args.subject, args.condition, str(args.model_week)).get_log()
+    model = load_online_model(get_save_folder(args.root_path, args.condition, args.subject),
+                              get_output_prefix(args.subject, args.model_week), log)
+    if args.edf is not None:
+        info = edf_stream_info(args.edf)
+        stream = tail_edf(args.edf, timeout=args.timeout)
+    else:
+        # the channels sent by serve_edf
+        layout = preprocessing_helpers.AKONIC_LAYOUT
+        info = layout.info(layout.channels, args.sfreq)
+        host, port = args.socket.split(':')
+        stream = socket_stream(host, int(port), len(info['ch_names']))
+
+    online = OnlinePreprocessor(info, model, filter=args.filter)
+    print(f"Model {model['source']}, latency {online.latency:.2f} s")
+    flags_file = open(args.flags_file, 'a') if args.flags_file is not None else None
+    writer = EpochsWriter(args.save_epochs, info, args.epochs_per_file) if args.save_epochs is not None else None
+    start = time.perf_counter()
+    for chunk in stream:
+        for epoch in online.push(chunk):
+            flags = epoch['flags']
+            status = 'REJECTED' if flags['rejected'] else 'settling' if flags['settling'] else 'ok'
+            print(f"{epoch['onset']:9.1f} s  {status:<9} bad {','.join(flags['bad_channels']) or '-':<24} "
+                  f"flat {','.join(flags['flat_channels']) or '-':<12}{flags['processing_time'] * 1e3:6.1f} ms")
+            if flags_file is not None:
+                flags_file.write(json.dumps({'onset': epoch['onset'], **flags}) + '\n')
+                flags_file.flush()
+            if writer is not None and not flags['rejected']:
+                writer.add(epoch)
+    if flags_file is not None:
+        flags_file.close()
+    print(f"{online.n_epochs} epochs in {time.perf_counter() - start:.1f} s")
+    if writer is not None:
+        print(f"Epochs saved to {', '.join(writer.close()) or 'no file'}")
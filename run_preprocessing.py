@@ -0,0 +1,287 @@
+import argparse
+import os
+import multiprocessing
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from utils.log_preprocessing import LogPreprocessingDetails, is_sqlite_path, migrate_json_to_sqlite
+from utils.stage_cache import DEFAULT_MAX_GB, StageCache
+
+
+"""
+Headless batch driver for the preprocessing.
+Discovers every results/raw/<condition>/<id>/<id>_<week>.EDF and runs the
+full chain of preprocessing.py (see utils/pipeline.py) for each recording
+in a pool of processes.
+
+Examples:
+    python run_preprocessing.py --n-jobs 8
+    python run_preprocessing.py --conditions baseline --subjects 022 --manual interactive
+"""
+
+
+def _init_worker(threads_per_worker):
+    # Avoid oversubscription: every worker uses its own share of cores
+    for var in ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS']:
+        os.environ[var] = str(threads_per_worker)
+    os.environ.setdefault('MPLBACKEND', 'Agg')
+
+
+def _run_one(recording, params, manual, root_path, json_path, n_jobs_subject, cache, raw_hash=None):
+    # imported here so that the heavy dependencies are loaded in the workers
+    from utils.pipeline import preprocess_subject
+
+    try:
+        details = preprocess_subject(recording['raw_file'], recording['id'], recording['week'],
+                                     recording['condition'], params=params, manual=manual,
+                                     root_path=root_path, json_path=json_path, n_jobs=n_jobs_subject,
+                                     cache=cache, raw_hash=raw_hash)
+        return recording, details, None
+    except Exception:
+        return recording, None, traceback.format_exc()
+
+
+def _save_details(json_path, recording, details):
+    # Only the main process writes the JSON file. With an SQLite log the workers have
+    # already written every detail, this writes them again in one transaction
+    log_preprocessing = LogPreprocessingDetails(json_path, recording['id'], recording['condition'],
+                                                recording['week'])
+    for key, value in details.items():
+        log_preprocessing.log_detail(key, value)
+    log_preprocessing.save_preprocessing_details()
+
+
+def run_batch(recordings, params=None, manual='replay', root_path='results',
+              json_path='logs_preprocessing_details_all_subjects.db', n_workers=None,
+              threads_per_worker=1, cache=None, manifest=None, raw_fingerprints=None):
+    # manifest: a utils.manifest.Manifest in which every recording done is recorded, with the
+    # fingerprints of the raw files computed by the plan ({raw_file: fingerprint})
+    if n_workers is None:
+        n_workers = os.cpu_count()
+    raw_fingerprints = raw_fingerprints or {}
+    start = time.time()
+    # recordings waiting for their deferred report
+    rendering = []
+    # the workers never remove cached stages: the least recently used ones are removed here, after every
+    # recording, so that two workers never walk and remove the cache at the same time (see utils/stage_cache.py)
+    worker_cache = StageCache(cache.root_path) if cache is not None else None
+
+    def raw_hash(recording):
+        # the hash computed by the plan, the workers do not read the raw file again to hash it
+        return raw_fingerprints.get(recording['raw_file'], {}).get('hash')
+
+    def evict():
+        if cache is not None and cache.max_size is not None:
+            cache.evict(cache.max_size)
+
+    def done(recording, details):
+        if details.get('report_deferred') and details.get('report_file'):
+            rendering.append((recording, details))
+        else:
+            record(recording, details)
+        check_reports()
+
+    def record(recording, details):
+        _save_details(json_path, recording, details)
+        if manifest is not None:
+            manifest.record(recording, params, root_path, raw=raw_fingerprints.get(recording['raw_file']))
+        print(f"Done {recording['raw_file']}")
+
+    def check_reports(final=False):
+        # A recording with a deferred report is done once the report is written, it is only moved in place
+        # when complete (see utils/reporting.py). final: every report was rendered or failed
+        for recording, details in list(rendering):
+            report_file = details['report_file']
+            if os.path.exists(report_file) and os.path.getmtime(report_file) >= start:
+                rendering.remove((recording, details))
+                record(recording, details)
+            elif final:
+                rendering.remove((recording, details))
+                print(f"Failed {recording['raw_file']}\nthe report {report_file} was not written")
+                failed.append(recording)
+
+    failed = []
+    if manual == 'interactive' or n_workers == 1:
+        # a human has to look at the plots: one recording at a time in this process
+        for recording in recordings:
+            recording, details, error = _run_one(recording, params, manual, root_path, json_path, -1, worker_cache,
+                                                 raw_hash(recording))
+            if error is None:
+                done(recording, details)
+            else:
+                print(f"Failed {recording['raw_file']}\n{error}")
+                failed.append(recording)
+            evict()
+        from utils.reporting import wait_for_reports
+        wait_for_reports()
+        check_reports(final=True)
+        return failed
+
+    # spawn: the workers start clean, without the threads of the parent
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=n_workers, mp_context=context, initializer=_init_worker,
+                             initargs=(threads_per_worker,)) as executor:
+        futures = {executor.submit(_run_one, recording, params, manual, root_path, json_path,
+                                   threads_per_worker, worker_cache, raw_hash(recording)): recording
+                   for recording in recordings}
+        for future in as_completed(futures):
+            try:
+                recording, details, error = future.result()
+            except Exception:
+                # the worker died (e.g. killed because it ran out of memory)
+                recording, details, error = futures[future], None, traceback.format_exc()
+            if error is None:
+                done(recording, details)
+            else:
+                print(f"Failed {recording['raw_file']}\n{error}")
+                failed.append(recording)
+            evict()
+    # the workers have exited, after their render thread
+    check_reports(final=True)
+    return failed
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Preprocess every EDF recording of the cohort')
+    parser.add_argument('--root-path', default='results', help='folder containing raw/ and derivatives/')
+    parser.add_argument('--json-path', default='logs_preprocessing_details_all_subjects.db',
+                        help='preprocessing log, an SQLite database (.db) or a JSON file (.json)')
+    parser.add_argument('--migrate-from', default='logs_preprocessing_details_all_subjects.json',
+                        help='JSON log copied into the SQLite log when it does not exist yet')
+    parser.add_argument('--conditions', nargs='+', default=None)
+    parser.add_argument('--subjects', nargs='+', default=None)
+    parser.add_argument('--weeks', nargs='+', default=None)
+    parser.add_argument('--n-jobs', type=int, default=None, help='number of worker processes (default: all cores)')
+    parser.add_argument('--threads-per-worker', type=int, default=1)
+    parser.add_argument('--manual', choices=['interactive', 'replay', 'skip'], default='replay',
+                        help='how to handle the manual inspection steps')
+    parser.add_argument('--read-padding', type=float, default=None,
+                        help='read only from the baseline to the end of the dosis, with this padding in seconds')
+    parser.add_argument('--ransac', choices=['always', 'auto', 'never'], default='always',
+                        help='RANSAC on every channel, only on the channels the other criteria cannot decide on, '
+                             'or never')
+    parser.add_argument('--autoreject-mode', choices=['fit', 'warm', 'fixed'], default='fit',
+                        help='fit AutoReject, start from a stored model or apply a stored model as is')
+    parser.add_argument('--autoreject-scope', choices=['recording', 'subject', 'condition'], default='subject',
+                        help='where to look for a stored AutoReject model')
+    parser.add_argument('--autoreject-fit-epochs', type=float, default=None,
+                        help='fit AutoReject on a random subsample of epochs (a fraction or a number of epochs)')
+    parser.add_argument('--window-bins', type=float, default=None,
+                        help='also cut the baseline and the dosis in bins of this many seconds (e.g. 60)')
+    parser.add_argument('--derivative-format', choices=['fif', 'hdf5', 'both'], default='fif',
+                        help='FIF files of the epochs and windows, one compressed HDF5 store with the windows as '
+                             'views, or both')
+    parser.add_argument('--derivative-compression', choices=['lzf', 'gzip', 'none'], default='lzf',
+                        help='compression of the HDF5 store')
+    parser.add_argument('--report', choices=['full', 'light', 'none'], default='full',
+                        help='full report as preprocessing.py, summary plots only or no report')
+    parser.add_argument('--report-deferred', action='store_true',
+                        help='render the reports in a background thread while the next recording runs')
+    parser.add_argument('--precision', choices=['float64', 'float32'], default='float64',
+                        help='keep the epochs in double or single precision')
+    parser.add_argument('--worker-memory-gb', default=None,
+                        help="memory budget of a worker in GB, or 'auto' for the highest peak of the "
+                             "profiled recordings in the log; the number of workers is reduced to fit "
+                             "in --memory-limit-gb and a recording above the budget fails")
+    parser.add_argument('--memory-limit-gb', type=float, default=None,
+                        help='memory the workers can use in total (default: the available memory)')
+    parser.add_argument('--profile-summary', action='store_true',
+                        help='print the time and memory of every stage across the recordings of the log and exit')
+    parser.add_argument('--no-cache', action='store_true', help='recompute every stage')
+    parser.add_argument('--cache-max-gb', type=float, default=DEFAULT_MAX_GB,
+                        help='maximum size of the cached stages, the least recently used are removed '
+                             f'(default: {DEFAULT_MAX_GB}, 0 for no limit)')
+    parser.add_argument('--invalidate', action='store_true',
+                        help='remove the cached stages of the selected recordings before running')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only run the recordings that are new or changed since the manifest '
+                             '(see utils/manifest.py)')
+    parser.add_argument('--plan', action='store_true',
+                        help='print what --incremental would run and exit')
+    parser.add_argument('--manifest', default=None,
+                        help='manifest of the preprocessed recordings (default: <root-path>/derivatives/manifest.json)')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    from utils.pipeline import find_raw_files
+
+    args = parse_args()
+    if args.profile_summary:
+        from utils.profiling import summarize_stage_profiles
+
+        print(summarize_stage_profiles(args.json_path).to_string(float_format=lambda value: f'{value:.2f}'))
+        raise SystemExit
+    if is_sqlite_path(args.json_path) and not os.path.exists(args.json_path) and os.path.exists(args.migrate_from):
+        n_recordings = migrate_json_to_sqlite(args.migrate_from, args.json_path)
+        print(f"Copied {n_recordings} recordings from {args.migrate_from} to {args.json_path}")
+    recordings = find_raw_files(args.root_path, args.conditions, args.subjects, args.weeks)
+    print(f"Found {len(recordings)} recordings")
+
+    cache = None
+    if not args.no_cache:
+        max_size = int(args.cache_max_gb * 1024 ** 3) if args.cache_max_gb > 0 else None
+        cache = StageCache(args.root_path, max_size=max_size)
+        if args.invalidate:
+            for recording in recordings:
+                cache.invalidate(recording['condition'], recording['id'], recording['week'])
+
+    params = {}
+    if args.read_padding is not None:
+        params['read_padding'] = args.read_padding
+    params['ransac'] = args.ransac
+    params['autoreject_mode'] = args.autoreject_mode
+    params['autoreject_scope'] = args.autoreject_scope
+    params['autoreject_fit_epochs'] = args.autoreject_fit_epochs
+    params['window_bins'] = args.window_bins
+    params['derivative_format'] = args.derivative_format
+    params['derivative_compression'] = None if args.derivative_compression == 'none' else args.derivative_compression
+    params['report'] = args.report
+    params['report_deferred'] = args.report_deferred
+    params['precision'] = args.precision
+
+    n_workers = args.n_jobs if args.n_jobs is not None else os.cpu_count()
+    if args.worker_memory_gb is not None:
+        from utils.profiling import estimate_worker_memory, workers_for_memory
+
+        if args.worker_memory_gb == 'auto':
+            worker_memory = estimate_worker_memory(args.json_path)
+        else:
+            worker_memory = float(args.worker_memory_gb) * 1024
+        if worker_memory is None:
+            print('No profiled recording in the log, the number of workers is not limited by memory')
+        else:
+            memory_limit = args.memory_limit_gb * 1024 if args.memory_limit_gb is not None else None
+            n_workers = workers_for_memory(n_workers, worker_memory, memory_limit)
+            params['memory_budget_mb'] = worker_memory
+            print(f"{n_workers} workers with a budget of {worker_memory / 1024:.1f} GB each")
+
+    manifest, raw_fingerprints = None, None
+    if args.incremental or args.plan:
+        from utils.manifest import Manifest, get_manifest_path, plan_runs, plan_to_frame
+
+        manifest = Manifest(args.manifest or get_manifest_path(args.root_path))
+        plan = plan_runs(recordings, manifest, params, args.root_path)
+        table = plan_to_frame(plan)
+        print(table['status'].value_counts().to_string())
+        to_run = table[table['status'] != 'up_to_date']
+        if not to_run.empty:
+            print(to_run.to_string(index=False))
+        if args.plan:
+            raise SystemExit
+        if cache is not None:
+            # the cached stages were computed by other code
+            for item in plan:
+                if item['status'] == 'code_changed':
+                    recording = item['recording']
+                    cache.invalidate(recording['condition'], recording['id'], recording['week'])
+        recordings = [item['recording'] for item in plan if item['status'] != 'up_to_date']
+        raw_fingerprints = {item['recording']['raw_file']: item['raw'] for item in plan}
+        print(f"Running {len(recordings)} recordings")
+
+    failed = run_batch(recordings, params=params, manual=args.manual, root_path=args.root_path, json_path=args.json_path,
+                       n_workers=n_workers, threads_per_worker=args.threads_per_worker, cache=cache,
+                       manifest=manifest, raw_fingerprints=raw_fingerprints)
+    if failed:
+        print(f"{len(failed)} recordings failed: {[r['raw_file'] for r in failed]}")
@@ -0,0 +1,76 @@
+import json
+import os
+import numpy as np
+
+import mne
+import pytest
+
+from utils.autoreject_models import find_model, get_model_params, is_compatible, run_autoreject, save_model
+
+
+def write_model(folder, prefix, ch_names=('Cz',), h5=True):
+    os.makedirs(folder, exist_ok=True)
+    with open(os.path.join(folder, f'{prefix}-autoreject.json'), 'w') as f:
+        json.dump({'ch_names': list(ch_names), 'bads': []}, f)
+    if h5:
+        open(os.path.join(folder, f'{prefix}-autoreject.h5'), 'wb').close()
+
+
+def test_find_model_scopes(tmp_path):
+    condition = tmp_path / 'baseline'
+    write_model(str(condition / '022'), '022_2')
+    write_model(str(condition / '023'), '023_1')
+    # a model whose .h5 is not written is not found
+    write_model(str(condition / '022'), '022_3', h5=False)
+
+    assert find_model(str(condition / '022'), '022_1', scope='recording') is None
+    assert find_model(str(condition / '022'), '022_1')['source'] == '022_2'
+    assert find_model(str(condition / '024'), '024_1', scope='subject') is None
+    assert find_model(str(condition / '024'), '024_1', scope='condition')['source'] == '022_2'
+    # the model of the recording comes first
+    write_model(str(condition / '023'), '023_2')
+    model = find_model(str(condition / '023'), '023_2', scope='condition')
+    assert (model['source'], model['h5_file']) == ('023_2', str(condition / '023' / '023_2-autoreject.h5'))
+    with pytest.raises(ValueError, match='scope must be one of'):
+        find_model(str(condition / '022'), '022_1', scope='cohort')
+
+
+@pytest.fixture(scope='module')
+def epochs():
+    ch_names = ['Fp1', 'Fp2', 'F3', 'F4', 'C3', 'C4', 'P3', 'P4', 'O1', 'O2']
+    info = mne.create_info(ch_names, 100., 'eeg')
+    rng = np.random.RandomState(0)
+    data = rng.randn(30, len(ch_names), 100) * 1e-5
+    # artifacts in a few epochs
+    data[[3, 11], 2] *= 40
+    data[17] *= 30
+    epochs = mne.EpochsArray(data, info, verbose=False)
+    epochs.set_montage('standard_1020', verbose=False)
+    return epochs
+
+
+def test_warm_and_fixed_models(epochs, tmp_path):
+    _, reject, ar, details = run_autoreject(epochs.copy(), 3, 0)
+    assert details['mode'] == 'fit'
+    assert 17 in details['reject_log']['bad_epochs']
+    save_model(str(tmp_path), '022_1', ar, get_model_params(ar, epochs, reject))
+    model = find_model(str(tmp_path), '022_2')
+    assert is_compatible(model, epochs)
+
+    # the stored model applied as is cleans the epochs as the fitted one
+    clean, _, _, fixed = run_autoreject(epochs.copy(), 3, 0, mode='fixed', model=model)
+    assert (fixed['mode'], fixed['source'], fixed['n_fit_epochs']) == ('fixed', '022_1', 0)
+    assert fixed['reject_log'] == details['reject_log']
+
+    # warm: the thresholds are fitted again on the stored point of the grid
+    _, _, ar_warm, warm = run_autoreject(epochs.copy(), 3, 0, mode='warm', model=model)
+    assert (warm['mode'], warm['source']) == ('warm', '022_1')
+    assert list(ar_warm.n_interpolate) == [details['n_interpolate']['eeg']]
+    assert list(ar_warm.consensus) == [details['consensus']['eeg']]
+
+    # other bad channels: a fixed model is fitted again, warm started
+    epochs_bads = epochs.copy()
+    epochs_bads.info['bads'] = ['O2']
+    assert not is_compatible(model, epochs_bads)
+    _, _, _, refit = run_autoreject(epochs_bads, 3, 0, mode='fixed', model=model)
+    assert refit['mode'] == 'warm'
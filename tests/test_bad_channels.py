@@ -0,0 +1,63 @@
+import numpy as np
+
+import pytest
+from pyprep import NoisyChannels
+
+from benchmarks.synthetic_akonic import simulate_recording, write_edf
+from utils.bad_channels import find_bad_by_ransac, find_bad_channels, get_suspicious_channels
+from utils.pipeline import filter_raw, read_raw
+
+
+@pytest.fixture(scope='module')
+def raw_filtered(tmp_path_factory):
+    # T8 noisy and P4 flat
+    signals, eeg = simulate_recording(60, seed=0)
+    raw = read_raw(write_edf(str(tmp_path_factory.mktemp('raw') / '001_1.EDF'), signals, eeg))
+    return filter_raw(raw, 1, 45)
+
+
+def cheap_criteria(raw_filtered):
+    nd = NoisyChannels(raw_filtered, do_detrend=False, random_state=42)
+    for method in [nd.find_bad_by_nan_flat, nd.find_bad_by_deviation, nd.find_bad_by_hfnoise,
+                   nd.find_bad_by_correlation, nd.find_bad_by_SNR]:
+        method()
+    return nd
+
+
+def test_ransac_is_the_channel_wise_ransac_of_pyprep(raw_filtered):
+    expected = cheap_criteria(raw_filtered)
+    expected.find_bad_by_ransac(channel_wise=True)
+    expected_correlations = expected._extra_info['bad_by_ransac']['ransac_correlations'][:, expected.usable_idx]
+    # the same random channel subsets whatever the number of jobs
+    for n_jobs in [1, 2]:
+        nd = cheap_criteria(raw_filtered)
+        assert find_bad_by_ransac(nd, n_jobs=n_jobs) == expected.bad_by_ransac
+        np.testing.assert_allclose(nd._extra_info['bad_by_ransac']['ransac_correlations'], expected_correlations)
+
+    result = find_bad_channels(raw_filtered, ransac='always', n_jobs=2)
+    assert result['bads_by_criterion']['bad_by_ransac'] == expected.bad_by_ransac
+    assert result['ransac_status'] == 'all channels'
+    assert {'T8', 'P4'} <= set(result['bads'])
+
+
+def test_ransac_auto_predicts_the_suspicious_channels(raw_filtered):
+    nd = cheap_criteria(raw_filtered)
+    suspicious = get_suspicious_channels(nd, margin=0.)
+    assert suspicious and not set(suspicious) & set(nd.get_bads())
+    find_bad_by_ransac(nd, suspicious[:2])
+    # the channels that are not predicted keep a correlation of 1
+    correlations = nd._extra_info['bad_by_ransac']['ransac_correlations']
+    predicted = [ch for ch, column in zip(nd.ch_names_new, correlations.T) if not np.all(column == 1)]
+    assert predicted == [ch for ch in nd.ch_names_new if ch in suspicious[:2]]
+
+    result = find_bad_channels(raw_filtered, ransac='auto', margin=0.)
+    assert result['ransac_channels'] == suspicious
+    assert result['ransac_status'] == f'{len(suspicious)} channels'
+
+
+def test_ransac_never(raw_filtered):
+    result = find_bad_channels(raw_filtered, ransac='never')
+    assert (result['ransac_channels'], result['ransac_status']) == ([], 'skipped')
+    assert result['bads_by_criterion']['bad_by_ransac'] == []
+    with pytest.raises(ValueError, match='ransac must be one of'):
+        find_bad_channels(raw_filtered, ransac='sometimes')
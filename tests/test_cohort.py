@@ -0,0 +1,108 @@
+import os
+import numpy as np
+
+import mne
+import pandas as pd
+import pytest
+
+import utils.cohort as cohort
+from utils.cohort import (check_derivatives, count_epochs, group_statistics, index_derivatives, memmap_epochs,
+                          read_epochs_header, recording_statistics)
+from utils.epochs_store import get_store_file, write_epochs_store
+from utils.log_preprocessing import LogPreprocessingDetails
+from utils.pipeline import get_output_prefix, get_raw_file, get_save_folder, save_epochs
+
+
+def write_recording(root, condition, id, week, n_epochs):
+    # An empty raw file and the baseline window, older and newer than each other as after a run
+    raw_file = get_raw_file(root, condition, id, week)
+    os.makedirs(os.path.dirname(raw_file))
+    open(raw_file, 'wb').close()
+    os.utime(raw_file, (0, 0))
+    info = mne.create_info(['Cz', 'Pz'], 100., 'eeg')
+    epochs = mne.EpochsArray(np.zeros((n_epochs, 2, 200)), info, verbose=False)
+    save_folder = get_save_folder(root, condition, id)
+    os.makedirs(save_folder)
+    save_epochs(epochs, os.path.join(save_folder, f'{get_output_prefix(id, week)}-baseline-prepro_eeg.fif'))
+    return raw_file
+
+
+@pytest.mark.parametrize('extension', ['.db', '.json'])
+def test_check_derivatives_logged_recording_is_ok(tmp_path, extension):
+    root, json_path = str(tmp_path), str(tmp_path / f'log{extension}')
+    for condition, id, n_epochs in [('baseline', '022', 3), ('ketamine', '023', 4)]:
+        raw_file = write_recording(root, condition, id, '1', n_epochs)
+        # logged as preprocess_subject does
+        log = LogPreprocessingDetails(json_path, id, condition, '1')
+        log.log_detail('n_epochs_windows', {'baseline': n_epochs})
+        log.log_detail('raw_file', raw_file)
+        log.save_preprocessing_details()
+
+    report = check_derivatives(root, json_path, windows=['baseline'])
+    assert report['status'].tolist() == ['ok', 'ok']
+    assert report[['condition', 'subject', 'week']].values.tolist() == [['baseline', '022', '1'],
+                                                                          ['ketamine', '023', '1']]
+    assert report['n_epochs'].tolist() == [3, 4]
+
+    report = check_derivatives(root, json_path, windows=['baseline'], conditions=['ketamine'])
+    assert report[['condition', 'status']].values.tolist() == [['ketamine', 'ok']]
+
+
+def test_check_derivatives_stale_and_missing(tmp_path):
+    root, json_path = str(tmp_path), str(tmp_path / 'log.db')
+    raw_file = write_recording(root, 'baseline', '022', '1', 3)
+    log = LogPreprocessingDetails(json_path, '022', 'baseline', '1')
+    log.log_detail('n_epochs_windows', {'baseline': 5, 'dosis': 2})
+    log.log_detail('raw_file', raw_file)
+
+    report = check_derivatives(root, json_path).set_index('window')
+    assert report.loc['baseline', 'status'] == 'stale'
+    assert report.loc['dosis', 'status'] == 'missing'
+
+
+def test_cohort_reads_the_views_of_a_store(tmp_path):
+    # the same recording written as FIF (derivative_format 'fif') and as a store ('hdf5')
+    info = mne.create_info(['Cz', 'Pz'], 100., 'eeg')
+    data = np.random.RandomState(0).randn(6, 2, 200) * 1e-5
+    events = np.column_stack([np.arange(6) * 200, np.zeros(6, int), np.ones(6, int)])
+    epochs = mne.EpochsArray(data.astype(np.float32).astype(np.float64), info, events, verbose=False)
+    windows = {'baseline': (0, 6), 'dosis': (6, 12)}
+    stats = {}
+    for root in ['fif', 'hdf5']:
+        save_folder = get_save_folder(str(tmp_path / root), 'baseline', '022')
+        os.makedirs(save_folder)
+        if root == 'fif':
+            for window, (start, stop) in windows.items():
+                save_epochs(epochs[start // 2:stop // 2], os.path.join(save_folder, f'022_1-{window}-prepro_eeg.fif'))
+        else:
+            write_epochs_store(epochs, get_store_file(save_folder, '022_1'), windows)
+        index = index_derivatives(str(tmp_path / root))
+        assert index['window'].tolist() == ['baseline', 'dosis']
+        assert [count_epochs(path, view) for path, view in zip(index['path'], index['view'])] == [3, 3]
+        stats[root] = group_statistics(index)
+    pd.testing.assert_frame_equal(stats['fif'], stats['hdf5'])
+
+
+def test_memmap_epochs(tmp_path, monkeypatch):
+    info = mne.create_info(['Cz', 'Pz', 'ECG'], 100., ['eeg', 'eeg', 'ecg'])
+    data = np.random.RandomState(0).randn(5, 3, 200) * 1e-5
+    path = str(tmp_path / '022_1-baseline-prepro_eeg.fif')
+    save_epochs(mne.EpochsArray(data, info, verbose=False), path)
+    expected = read_epochs_header(path).get_data()
+
+    ch_names, picks, parts = memmap_epochs(path)
+    assert ch_names == ['Cz', 'Pz']
+    np.testing.assert_allclose(np.concatenate([data * cals for data, cals in parts])[:, picks], expected[:, :2],
+                               rtol=1e-6)
+
+    # without the layout of the file, the epochs are read with get_data and give the same statistics
+    statistics = recording_statistics(path, chunk_epochs=2).to_frame()
+    monkeypatch.setattr(cohort, '_memmap_parts', lambda epochs: None)
+    pd.testing.assert_frame_equal(recording_statistics(path, chunk_epochs=2).to_frame(), statistics)
+
+
+def test_memmap_parts_without_the_layout():
+    # the private attributes of another version of MNE
+    class Part:
+        fmt = '>f4'
+    assert cohort._memmap_parts(type('Epochs', (), {'_raw': [Part()]})()) is None
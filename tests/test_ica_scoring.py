@@ -0,0 +1,134 @@
+import numpy as np
+import pandas as pd
+
+import mne
+import pytest
+
+from utils.ica_scoring import decide, find_artifacts, score_components, DEFAULT_RULES
+
+
+N_COMPONENTS = 15
+
+
+@pytest.fixture
+def scores():
+    # Scores of 15 components:
+    #   0 correlated with Fp1, eye blink      1 phase locked to the ECG, heart beat
+    #   2 correlated with the ECG, brain      3 muscle criteria, muscle artifact
+    #   4 channel noise                       5 eye blink without EOG score
+    #   6 other                               the others brain and not found by any method
+    small = np.linspace(-0.05, 0.05, N_COMPONENTS)
+    scores = pd.DataFrame(index=pd.RangeIndex(N_COMPONENTS, name='component'))
+    scores['eog_r'] = small.copy()
+    scores.loc[0, 'eog_r'] = 0.9
+    scores['ecg_r'] = small[::-1].copy()
+    scores.loc[2, 'ecg_r'] = 0.8
+    scores['ecg_ctps'] = 0.1
+    scores.loc[1, 'ecg_ctps'] = 0.5
+    for name in ['muscle_slope', 'muscle_focus', 'muscle_smoothness']:
+        scores[name] = 0.2
+        scores.loc[3, name] = 0.95
+    scores['muscle_score'] = scores.filter(like='muscle_').prod(axis=1)
+    scores['label'] = 'brain'
+    scores.loc[[0, 1, 3, 4, 5, 6], 'label'] = ['eye blink', 'heart beat', 'muscle artifact', 'channel noise',
+                                                'eye blink', 'other']
+    return scores
+
+
+def excluded(table):
+    return table.index[table['exclude']].tolist()
+
+
+def test_find_artifacts(scores):
+    found = find_artifacts(scores, DEFAULT_RULES)
+    assert found == {'eog': [0], 'ecg': [1], 'muscle': [3]}
+
+
+def test_decide_default_rules(scores):
+    table = decide(scores)
+    # the eye blink without EOG score counts as found by the EOG method, as ICLabel did with ica.labels_
+    assert excluded(table) == [0, 1, 3, 4, 5]
+    assert table.loc[[0, 1, 3, 4, 5], 'reason'].tolist() == ['eog (eye blink)', 'ecg (heart beat)',
+                                                            'muscle (muscle artifact)', 'label (channel noise)',
+                                                            'eog (eye blink)']
+    assert table.attrs['found_by_scores'] == {'eog': [0], 'ecg': [1], 'muscle': [3]}
+    assert table.attrs['found']['eog'] == [0, 5]
+    assert (table.loc[~table['exclude'], 'reason'] == '').all()
+
+
+def test_decide_without_label_methods(scores):
+    table = decide(scores, {'label_methods': {}})
+    assert excluded(table) == [0, 1, 3, 4]
+    assert not table.loc[5, 'eog']
+
+
+def test_decide_ecg_correlation(scores):
+    table = decide(scores, {'ecg_method': 'correlation', 'label_methods': {}})
+    # component 2 is found by the ECG correlation but ICLabel does not confirm it
+    assert table.attrs['found_by_scores']['ecg'] == [2]
+    assert table.loc[2, 'ecg'] and not table.loc[2, 'exclude']
+    assert excluded(table) == [0, 3, 4]
+
+
+def test_decide_unknown_ecg_method(scores):
+    with pytest.raises(ValueError, match='ecg_method'):
+        decide(scores, {'ecg_method': 'template'})
+
+
+def test_decide_exclude_labels(scores):
+    assert excluded(decide(scores, {'exclude_labels': []})) == [0, 1, 3, 5]
+    table = decide(scores, {'exclude_labels': ['channel noise', 'other']})
+    assert excluded(table) == [0, 1, 3, 4, 5, 6]
+    assert table.loc[6, 'reason'] == 'label (other)'
+
+
+def test_decide_muscle_threshold(scores):
+    # 0.2 ** 3 is above 0.1 ** 3: every component is found by the muscle criteria, only the ones
+    # labelled as an artifact are excluded
+    table = decide(scores, {'muscle_threshold': 0.1, 'label_methods': {}})
+    assert table['muscle'].all()
+    assert excluded(table) == [0, 1, 3, 4, 5]
+
+
+def test_decide_ecg_threshold(scores):
+    # 'auto' is the threshold of the ICA of the scores for ctps (0.3 without it) and 3.0 for the z-score of
+    # the correlation, as find_bads_ecg
+    scores.attrs['ecg_ctps_threshold'] = 0.6
+    assert decide(scores).attrs['found_by_scores']['ecg'] == []
+    scores.attrs['ecg_ctps_threshold'] = 0.45
+    assert decide(scores).attrs['found_by_scores']['ecg'] == [1]
+    assert decide(scores, {'ecg_threshold': 0.6}).attrs['found_by_scores']['ecg'] == []
+    assert decide(scores, {'ecg_method': 'correlation', 'ecg_threshold': 3.0}).attrs['found_by_scores']['ecg'] == [2]
+
+
+@pytest.fixture(scope='module')
+def ecg_ica():
+    # ICA of 8 EEG channels with a leak of the ECG channel, at 256 Hz. The epochs are locked to the beats,
+    # as the ECG epochs of find_bads_ecg
+    rng = np.random.RandomState(0)
+    ch_names = ['Fp1', 'Fp2', 'F3', 'F4', 'C3', 'C4', 'O1', 'O2']
+    info = mne.create_info(ch_names + ['ECG'], 256., ['eeg'] * len(ch_names) + ['ecg'])
+    n_epochs, n_times = 30, 512
+    ecg = np.zeros((n_epochs, n_times))
+    for beat in [100, 300]:
+        ecg[:, beat:beat + 10] = np.hanning(10)
+    eeg = rng.randn(n_epochs, len(ch_names), n_times) + 5 * rng.rand(len(ch_names))[:, None] * ecg[:, None]
+    epochs = mne.EpochsArray(np.concatenate([eeg, ecg[:, None]], axis=1) * 1e-5, info, verbose=False)
+    epochs.set_montage('standard_1020')
+    ica = mne.preprocessing.ICA(n_components=6, random_state=0, max_iter=500)
+    ica.fit(epochs, picks='eeg', verbose=False)
+    return epochs, ica
+
+
+def test_decide_matches_find_bads_ecg(ecg_ica):
+    epochs, ica = ecg_ica
+    scores = score_components(ica.copy(), epochs, eog_ch=None, ecg_ch='ECG')
+    ecg_idx, ctps = ica.copy().find_bads_ecg(epochs, ch_name='ECG', method='ctps', verbose=False)
+    np.testing.assert_allclose(scores['ecg_ctps'], ctps)
+    assert len(ecg_idx)
+    assert decide(scores).attrs['found_by_scores']['ecg'] == list(ecg_idx)
+    # with the threshold just above the lowest score found, as with find_bads_ecg
+    threshold = ctps[ecg_idx].min() + 1e-9
+    scores.attrs['ecg_ctps_threshold'] = threshold
+    expected = ica.copy().find_bads_ecg(epochs, ch_name='ECG', threshold=threshold, verbose=False)[0]
+    assert decide(scores).attrs['found_by_scores']['ecg'] == list(expected)
@@ -0,0 +1,61 @@
+import warnings
+import numpy as np
+
+import mne
+import pytest
+from mne_icalabel import label_components
+
+from benchmarks.synthetic_akonic import simulate_recording, write_edf
+from utils.ica_scoring import get_sources, iclabel_activations
+from utils.iclabel_batch import get_iclabel_model, label_components_batch
+from utils.pipeline import filter_raw, make_epochs, read_raw
+
+
+@pytest.fixture(scope='module')
+def decompositions(tmp_path_factory):
+    # two recordings, average referenced and filtered as ICLabel expects, with their extended infomax ICA
+    folder = tmp_path_factory.mktemp('raw')
+    decompositions = []
+    for seed in [0, 1]:
+        signals, eeg = simulate_recording(30, seed=seed)
+        raw = read_raw(write_edf(str(folder / f'00{seed}_1.EDF'), signals, eeg))
+        epochs = make_epochs(filter_raw(raw, 1, 100).set_eeg_reference('average', verbose=False), 2.)
+        epochs.pick('eeg')
+        ica = mne.preprocessing.ICA(n_components=8, method='infomax', fit_params={'extended': True},
+                                    max_iter=100, random_state=0)
+        ica.fit(epochs, verbose=False)
+        decompositions.append((epochs, ica))
+    return decompositions
+
+
+def copy(decompositions):
+    return [(epochs, ica.copy()) for epochs, ica in decompositions]
+
+
+def test_batch_equals_label_components(decompositions):
+    results = label_components_batch(copy(decompositions), backend='onnx')
+    assert len(results) == 2
+    for (epochs, ica), result in zip(copy(decompositions), results):
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            expected = label_components(epochs, ica, method='iclabel')
+        assert result['labels'] == expected['labels']
+        np.testing.assert_allclose(result['y_pred_proba'], expected['y_pred_proba'], rtol=1e-5, atol=1e-6)
+        assert result['labels_pred_proba'].shape == (8, 7)
+    assert label_components_batch([]) == []
+    # the network is loaded once
+    assert get_iclabel_model('onnx') is get_iclabel_model('onnx')
+
+
+def test_batch_with_activations(decompositions):
+    # the activations computed from the sources give the labels of the ones computed by ICLabel
+    expected = label_components_batch(copy(decompositions), backend='onnx')
+    pairs = copy(decompositions)
+    activations = [iclabel_activations(ica, get_sources(ica, epochs)) for epochs, ica in pairs]
+    results = label_components_batch([(epochs, ica, icaact) for (epochs, ica), icaact in zip(pairs, activations)],
+                                     backend='onnx')
+    for (_, ica), result, expected_result in zip(pairs, results, expected):
+        assert result['labels'] == expected_result['labels']
+        np.testing.assert_allclose(result['labels_pred_proba'], expected_result['labels_pred_proba'], atol=1e-4)
+        # added to the ICA as label_components does
+        np.testing.assert_array_equal(ica.labels_scores_, result['labels_pred_proba'])
@@ -0,0 +1,11 @@
+import pytest
+
+from benchmarks.bench_import import HEAVY_PACKAGES, import_times
+
+
+@pytest.mark.parametrize('module', ['run_preprocessing', 'utils.pipeline', 'utils.autoreject_models'])
+def test_headless_modules_do_not_import_the_heavy_dependencies(module):
+    # in a fresh interpreter, as a pool worker before its first recording
+    total, times, heavy = import_times(module)
+    assert heavy == []
+    assert not set(times) & {name.split('.')[0] for name in HEAVY_PACKAGES if name != 'matplotlib.pyplot'}
@@ -0,0 +1,55 @@
+import json
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from utils.log_preprocessing import (LogPreprocessingDetails, SQLiteLogStore, migrate_json_to_sqlite,
+                                     query_log)
+
+
+def log_recording(db_path, subject, n_keys):
+    log = LogPreprocessingDetails(db_path, subject, 'baseline', '1')
+    for n in range(n_keys):
+        log.log_detail(f'key_{n}', n)
+    log.save_preprocessing_details()
+
+
+def test_sqlite_upsert(tmp_path):
+    db_path = str(tmp_path / 'log.db')
+    log = LogPreprocessingDetails(db_path, '022', 'baseline', '1')
+    log.log_detail('bad_channels', ['T8'])
+    log.log_detail('ica_components', np.array([0, 3]))
+    # written as soon as logged, the last value of a key replaces the previous one
+    log.log_detail('bad_channels', ['T8', 'P4'])
+    assert LogPreprocessingDetails(db_path, '022', 'baseline', '1').get_log() == \
+        {'bad_channels': ['T8', 'P4'], 'ica_components': [0, 3]}
+    # only the details of the recording are read
+    assert LogPreprocessingDetails(db_path, '023', 'baseline', '1').get_log() == {}
+    assert query_log(db_path, 'bad_channels') == {('022', 'baseline', '1'): ['T8', 'P4']}
+
+
+def test_sqlite_concurrent_writers(tmp_path):
+    db_path = str(tmp_path / 'log.db')
+    SQLiteLogStore(db_path).close()
+    with ProcessPoolExecutor(max_workers=4) as executor:
+        list(executor.map(log_recording, [db_path] * 8, [f'{n:03d}' for n in range(8)], [20] * 8))
+    logs = SQLiteLogStore(db_path).to_dict()
+    assert sorted(logs) == [f'{n:03d}' for n in range(8)]
+    assert all(logs[subject]['baseline']['1'] == {f'key_{n}': n for n in range(20)} for subject in logs)
+
+
+def test_migrate_json_to_sqlite(tmp_path):
+    json_path, db_path = str(tmp_path / 'log.json'), str(tmp_path / 'log.db')
+    for subject, session in [('022', 'baseline'), ('022', 'ketamine'), ('023', 'baseline')]:
+        log = LogPreprocessingDetails(json_path, subject, session, '1')
+        log.log_detail('n_epochs', len(subject + session))
+        log.log_detail('details', {'hpass': 1.0, 'bads': ['Fp1']})
+        log.save_preprocessing_details()
+
+    assert migrate_json_to_sqlite(json_path, db_path) == 3
+    with open(json_path, 'r') as f:
+        assert SQLiteLogStore(db_path).to_dict() == json.load(f)
+    assert query_log(db_path, 'n_epochs') == query_log(json_path, 'n_epochs')
+    # migrating again replaces the details, it does not duplicate them
+    assert migrate_json_to_sqlite(json_path, db_path) == 3
+    assert len(query_log(db_path, 'details')) == 3
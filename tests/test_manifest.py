@@ -0,0 +1,81 @@
+import os
+
+import pytest
+
+from utils.manifest import Manifest, STAGES, output_files, plan_recording, raw_fingerprint
+from utils.pipeline import get_output_prefix, get_raw_file, get_save_folder
+
+
+@pytest.fixture
+def recorded(tmp_path):
+    # A recording recorded in the manifest as done, with its outputs
+    root = str(tmp_path)
+    raw_file = get_raw_file(root, 'baseline', '022', '1')
+    os.makedirs(os.path.dirname(raw_file))
+    with open(raw_file, 'wb') as f:
+        f.write(b'raw data')
+    recording = {'condition': 'baseline', 'id': '022', 'week': '1', 'raw_file': raw_file}
+    params = {'report': 'none'}
+    os.makedirs(get_save_folder(root, 'baseline', '022'))
+    for path in output_files(root, 'baseline', '022', '1', params):
+        open(path, 'wb').close()
+    manifest = Manifest(os.path.join(root, 'derivatives', 'manifest.json'))
+    manifest.record(recording, params, root, version='v1')
+    return root, recording, params, manifest
+
+
+def plan(recorded, params=None, version='v1'):
+    root, recording, recorded_params, manifest = recorded
+    entry = Manifest(manifest.path).get('baseline', '022', '1')
+    status, stages, reason, _ = plan_recording(entry, recording, params or recorded_params, root, version)
+    return status, stages
+
+
+def test_new(recorded):
+    root, recording, params, _ = recorded
+    assert plan_recording(None, recording, params, root, 'v1')[:2] == ('new', STAGES)
+
+
+def test_up_to_date(recorded):
+    assert plan(recorded) == ('up_to_date', [])
+    # a new modification time alone does not change the raw file
+    os.utime(recorded[1]['raw_file'], (1e9, 1e9))
+    assert plan(recorded) == ('up_to_date', [])
+
+
+def test_raw_changed(recorded):
+    with open(recorded[1]['raw_file'], 'wb') as f:
+        f.write(b'other data')
+    assert plan(recorded) == ('raw_changed', STAGES)
+
+
+def test_code_changed(recorded):
+    assert plan(recorded, version='v2') == ('code_changed', STAGES)
+
+
+def test_params_changed_from_first_changed_stage(recorded):
+    params = {**recorded[2], 'ica_decim': 2, 'window_bins': 60}
+    assert plan(recorded, params) == ('params_changed', STAGES[STAGES.index('ica'):])
+    assert plan(recorded, {**recorded[2], 'hpass': 0.5}) == ('params_changed', STAGES[STAGES.index('filter'):])
+
+
+def test_manual_changed(recorded):
+    root = recorded[0]
+    with open(os.path.join(get_save_folder(root, 'baseline', '022'), f"{get_output_prefix('022', '1')}-manual.json"),
+              'w') as f:
+        f.write('{}')
+    assert plan(recorded) == ('manual_changed', STAGES[STAGES.index('bad_channels'):])
+
+
+def test_outputs_missing(recorded):
+    root, _, params, _ = recorded
+    os.remove(output_files(root, 'baseline', '022', '1', params)[-1])
+    assert plan(recorded) == ('outputs_missing', STAGES[STAGES.index('windows'):])
+
+
+def test_raw_fingerprint_reuses_hash(recorded):
+    raw_file = recorded[1]['raw_file']
+    fingerprint = raw_fingerprint(raw_file)
+    # same size and modification time: the previous hash is kept without reading the file
+    assert raw_fingerprint(raw_file, {**fingerprint, 'hash': 'previous'})['hash'] == 'previous'
+    assert raw_fingerprint(raw_file, {**fingerprint, 'size': 0, 'hash': 'previous'})['hash'] == fingerprint['hash']
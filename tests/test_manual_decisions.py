@@ -0,0 +1,31 @@
+from utils.manual_decisions import decisions_from_log, replay_ica
+
+
+LOG = {'bad_channels': ['T8'], 'manual_reject_epochs': [3, 4], 'manual_reject_epochs_after_ica': [],
+       'ica_components': [12], 'ica_key': 'bc71'}
+
+
+def test_decisions_from_log_of_interactive_run():
+    # preprocessing.py logs manual_mode from now on, older logs have none
+    for saved in [LOG, {**LOG, 'manual_mode': 'interactive'}]:
+        decisions = decisions_from_log(saved)
+        assert decisions == {'bad_channels': {'channels': ['T8']}, 'manual_reject_epochs': {'indices': [3, 4]},
+                             'ica_components': {'exclude': [12], 'ica_key': 'bc71'}}
+
+
+def test_decisions_from_log_of_automatic_run_are_not_replayed():
+    assert decisions_from_log({**LOG, 'manual_mode': 'skip', 'manual_replayed': []}) == {}
+    assert decisions_from_log({**LOG, 'manual_mode': 'replay', 'manual_replayed': []}) == {}
+    # a replay run logs the decisions it re-applied as they were, they are still the ones taken by hand
+    decisions = decisions_from_log({**LOG, 'manual_mode': 'replay', 'manual_replayed': ['bad_channels']})
+    assert decisions == {'bad_channels': {'channels': ['T8']}}
+
+
+def test_replay_ica_of_log_is_stale_after_refit():
+    decisions = decisions_from_log(LOG)
+    assert replay_ica(decisions, None, 'bc71') == ([12], None)
+    exclude, stale = replay_ica(decisions, None, 'd63e')
+    assert exclude is None
+    assert 'bc71 -> d63e' in stale
+    # without an ica_key (logs of preprocessing.py) the indices cannot be checked and are applied
+    assert replay_ica(decisions_from_log({'ica_components': [1]}), None, 'd63e') == ([1], None)
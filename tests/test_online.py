@@ -0,0 +1,112 @@
+import numpy as np
+
+import mne
+import pytest
+
+from benchmarks.synthetic_akonic import simulate_recording, write_edf
+from utils.online import EpochsWriter, OnlinePreprocessor
+from utils.pipeline import filter_raw, make_epochs, read_raw
+
+BADS = ['T8', 'P4']
+
+
+@pytest.fixture(scope='module')
+def raw(tmp_path_factory):
+    signals, eeg = simulate_recording(60, seed=0)
+    return read_raw(write_edf(str(tmp_path_factory.mktemp('raw') / '001_1.EDF'), signals, eeg))
+
+
+@pytest.fixture(scope='module')
+def model(raw):
+    # a frozen model that never rejects nor interpolates an epoch: the epochs are only filtered and cleaned
+    raw_filtered = filter_raw(raw, 1, 45)
+    raw_filtered.info['bads'] = BADS
+    ica = mne.preprocessing.ICA(n_components=8, method='infomax', random_state=0)
+    ica.fit(raw_filtered, picks='eeg', verbose=False)
+    ica.exclude = [0, 1]
+    eeg = mne.pick_types(raw.info, eeg=True)
+    return {
+        'autoreject': {'thresholds': {raw.ch_names[idx]: 1. for idx in eeg}, 'consensus': {'eeg': 1.},
+                       'n_interpolate': {'eeg': 1}},
+        'ica': ica, 'bads': BADS, 'hpass': 1, 'lpass': 45, 'duration_epochs': 2., 'source': '001_1',
+    }
+
+
+def clean_offline(inst, model):
+    # ICA, interpolation of the bad channels and average reference of the pipeline
+    inst = model['ica'].apply(inst.copy(), verbose=False)
+    inst.info['bads'] = list(model['bads'])
+    inst.interpolate_bads(reset_bads=True, verbose=False)
+    return mne.set_eeg_reference(inst, 'average', copy=False, verbose=False)[0]
+
+
+def push(online, data, sizes):
+    epochs, start = [], 0
+    for size in sizes:
+        epochs += online.push(data[:, start:start + size])
+        start += size
+    return epochs + online.push(data[:, start:])
+
+
+def make_epoch(n, info):
+    return {'onset': 2. * n, 'data': np.full((len(info['ch_names']), 512), n * 1e-6)}
+
+
+def test_epochs_writer_parts(tmp_path):
+    info = mne.create_info(['Cz', 'Pz', 'Fz'], 256., 'eeg')
+    writer = EpochsWriter(str(tmp_path / 'live-epo.fif'), info, max_epochs=4)
+    for n in range(10):
+        writer.add(make_epoch(n, info))
+        # only the epochs of the part being filled are in memory
+        assert len(writer._epochs) < 4
+    files = writer.close()
+    assert [path.split('/')[-1] for path in files] == ['live-001-epo.fif', 'live-002-epo.fif', 'live-003-epo.fif']
+    parts = [mne.read_epochs(path, verbose=False) for path in files]
+    # the events are at the onsets of the epochs in the stream
+    np.testing.assert_array_equal(np.concatenate([part.events[:, 0] for part in parts]), np.arange(10) * 512)
+    np.testing.assert_allclose(np.concatenate([part.get_data()[:, 0, 0] for part in parts]), np.arange(10) * 1e-6,
+                               rtol=1e-6)
+
+
+def test_epochs_writer_without_epochs(tmp_path):
+    info = mne.create_info(['Cz'], 256., 'eeg')
+    assert EpochsWriter(str(tmp_path / 'live-epo.fif'), info).close() == []
+    with pytest.raises(ValueError):
+        EpochsWriter(str(tmp_path / 'live-epo.fif'), info, max_epochs=0)
+
+
+def test_chunk_sizes(raw, model):
+    data = raw.get_data()
+    expected = OnlinePreprocessor(raw.info, model).push(data)
+    rng = np.random.default_rng(0)
+    epochs = push(OnlinePreprocessor(raw.info, model), data, rng.integers(1, 700, 40))
+    assert [epoch['onset'] for epoch in epochs] == [epoch['onset'] for epoch in expected]
+    for epoch, expected_epoch in zip(epochs, expected):
+        np.testing.assert_allclose(epoch['data'], expected_epoch['data'], rtol=0, atol=1e-12)
+        for key in ['settling', 'rejected', 'interpolated']:
+            assert epoch['flags'][key] == expected_epoch['flags'][key]
+
+
+def test_fir_epochs_equal_offline_epochs(raw, model):
+    online = OnlinePreprocessor(raw.info, model)
+    epochs = online.push(raw.get_data())
+    expected = clean_offline(make_epochs(filter_raw(raw, 1, 45), 2.), model)
+    # the online epochs end delay samples before the end of the stream
+    n_epochs = (raw.n_times - online.filter.delay) // 512
+    assert len(epochs) == n_epochs
+    np.testing.assert_array_equal([epoch['onset'] * 256 for epoch in epochs], expected.events[:n_epochs, 0])
+    settling = [epoch['flags']['settling'] for epoch in epochs]
+    # the filter reaches back delay samples before the onset of an epoch
+    assert settling == [n * 512 < online.filter.delay for n in range(n_epochs)]
+    assert not any(epoch['flags']['rejected'] or epoch['flags']['interpolated'] for epoch in epochs)
+    # the settled epochs only depend on samples of the stream, as the offline ones
+    settled = [n for n in range(n_epochs) if not settling[n]]
+    np.testing.assert_allclose(np.stack([epochs[n]['data'] for n in settled]), expected.get_data()[settled],
+                               rtol=0, atol=1e-10)
+
+
+def test_linear_map(raw, model):
+    online = OnlinePreprocessor(raw.info, model)
+    data = np.random.default_rng(0).normal(scale=1e-5, size=(len(raw.ch_names), 256))
+    expected = clean_offline(mne.io.RawArray(data, raw.info, verbose=False), model)
+    np.testing.assert_allclose(online.W @ data + online.c, expected.get_data(), rtol=0, atol=1e-12)
@@ -0,0 +1,54 @@
+import numpy as np
+
+import mne
+import pytest
+
+from utils.pipeline import autoreject_epochs, fit_ica, save_epochs, set_precision
+
+
+@pytest.fixture(scope='module')
+def epochs():
+    ch_names = ['Fp1', 'Fp2', 'F3', 'F4', 'C3', 'C4', 'P3', 'P4', 'O1', 'O2']
+    info = mne.create_info(ch_names, 100., 'eeg')
+    rng = np.random.RandomState(0)
+    # mixed sources, with artifacts in a few epochs
+    data = np.einsum('ij,ejt->eit', rng.randn(10, 10), rng.laplace(size=(30, 10, 100))) * 1e-5
+    data[[3, 11], 2] *= 40
+    data[17] *= 30
+    epochs = mne.EpochsArray(data.astype(np.float32).astype(np.float64), info, verbose=False)
+    epochs.set_montage('standard_1020', verbose=False)
+    return epochs
+
+
+def test_set_precision(epochs):
+    epochs32 = set_precision(epochs.copy(), 'float32')
+    assert epochs32.get_data().dtype == np.float32
+    # the copies and the following steps keep the precision
+    assert epochs32.copy().get_data().dtype == np.float32
+    epochs32.info['bads'] = ['O2']
+    assert epochs32.interpolate_bads(verbose=False).get_data().dtype == np.float32
+    with pytest.raises(ValueError, match='precision must be one of'):
+        set_precision(epochs.copy(), 'float16')
+
+
+def test_autoreject_in_float32(epochs):
+    # AutoReject runs on a float64 copy: the same epochs are rejected and the epochs stay in float32
+    expected = autoreject_epochs(epochs.copy(), 3, 0)[3]['reject_log']
+    epochs32 = set_precision(epochs.copy(), 'float32')
+    _, _, _, details = autoreject_epochs(epochs32, 3, 0)
+    assert details['reject_log'] == expected
+    assert epochs32.get_data().dtype == np.float32
+
+
+def test_ica_in_float32(epochs, tmp_path):
+    ica = fit_ica(epochs.copy(), 5, 'fastica', 'auto', 0)
+    epochs32 = set_precision(epochs.copy(), 'float32')
+    ica32 = fit_ica(epochs32, 5, 'fastica', 'auto', 0)
+    # the same components, up to float32 rounding
+    np.testing.assert_allclose(ica32.get_components(), ica.get_components(), rtol=0, atol=1e-4)
+    ica32.exclude = [0]
+    assert ica32.apply(epochs32, verbose=False).get_data().dtype == np.float32
+
+    save_epochs(epochs32, str(tmp_path / 'clean-epo.fif'))
+    saved = mne.read_epochs(str(tmp_path / 'clean-epo.fif'), verbose=False)
+    np.testing.assert_allclose(saved.get_data(), epochs32.get_data(), rtol=1e-6)
@@ -0,0 +1,83 @@
+import time
+import numpy as np
+
+import pytest
+
+from utils.log_preprocessing import LogPreprocessingDetails
+from utils.profiling import (PROFILE_COLUMNS, StageProfiler, estimate_worker_memory, peak_rss,
+                             summarize_stage_profiles, workers_for_memory)
+
+
+def test_stage_profiles(tmp_path):
+    log = LogPreprocessingDetails(str(tmp_path / 'log.db'), '022', 'baseline', '1')
+    profiler = StageProfiler(log=log.log_detail)
+    with profiler.stage('filter'):
+        time.sleep(0.05)
+    with profiler.stage('epochs'):
+        # about 80 MB held during the stage
+        data = np.ones((10, 1024, 1024))
+        del data
+    with profiler.stage('filter'):
+        time.sleep(0.05)
+
+    assert list(profiler.profiles) == ['filter', 'epochs']
+    # a stage entered twice adds up its times
+    assert profiler.profiles['filter']['wall'] >= 0.1
+    assert profiler.profiles['epochs']['peak_rss_delta'] > 60
+    # logged after every stage
+    assert log.get_log()['stage_profile'] == profiler.profiles
+    assert list(profiler.to_frame().columns) == PROFILE_COLUMNS
+    assert '<th>total</th>' in profiler.to_html()
+
+
+def test_stage_profile_of_a_failed_stage():
+    profiler = StageProfiler()
+    with pytest.raises(RuntimeError):
+        with profiler.stage('ica'):
+            raise RuntimeError('ICA failed')
+    assert profiler.profiles['ica']['wall'] >= 0
+
+
+def test_summarize_stage_profiles(tmp_path):
+    json_path = str(tmp_path / 'log.db')
+    for n, subject in enumerate(['022', '023', '024']):
+        log = LogPreprocessingDetails(json_path, subject, 'baseline', '1')
+        log.log_detail('stage_profile', {
+            'filter': {'wall': 1. + n, 'cpu': 1., 'rss_start': 100., 'peak_rss': 200., 'peak_rss_delta': 100.},
+            'ica': {'wall': 9. + n, 'cpu': 9., 'rss_start': 200., 'peak_rss': 500., 'peak_rss_delta': 300. + n},
+        })
+    summary = summarize_stage_profiles(json_path)
+    assert summary.index.tolist() == ['ica', 'filter']
+    assert summary.loc['ica', 'wall_median'] == 10.
+    assert summary.loc['ica', 'peak_rss_delta_max'] == 302.
+    assert summary.loc['filter', 'n_recordings'] == 3
+    np.testing.assert_allclose(summary['wall_share'].sum(), 1.)
+    assert summarize_stage_profiles(str(tmp_path / 'empty.db')).empty
+
+
+def test_memory_budget():
+    profiler = StageProfiler(max_rss=peak_rss() + 200)
+    with profiler.stage('filter'):
+        pass
+    # the stage is measured before the recording is stopped
+    with pytest.raises(MemoryError, match='The epochs stage used'):
+        with profiler.stage('epochs'):
+            data = np.ones((40, 1024, 1024))
+            del data
+    assert profiler.profiles['epochs']['peak_rss_delta'] > 200
+
+
+def test_workers_for_memory(tmp_path):
+    assert workers_for_memory(8, 1000, memory_limit=3500) == 3
+    assert workers_for_memory(2, 1000, memory_limit=3500) == 2
+    # at least one worker
+    assert workers_for_memory(8, 5000, memory_limit=3500) == 1
+
+    json_path = str(tmp_path / 'log.db')
+    assert estimate_worker_memory(json_path) is None
+    log = LogPreprocessingDetails(json_path, '022', 'baseline', '1')
+    log.log_detail('stage_profile', {
+        'filter': {'wall': 1., 'cpu': 1., 'rss_start': 100., 'peak_rss': 800., 'peak_rss_delta': 700.},
+        'ica': {'wall': 9., 'cpu': 9., 'rss_start': 200., 'peak_rss': 1000., 'peak_rss_delta': 800.},
+    })
+    assert estimate_worker_memory(json_path, margin=1.5) == 1500.
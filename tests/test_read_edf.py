@@ -0,0 +1,89 @@
+import shutil
+import numpy as np
+
+import pytest
+
+import utils.preprocessing_helpers as preprocessing_helpers
+from benchmarks.synthetic_akonic import simulate_recording, write_edf
+from utils.preprocessing_helpers import (AKONIC_LAYOUT, UnsupportedEDF, read_edf_akonic, read_edf_header,
+                                         set_chs_montage)
+
+
+@pytest.fixture(scope='module')
+def edf_file(tmp_path_factory):
+    signals, eeg = simulate_recording(4, seed=0)
+    return write_edf(str(tmp_path_factory.mktemp('raw') / '001_1.EDF'), signals, eeg)
+
+
+def test_read_edf_akonic(edf_file):
+    raw = read_edf_akonic(edf_file, layout=AKONIC_LAYOUT)
+    assert raw.ch_names == AKONIC_LAYOUT.info(AKONIC_LAYOUT.channels, 256).ch_names
+    assert raw.n_times == 4 * 256
+
+
+def test_layout_is_set_chs_montage(edf_file):
+    # the Raw built with the final channels in one step is the one renamed, retyped, dropped and placed
+    raw = read_edf_akonic(edf_file, layout=AKONIC_LAYOUT)
+    expected = set_chs_montage(read_edf_akonic(edf_file, channels=None))
+    assert raw.ch_names == expected.ch_names
+    assert raw.get_channel_types() == expected.get_channel_types()
+    assert raw.info['bads'] == [] and raw.info['line_freq'] == expected.info['line_freq']
+    assert raw.info['meas_date'] == expected.info['meas_date']
+    np.testing.assert_array_equal([ch['loc'] for ch in raw.info['chs']], [ch['loc'] for ch in expected.info['chs']])
+    np.testing.assert_allclose(raw.get_data(), expected.get_data())
+
+
+def test_layout_info_is_built_once(edf_file):
+    info = AKONIC_LAYOUT.info(['EEG Cz-Ref', 'EMG-0'], 256)
+    assert info.ch_names == ['Cz', 'ECG'] and info.get_channel_types() == ['eeg', 'ecg']
+    # every recording gets its own copy of the Info built once
+    info['bads'] = ['Cz']
+    assert AKONIC_LAYOUT.info(['EEG Cz-Ref', 'EMG-0'], 256)['bads'] == []
+    assert len([key for key in AKONIC_LAYOUT._infos if key[0] == ('EEG Cz-Ref', 'EMG-0')]) == 1
+
+
+def test_read_edf_akonic_without_the_channels(edf_file):
+    # a ValueError naming the channels, not an IndexError
+    with pytest.raises(ValueError, match='none of the channels EEG Oz-Ref, EEG POz-Ref'):
+        read_edf_akonic(edf_file, channels=['EEG Oz-Ref', 'EEG POz-Ref'])
+
+
+class FallbackCalled(Exception):
+    pass
+
+
+@pytest.fixture
+def no_fallback(monkeypatch):
+    def read_edf_akonic_mne(path):
+        raise FallbackCalled(path)
+    monkeypatch.setattr(preprocessing_helpers, 'read_edf_akonic_mne', read_edf_akonic_mne)
+
+
+def test_read_edf_akonic_span(edf_file, no_fallback):
+    raw = read_edf_akonic(edf_file, tmin=1., tmax=3.)
+    assert (raw.first_samp, raw.n_times) == (256, 512)
+    # a span without samples is raised, the MNE reader is not tried
+    with pytest.raises(ValueError, match='No samples between') as error:
+        read_edf_akonic(edf_file, tmin=10.)
+    assert not isinstance(error.value, UnsupportedEDF)
+
+
+def test_read_edf_akonic_unsupported(edf_file, tmp_path, no_fallback):
+    # a discontinuous EDF+ and a malformed header are read by the MNE reader
+    discontinuous = str(tmp_path / 'discontinuous.EDF')
+    shutil.copy(edf_file, discontinuous)
+    with open(discontinuous, 'r+b') as f:
+        f.seek(192)
+        f.write(b'EDF+D'.ljust(44))
+    with pytest.raises(FallbackCalled):
+        read_edf_akonic(discontinuous)
+
+    malformed = str(tmp_path / 'malformed.EDF')
+    shutil.copy(edf_file, malformed)
+    with open(malformed, 'r+b') as f:
+        f.seek(236)
+        f.write(b'n/a'.ljust(8))
+    with pytest.raises(UnsupportedEDF, match='Unsupported EDF header'):
+        read_edf_header(malformed)
+    with pytest.raises(FallbackCalled):
+        read_edf_akonic(malformed)
@@ -0,0 +1,87 @@
+import numpy as np
+
+import pytest
+
+import utils.ReadRawAkonic as ReadRawAkonic
+from utils.ReadRawAkonic import CH_NAMES, KEEP_CH_NAMES, N_CHANNELS, SFREQ, read_raw_akonic
+
+HEADER = 'Akonic BIO-PC text export\nSampling rate: 256 Hz\n\n'
+
+
+def make_data(n_times, seed=0):
+    return np.round(np.random.default_rng(seed).normal(scale=50, size=(N_CHANNELS, n_times)), 2)
+
+
+def write_samples(path, data, blank_every=None):
+    # one line per sample, with an empty line every blank_every samples
+    lines = [' '.join(f'{value:.2f}' for value in sample) + '\n' for sample in data.T]
+    if blank_every:
+        lines = [line + ('\n' if n % blank_every == blank_every - 1 else '') for n, line in enumerate(lines)]
+    path.write_text(HEADER + ''.join(lines))
+    return str(path)
+
+
+def write_channels(path, data):
+    # one line per channel, separated by empty lines
+    path.write_text(HEADER + '\n'.join(' '.join(f'{value:.2f}' for value in row) + '\n' for row in data))
+    return str(path)
+
+
+@pytest.mark.parametrize('tmin, tmax', [(None, None), (1., 3.), (2.5, None)])
+def test_sample_lines(tmp_path, monkeypatch, tmin, tmax):
+    # blocks of a few lines: the empty lines of the blocks before tmin are not counted as samples
+    monkeypatch.setattr(ReadRawAkonic, 'CHUNK_BYTES', 4096)
+    data = make_data(4 * SFREQ)
+    path = write_samples(tmp_path / 'rec.txt', data, blank_every=7)
+    raw = read_raw_akonic(path, channels=KEEP_CH_NAMES, tmin=tmin, tmax=tmax).raw
+    start = int(tmin * SFREQ) if tmin is not None else 0
+    stop = int(tmax * SFREQ) if tmax is not None else None
+    assert raw.ch_names == KEEP_CH_NAMES
+    assert raw.first_samp == start
+    np.testing.assert_array_equal(raw.get_data(), data[:len(KEEP_CH_NAMES), start:stop])
+
+
+def test_sample_lines_estimate_grows(tmp_path, monkeypatch):
+    # the first block has longer lines than the rest of the file: the estimated number of samples is short
+    monkeypatch.setattr(ReadRawAkonic, 'CHUNK_BYTES', 4096)
+    data = make_data(3 * SFREQ)
+    data[:, 2 * SFREQ:] = data[:, :SFREQ] = -1234.56
+    data[:, SFREQ:2 * SFREQ] = 0
+    path = write_samples(tmp_path / 'rec.txt', data)
+    np.testing.assert_array_equal(read_raw_akonic(path).raw.get_data(), data)
+
+
+def test_channel_lines(tmp_path):
+    data = make_data(2 * SFREQ)
+    path = write_channels(tmp_path / 'rec.txt', data)
+    raw = read_raw_akonic(path, channels=['F3', 'Cz', 'EKG'], tmin=0.5, tmax=1.5).raw
+    assert raw.ch_names == ['F3', 'Cz', 'EKG']
+    picks = [CH_NAMES.index(ch) for ch in raw.ch_names]
+    np.testing.assert_array_equal(raw.get_data(), data[picks, SFREQ // 2:3 * SFREQ // 2])
+    # the text has fewer channels than the ones asked for
+    path = write_channels(tmp_path / 'short.txt', data[:20])
+    with pytest.raises(ValueError, match='Expected 22 channels, but got 20'):
+        read_raw_akonic(path, channels=KEEP_CH_NAMES)
+
+
+def test_find_header(tmp_path):
+    path = write_samples(tmp_path / 'rec.txt', make_data(10))
+    reader = read_raw_akonic(path)
+    assert reader.find_header() == (len(HEADER), N_CHANNELS)
+    path = tmp_path / 'empty.txt'
+    path.write_text(HEADER)
+    with pytest.raises(ValueError, match='No numeric data'):
+        read_raw_akonic(str(path))
+
+
+def test_sidecar(tmp_path, monkeypatch):
+    data = make_data(2 * SFREQ)
+    path = write_samples(tmp_path / 'rec.txt', data)
+    raw = read_raw_akonic(path, sidecar=True, channels=KEEP_CH_NAMES, tmin=1.).raw
+    np.testing.assert_array_equal(np.load(f'{path}.npy'), data)
+    np.testing.assert_array_equal(raw.get_data(), data[:len(KEEP_CH_NAMES), SFREQ:])
+
+    # the following reads do not parse the text
+    monkeypatch.setattr(read_raw_akonic, 'parse_text', lambda *args: pytest.fail('the text was parsed'))
+    raw = read_raw_akonic(path, sidecar=True, channels=['Cz'], tmax=1.).raw
+    np.testing.assert_array_equal(raw.get_data(), data[[CH_NAMES.index('Cz')], :SFREQ])
@@ -0,0 +1,71 @@
+import json
+import os
+
+import mne
+import pytest
+
+import run_preprocessing
+from run_preprocessing import run_batch
+from utils.reporting import PreprocessingReport, wait_for_reports
+
+
+def failing_section(report):
+    raise RuntimeError('render failed')
+
+
+def test_deferred_report_is_moved_in_place(tmp_path, monkeypatch):
+    path = str(tmp_path / '022_1-report.html')
+    report = PreprocessingReport('022', level='light', deferred=True)
+    report.add_html('<p>profile</p>', 'Timing')
+    # the full sections are not recorded in a light report
+    report.add_raw(mne.io.RawArray([[0.] * 10], mne.create_info(['Cz'], 10., 'eeg'), verbose=False), 'Raw')
+    assert len(report.sections) == 1
+
+    report_save = mne.Report.save
+    seen = []
+
+    def save(self, fname, **kwargs):
+        # the report is written next to its path, not at it
+        report_save(self, fname, **kwargs)
+        seen.append((fname, os.path.exists(path)))
+    monkeypatch.setattr(mne.Report, 'save', save)
+    report.save(path).result()
+    assert [exists for _, exists in seen] == [False]
+    assert os.listdir(tmp_path) == ['022_1-report.html']
+    assert 'profile' in open(path).read()
+
+
+def test_failed_report_leaves_nothing(tmp_path, monkeypatch):
+    def save(self, fname, **kwargs):
+        # half written
+        open(fname, 'w').close()
+        raise OSError('disk full')
+    monkeypatch.setattr(mne.Report, 'save', save)
+    report = PreprocessingReport('022', level='light', deferred=True)
+    report.add_html('<p>profile</p>', 'Timing')
+    with pytest.raises(OSError):
+        report.save(str(tmp_path / '022_1-report.html')).result()
+    assert os.listdir(tmp_path) == []
+
+
+def test_run_batch_waits_for_the_reports(tmp_path, monkeypatch):
+    # a recording with a deferred report is only done once its report is written
+    def run_one(recording, params, manual, root_path, json_path, n_jobs_subject, cache, raw_hash=None):
+        report = PreprocessingReport(recording['id'], level='light', deferred=True)
+        report.add_html('<p>epochs</p>', 'Epochs')
+        if recording['id'] == '023':
+            report._add(failing_section)
+        report_file = str(tmp_path / f"{recording['id']}_1-report.html")
+        report.save(report_file)
+        return recording, {'report_deferred': True, 'report_file': report_file}, None
+    monkeypatch.setattr(run_preprocessing, '_run_one', run_one)
+
+    recordings = [{'raw_file': f'{id}_1.EDF', 'id': id, 'week': '1', 'condition': 'baseline'}
+                  for id in ['022', '023']]
+    json_path = str(tmp_path / 'log.json')
+    failed = run_batch(recordings, manual='skip', root_path=str(tmp_path), json_path=json_path, n_workers=1)
+    wait_for_reports()
+    assert [recording['id'] for recording in failed] == ['023']
+    with open(json_path) as f:
+        assert list(json.load(f)) == ['022']
+    assert not os.path.exists(tmp_path / '023_1-report.html')
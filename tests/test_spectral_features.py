@@ -0,0 +1,69 @@
+import os
+import numpy as np
+
+import mne
+import pandas as pd
+import pytest
+
+from utils.spectral_features import (BANDS, band_powers, compute_psd, fit_aperiodic, get_spectral_file,
+                                     read_spectral_features, spectral_features, write_spectral_features)
+
+
+@pytest.fixture(scope='module')
+def epochs():
+    info = mne.create_info(['Cz', 'Pz', 'ECG'], 256., ['eeg', 'eeg', 'ecg'])
+    rng = np.random.RandomState(0)
+    times = np.arange(512) / 256.
+    data = rng.randn(6, 3, 512) * 1e-6
+    # a 10 Hz rhythm on Pz
+    data[:, 1] += 10e-6 * np.sin(2 * np.pi * 10 * times)
+    events = np.column_stack([np.arange(6) * 512, np.zeros(6, int), np.ones(6, int)])
+    return mne.EpochsArray(data, info, events, verbose=False)
+
+
+def test_compute_psd_welch(epochs):
+    psds, freqs, ch_names = compute_psd(epochs)
+    spectrum = epochs.compute_psd(method='welch', n_fft=len(epochs.times), fmin=1, fmax=45, picks='eeg',
+                                  verbose=False)
+    assert ch_names == ['Cz', 'Pz']
+    np.testing.assert_allclose(freqs, spectrum.freqs)
+    np.testing.assert_allclose(psds, spectrum.get_data(), rtol=1e-10)
+
+
+def test_band_powers(epochs):
+    # a flat spectrum has relative powers proportional to the width of the bands
+    freqs = np.arange(1, 45.5, 0.5)
+    powers = band_powers(np.ones((2, len(freqs))), freqs)
+    for band, (fmin, fmax) in BANDS.items():
+        np.testing.assert_allclose(powers[band], fmax - fmin)
+        np.testing.assert_allclose(powers[f'{band}_rel'], (fmax - fmin) / 44)
+    psds, freqs, _ = compute_psd(epochs)
+    powers = band_powers(psds, freqs)
+    assert (powers['alpha_rel'][:, 1] > 0.9).all() and (powers['alpha_rel'][:, 0] < 0.3).all()
+
+
+def test_fit_aperiodic():
+    freqs = np.arange(0, 46.)
+    exponents = np.array([[1., 1.5], [2., 0.5]])
+    psds = 10 ** (-11 - exponents[..., None] * np.log10(np.maximum(freqs, 1)))
+    offset, exponent = fit_aperiodic(psds, freqs)
+    np.testing.assert_allclose(offset, -11)
+    np.testing.assert_allclose(exponent, exponents)
+
+
+def test_parquet_round_trip(epochs, tmp_path):
+    windows = {'baseline': (0, 4), 'dosis': (4, 12)}
+    table = spectral_features(epochs, windows, '022', 1, 'baseline', bins={'0-4': (0, 4)}, store_psd=True)
+    assert len(table) == 6 * 2
+    assert table[table['window'] == 'baseline']['bin'].tolist() == ['0-4'] * 4
+    save_folder = tmp_path / 'derivatives' / 'baseline' / '022'
+    os.makedirs(save_folder)
+    write_spectral_features(table, get_spectral_file(str(save_folder), '022_1'))
+
+    pd.testing.assert_frame_equal(read_spectral_features(str(tmp_path)), table)
+    features = read_spectral_features(str(tmp_path), columns=['alpha_rel'], filters=[('window', '=', 'dosis')])
+    assert list(features.columns) == ['subject', 'week', 'condition', 'window', 'bin', 'epoch', 'onset', 'channel',
+                                      'alpha_rel']
+    expected = table[table['window'] == 'dosis'][features.columns].reset_index(drop=True)
+    pd.testing.assert_frame_equal(features, expected)
+    assert read_spectral_features(str(tmp_path / 'empty')).empty
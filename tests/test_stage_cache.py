@@ -0,0 +1,113 @@
+import json
+import os
+import shutil
+
+import pytest
+
+import utils.stage_cache as stage_cache
+from utils.stage_cache import StageCache, hash_file
+
+
+def write_json(folder, result):
+    with open(os.path.join(folder, 'result.json'), 'w') as f:
+        json.dump(result, f)
+
+
+def read_json(folder):
+    with open(os.path.join(folder, 'result.json'), 'r') as f:
+        return json.load(f)
+
+
+def save(cache, id, stage, key, size):
+    cache.save('baseline', id, '1', stage, key, lambda folder, result: write_json(folder, result), 'x' * size)
+
+
+def test_cached_computes_once(tmp_path):
+    cache = StageCache(str(tmp_path))
+    calls = []
+    compute = lambda: calls.append(1) or {'value': len(calls)}
+    for _ in range(2):
+        assert cache.cached('baseline', '022', '1', 'epochs', 'a', compute, write_json, read_json) == {'value': 1}
+    assert len(calls) == 1
+    # another key of the same stage replaces the entry
+    assert cache.cached('baseline', '022', '1', 'epochs', 'b', compute, write_json, read_json) == {'value': 2}
+    assert os.listdir(cache.get_cache_folder('baseline', '022', '1')) == ['epochs-b']
+
+
+def test_invalidate(tmp_path):
+    cache = StageCache(str(tmp_path))
+    for stage in ['epochs', 'ica']:
+        save(cache, '022', stage, 'a', 10)
+    cache.invalidate('baseline', '022', stage='ica')
+    assert cache.load('baseline', '022', '1', 'ica', 'a', read_json) is None
+    assert cache.load('baseline', '022', '1', 'epochs', 'a', read_json) == 'x' * 10
+    cache.invalidate('baseline', '022')
+    assert cache.list_entries() == []
+    # nothing to remove
+    cache.invalidate('baseline', '023', '1', 'ica')
+
+
+def test_evict_least_recently_used(tmp_path):
+    cache = StageCache(str(tmp_path))
+    for n, id in enumerate(['001', '002', '003']):
+        save(cache, id, 'epochs', 'a', 1000)
+        entry_folder = cache.get_entry_folder('baseline', id, '1', 'epochs', 'a')
+        os.utime(entry_folder, (n, n))
+    # reading 001 makes it the most recently used
+    assert cache.load('baseline', '001', '1', 'epochs', 'a', read_json) is not None
+    evicted = cache.evict(2500)
+    assert [folder.split(os.sep)[-4] for folder in evicted] == ['002']
+    assert sorted(folder.split(os.sep)[-4] for _, _, folder in cache.list_entries()) == ['001', '003']
+
+
+def test_save_evicts_above_max_size(tmp_path):
+    cache = StageCache(str(tmp_path), max_size=1500)
+    save(cache, '001', 'epochs', 'a', 1000)
+    os.utime(cache.get_entry_folder('baseline', '001', '1', 'epochs', 'a'), (0, 0))
+    save(cache, '002', 'epochs', 'a', 1000)
+    assert [folder.split(os.sep)[-4] for _, _, folder in cache.list_entries()] == ['002']
+
+
+def test_entry_removed_while_read_is_a_miss(tmp_path):
+    cache = StageCache(str(tmp_path))
+    save(cache, '022', 'epochs', 'a', 10)
+
+    def reader(folder):
+        # another process removes the entry between the check and the read
+        shutil.rmtree(folder)
+        return read_json(folder)
+    assert cache.load('baseline', '022', '1', 'epochs', 'a', reader) is None
+    assert cache.cached('baseline', '022', '1', 'epochs', 'a', lambda: 'y', write_json, reader) == 'y'
+
+
+def test_list_entries_skips_removed_entries(tmp_path, monkeypatch):
+    cache = StageCache(str(tmp_path))
+    for id in ['001', '002']:
+        save(cache, id, 'epochs', 'a', 10)
+    removed = cache.get_entry_folder('baseline', '001', '1', 'epochs', 'a')
+    getmtime = os.path.getmtime
+
+    def removing_getmtime(path):
+        # the entry is invalidated by another worker during the walk
+        if path == removed:
+            shutil.rmtree(path)
+        return getmtime(path)
+    monkeypatch.setattr(os.path, 'getmtime', removing_getmtime)
+    assert [folder for _, _, folder in cache.list_entries()] == \
+        [cache.get_entry_folder('baseline', '002', '1', 'epochs', 'a')]
+
+
+def test_file_key_is_kept_on_disk(tmp_path, monkeypatch):
+    raw_file = tmp_path / 'raw.EDF'
+    raw_file.write_bytes(b'a' * 100)
+    key = StageCache(str(tmp_path)).file_key(str(raw_file))
+    assert key == hash_file(str(raw_file))
+    # another process (a new cache) does not read the file again
+    monkeypatch.setattr(stage_cache, 'hash_file', lambda path: pytest.fail('hashed again'))
+    assert StageCache(str(tmp_path)).file_key(str(raw_file)) == key
+    # a modified file is hashed again
+    monkeypatch.undo()
+    raw_file.write_bytes(b'b' * 101)
+    assert StageCache(str(tmp_path)).file_key(str(raw_file)) == hash_file(str(raw_file)) != key
+    with open(tmp_path / 'derivatives' / stage_cache.RAW_HASHES) as f:
+        assert json.load(f)[str(raw_file)]['size'] == 101
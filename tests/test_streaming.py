@@ -0,0 +1,50 @@
+import numpy as np
+
+import pytest
+
+from benchmarks.synthetic_akonic import simulate_recording, write_edf
+from utils.pipeline import filter_raw, make_epochs, read_raw, stream_epochs
+from utils.streaming import edf_source, filter_epochs_streaming
+
+
+@pytest.fixture(scope='module')
+def edf_file(tmp_path_factory):
+    signals, eeg = simulate_recording(60, seed=0)
+    return write_edf(str(tmp_path_factory.mktemp('raw') / '001_1.EDF'), signals, eeg)
+
+
+def offline_epochs(edf_file, tmin=None, tmax=None):
+    return make_epochs(filter_raw(read_raw(edf_file, tmin, tmax), 1, 45), 2.)
+
+
+def assert_same_epochs(epochs, expected):
+    np.testing.assert_array_equal(epochs.events, expected.events)
+    assert epochs.ch_names == expected.ch_names
+    assert (epochs.info['highpass'], epochs.info['lowpass']) == (expected.info['highpass'], expected.info['lowpass'])
+    # up to float rounding (the recording is in the order of 1e-4 V)
+    np.testing.assert_allclose(epochs.get_data(), expected.get_data(), rtol=0, atol=1e-12)
+
+
+@pytest.mark.parametrize('tmin, tmax', [(None, None), (5., 41.)])
+def test_stream_epochs(edf_file, tmin, tmax):
+    expected = offline_epochs(edf_file, tmin, tmax)
+    info = read_raw(edf_file, tmin, tmax).info
+    assert_same_epochs(stream_epochs(edf_file, info, 1, 45, 2., tmin, tmax), expected)
+
+
+def test_stream_epochs_memmap(edf_file, tmp_path):
+    expected = offline_epochs(edf_file)
+    buffer_file = str(tmp_path / 'epochs-buffer.npy')
+    epochs = stream_epochs(edf_file, read_raw(edf_file).info, 1, 45, 2., buffer_file=buffer_file)
+    assert_same_epochs(epochs, expected)
+    # the epochs were written in the buffer
+    np.testing.assert_allclose(np.load(buffer_file), expected.get_data(), rtol=0, atol=1e-12)
+
+
+@pytest.mark.parametrize('chunk_epochs', [1, 4, 7])
+def test_chunks(edf_file, chunk_epochs):
+    # the first and the last chunks use the mirrored ends of the recording, the last one is shorter with 4 and 7
+    expected = offline_epochs(edf_file)
+    info = read_raw(edf_file).info
+    epochs = filter_epochs_streaming(edf_source(edf_file, info), info, 1, 45, 2., chunk_epochs=chunk_epochs)
+    assert_same_epochs(epochs, expected)
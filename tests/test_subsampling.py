@@ -0,0 +1,41 @@
+import numpy as np
+
+import mne
+import pytest
+
+from utils.pipeline import check_ica_decim, fit_ica
+from utils.preprocessing_helpers import subsample_epochs
+
+
+@pytest.fixture
+def epochs():
+    info = mne.create_info(['Cz', 'Pz', 'Fz'], 256., 'eeg')
+    with info._unlock():
+        info['lowpass'] = 45.
+    data = np.random.RandomState(0).randn(20, 3, 512) * 1e-5
+    return mne.EpochsArray(data, info, verbose=False)
+
+
+@pytest.mark.parametrize('fit_epochs, n_epochs', [(None, 20), (1.0, 20), (0.5, 10), (0.01, 1), (5, 5), (5.0, 5),
+                                                   (50, 20)])
+def test_subsample_epochs(epochs, fit_epochs, n_epochs):
+    # a float up to 1 is a fraction of the epochs (1.0 all of them), otherwise a number of epochs
+    assert len(subsample_epochs(epochs, fit_epochs, 42)) == n_epochs
+
+
+def test_subsample_epochs_rejects_non_positive(epochs):
+    with pytest.raises(ValueError):
+        subsample_epochs(epochs, 0, 42)
+
+
+def test_check_ica_decim():
+    for decim in [None, 1, 2]:
+        check_ica_decim(decim, 256., 45.)
+    for decim in [3, 1.5, 0]:
+        with pytest.raises(ValueError, match='ica_decim'):
+            check_ica_decim(decim, 256., 45.)
+
+
+def test_fit_ica_rejects_aliasing_decim(epochs):
+    with pytest.raises(ValueError, match='2.84'):
+        fit_ica(epochs, 2, 'fastica', 10, 42, decim=4)
@@ -0,0 +1,41 @@
+import numpy as np
+
+import mne
+import pytest
+
+from utils.pipeline import get_bins, onset_indices, select_bins, window_indices
+
+
+def test_onset_indices():
+    # 2 s epochs from 0 to 20 s with the one at 6 s dropped
+    onsets = np.array([0, 2, 4, 8, 10, 12, 14, 16, 18], dtype=float)
+    indices = onset_indices(onsets, {'baseline': (0, 6), 'dosis': (6, 14), 'after': (30, 40)})
+    assert indices == {'baseline': (0, 3), 'dosis': (3, 6), 'after': (9, 9)}
+
+
+def test_onset_indices_bounds():
+    # an epoch is in the window when tmin <= onset < tmax
+    onsets = np.array([0., 2., 4.])
+    assert onset_indices(onsets, {'a': (2, 4), 'b': (1.9, 4.1)}) == {'a': (1, 2), 'b': (1, 3)}
+
+
+def test_onset_indices_unsorted():
+    with pytest.raises(ValueError, match='sorted'):
+        onset_indices(np.array([0., 4., 2.]), {'a': (0, 10)})
+
+
+def test_get_bins():
+    assert get_bins({'dosis': (700, 850)}, 60) == {'dosis-00': (700., 760.), 'dosis-01': (760., 820.),
+                                                    'dosis-02': (820., 850.)}
+    assert get_bins({'baseline': (0, 60), 'dosis': (100, 160)}, 60, ['dosis']) == {'dosis-00': (100., 160.)}
+
+
+def test_select_bins():
+    info = mne.create_info(['Cz'], 10., 'eeg')
+    events = np.column_stack([np.arange(0, 200, 20), np.zeros(10, int), np.ones(10, int)])
+    epochs = mne.EpochsArray(np.zeros((10, 1, 20)), info, events, verbose=False)
+    assert window_indices(epochs, {'a': (4, 10)}) == {'a': (2, 5)}
+    bins = select_bins(epochs, get_bins({'a': (4, 10)}, 4))
+    assert bins.metadata['window'].tolist() == ['a-00', 'a-00', 'a-01']
+    with pytest.raises(ValueError, match='overlap'):
+        select_bins(epochs, {'x': (0, 6), 'y': (4, 10)})
@@ -1,9 +1,38 @@
+import os
+import warnings
 import numpy as np
 import mne
-from io import StringIO
+
+from utils.preprocessing_helpers import merge_windows
+
+# Size of the blocks of text parsed at once
+CHUNK_BYTES = 16 * 1024 ** 2
+N_CHANNELS = 32
+SFREQ = 256  # Sampling frequency
+
+# Channel names of the text export
+CH_NAMES = [
+    'Fp1', 'F3', 'C3', 'P3', 'O1', 'F7', 'T3', 'T5', 'A1',
+    'Fp2', 'F4', 'C4', 'P4', 'O2', 'F8', 'T4', 'T6', 'A2',
+    'Fpz', 'Fz', 'Cz',
+    'EKG', 'AF', 'TOR', 'ABD', 'MIC', 'EMG1', 'EMG2', 'EMG3', 'EMG4', 'EXT1', 'EXT2'
+]
+# EEG + ECG channels, the only ones used by the preprocessing
+KEEP_CH_NAMES = CH_NAMES[:22]
+
 class read_raw_akonic:
-    def __init__(self, eeg_path):
+    def __init__(self, eeg_path, sidecar=False, channels=None, tmin=None, tmax=None):
+        # sidecar: save the parsed data to <eeg_path>.npy on the first read,
+        # the following reads memory map it instead of parsing the text again
+        # channels: names of the channels to keep (e.g. KEEP_CH_NAMES), None for all
+        # tmin, tmax: part of the recording to read in seconds, the Raw keeps
+        # the time of the recording (first_samp is the first sample read)
         self.eeg_path = eeg_path
+        self.sidecar = sidecar
+        self.picks = list(range(N_CHANNELS)) if channels is None else \
+            [i for i, ch in enumerate(CH_NAMES) if ch in channels]
+        self.start = int(round(tmin * SFREQ)) if tmin is not None else 0
+        self.stop = int(round(tmax * SFREQ)) if tmax is not None else None
         self.raw = self._read_raw_akonic()
 
     def _read_raw_akonic(self):
@@ -11,26 +40,20 @@ class read_raw_akonic:
         data = self.load_data()
         
         # Check if the number of channels matches the expected number (32 channels)
-        if data.shape[0] != 32:  # Assuming the first dimension is the number of channels
-            raise ValueError(f"Expected 32 channels, but got {data.shape[0]}")
+        if data.shape[0] != len(self.picks):  # Assuming the first dimension is the number of channels
+            raise ValueError(f"Expected {len(self.picks)} channels, but got {data.shape[0]}")
 
         # Define the channel types - you'll need to adjust this based on your data
-        ch_types = ['eeg'] * 32
+        ch_types = ['eeg'] * len(self.picks)
 
         # Define the channel names
-        ch_names = [
-            'Fp1', 'F3', 'C3', 'P3', 'O1', 'F7', 'T3', 'T5', 'A1',
-            'Fp2', 'F4', 'C4', 'P4', 'O2', 'F8', 'T4', 'T6', 'A2',
-            'Fpz', 'Fz', 'Cz',
-            'EKG', 'AF', 'TOR', 'ABD', 'MIC', 'EMG1', 'EMG2', 'EMG3', 'EMG4', 'EXT1', 'EXT2'
-        ]
+        ch_names = [CH_NAMES[pick] for pick in self.picks]
 
         # Create the info structure needed by MNE
-        sfreq = 256  # Sampling frequency
-        info = mne.create_info(ch_names=ch_names, sfreq=sfreq, ch_types=ch_types)
+        info = mne.create_info(ch_names=ch_names, sfreq=SFREQ, ch_types=ch_types)
 
         # Create the MNE RawArray object
-        raw = mne.io.RawArray(data, info)  # Assuming data is already in shape (n_channels, n_times)
+        raw = mne.io.RawArray(data, info, first_samp=self.start)  # Assuming data is already in shape (n_channels, n_times)
 
         return raw
 
@@ -85,13 +108,147 @@ class read_raw_akonic:
         return self.raw
     
     def load_data(self):
-        try:
-            data = np.loadtxt(self.eeg_path)
-            return data
-        except ValueError:
-            cropped_lines = self.remove_first_n_lines(4)
-            data = np.genfromtxt(StringIO(''.join(cropped_lines)))
-            return data
+        sidecar_path = f"{self.eeg_path}.npy"
+        if self.sidecar and os.path.exists(sidecar_path) \
+                and os.path.getmtime(sidecar_path) >= os.path.getmtime(self.eeg_path):
+            # copy-on-write memory map: pages are read when used and MNE can modify the data in place
+            data = np.load(sidecar_path, mmap_mode='c')
+            return self.select(data)
+
+        if not self.sidecar:
+            return self.parse_text(self.picks, self.start, self.stop)
+
+        # the sidecar has every channel and sample
+        data = self.parse_text(list(range(N_CHANNELS)), 0, None)
+        tmp_path = f"{self.eeg_path}.{os.getpid()}.tmp.npy"
+        np.save(tmp_path, data)
+        os.replace(tmp_path, sidecar_path)
+        return self.select(data)
+
+    def select(self, data):
+        # Selected channels and samples of the full array
+        if self.picks == list(range(N_CHANNELS)):
+            return data[:, self.start:self.stop]
+        return data[self.picks, self.start:self.stop]
+
+    def find_header(self):
+        # Number of bytes before the first numeric line and number of values in that line
+        header_bytes = 0
+        with open(self.eeg_path, 'rb') as file:
+            for line in file:
+                values = line.split()
+                try:
+                    [float(value) for value in values]
+                except ValueError:
+                    values = []
+                if values:
+                    return header_bytes, len(values)
+                header_bytes += len(line)
+        raise ValueError(f"No numeric data found in {self.eeg_path}")
+
+    def iter_blocks(self, header_bytes):
+        # Blocks of complete lines of about CHUNK_BYTES, skipping the header
+        with open(self.eeg_path, 'rb') as file:
+            file.seek(header_bytes)
+            rest = b''
+            for chunk in iter(lambda: file.read(CHUNK_BYTES), b''):
+                chunk = rest + chunk
+                end = chunk.rfind(b'\n') + 1
+                rest = chunk[end:]
+                if end:
+                    yield chunk[:end]
+            if rest.strip():
+                yield rest
+
+    @staticmethod
+    def count_lines(block):
+        # Number of lines with values, the empty lines have no sample
+        return sum(1 for line in block.split(b'\n') if line.strip())
+
+    def parse_text(self, picks, start=0, stop=None):
+        header_bytes, n_columns = self.find_header()
+
+        if n_columns != N_CHANNELS:
+            return self.parse_channel_lines(header_bytes, picks, start, stop)
+
+        # One line per sample with the 32 channels as columns, read in one pass:
+        # parse blocks of lines straight into the preallocated (n_channels, n_times) array.
+        # Blocks before start are only counted, not parsed. Without stop the number of
+        # samples is estimated from the size of the file and the array grows if it is short
+        data = np.empty((len(picks), stop - start)) if stop is not None else None
+        size = os.path.getsize(self.eeg_path) - header_bytes
+        n_times = 0
+        n_lines = 0
+        n_bytes = 0
+        for block in self.iter_blocks(header_bytes):
+            if n_lines < start:
+                n_block = self.count_lines(block)
+                if n_lines + n_block <= start:
+                    n_lines += n_block
+                    n_bytes += len(block)
+                    continue
+            values = self.parse_block(block)
+            if values.size % N_CHANNELS:
+                raise ValueError(f"Lines with a number of values different from {N_CHANNELS} in {self.eeg_path}")
+            values = values.reshape(-1, N_CHANNELS)
+            n_block = len(values)
+            if data is None:
+                # lines left from the bytes per line of the block, with a margin of 2 %
+                n_estimate = int(n_block * (size - n_bytes) / len(block) * 1.02) + 1
+                data = np.empty((len(picks), n_estimate - max(start - n_lines, 0)))
+            values = values[max(start - n_lines, 0):stop - n_lines if stop is not None else None, picks]
+            if n_times + len(values) > data.shape[1]:
+                grown = np.empty((len(picks), max(int(data.shape[1] * 1.5), n_times + len(values))))
+                grown[:, :n_times] = data[:, :n_times]
+                data = grown
+            data[:, n_times:n_times + len(values)] = values.T
+            n_times += len(values)
+            n_lines += n_block
+            n_bytes += len(block)
+            if stop is not None and n_lines >= stop:
+                break
+
+        if data is None:
+            return np.empty((len(picks), 0))
+        # the samples of the estimate that were not read (a few %) are not copied away,
+        # which would hold the data twice
+        return data if n_times == data.shape[1] else data[:, :n_times]
+
+    def parse_channel_lines(self, header_bytes, picks, start=0, stop=None):
+        # One line per channel, only the selected lines are parsed, each one into its row
+        # of the (n_channels, n_times) array allocated once the first one is read
+        rows = {pick: n for n, pick in enumerate(picks)}
+        data = None
+        n_rows = 0
+        with open(self.eeg_path, 'rb') as file:
+            file.seek(header_bytes)
+            lines = (line for line in file if line.strip())
+            for n_line, line in enumerate(lines):
+                if n_line not in rows:
+                    continue
+                values = self.parse_block(line)[start:stop]
+                if data is None:
+                    data = np.empty((len(picks), len(values)))
+                elif len(values) != data.shape[1]:
+                    raise ValueError(f"Channels with different numbers of samples in {self.eeg_path}")
+                data[rows[n_line]] = values
+                n_rows += 1
+                if n_rows == len(picks):
+                    break
+        if data is None:
+            return np.empty((0, 0))
+        # fewer lines than channels: the missing ones are reported by _read_raw_akonic
+        return data[:n_rows]
+
+    def parse_block(self, block):
+        # Whitespace separated numbers, parsed in C.
+        # Older numpy versions only warn about non numeric values
+        with warnings.catch_warnings():
+            warnings.simplefilter('error', DeprecationWarning)
+            try:
+                return np.fromstring(block, sep=' ')
+            except (ValueError, DeprecationWarning):
+                raise ValueError(f"Non numeric values found in {self.eeg_path}")
     
     def remove_first_n_lines(self, n, write=False):
         with open(self.eeg_path, 'r', encoding='utf-8') as file:
@@ -102,3 +259,9 @@ class read_raw_akonic:
                 file.writelines(cropped_lines)
         
         return cropped_lines
+
+
+def read_raw_akonic_windows(eeg_path, windows, padding=0, channels=KEEP_CH_NAMES, sidecar=False):
+    # One Raw per (padded, merged) time window of a text export
+    return [read_raw_akonic(eeg_path, sidecar, channels, tmin, tmax).raw
+            for tmin, tmax in merge_windows(windows, padding)]
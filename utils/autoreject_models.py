@@ -0,0 +1,155 @@
+import json
+import os
+import time
+import numpy as np
+
+from utils.preprocessing_helpers import subsample_epochs
+
+
+"""
+Fitted AutoReject models stored next to the derivatives of a recording
+    results/derivatives/<condition>/<id>/<id>_<week>-autoreject.h5
+    results/derivatives/<condition>/<id>/<id>_<week>-autoreject.json
+The JSON file keeps the fitted parameters (consensus, n_interpolate and the
+per-channel thresholds), the global rejection threshold and the channels the
+model was fitted on, so that a model can be found and checked without
+loading it.
+
+A stored model can be reused in two ways:
+    'fixed': the model is applied as is, without fitting. Only possible when
+             the epochs have the same channels and bad channels as the epochs
+             the model was fitted on, otherwise a new model is fitted.
+    'warm': the thresholds are fitted again but the cross-validation runs only
+            on the stored consensus and n_interpolate instead of the full grid.
+'fit' ignores the stored models. In every mode the model can be fitted on a
+random subsample of the epochs and then applied to all of them.
+"""
+
+AUTOREJECT_MODES = ['fit', 'warm', 'fixed']
+
+# Where to look for a stored model: only this recording, also the other weeks of
+# the participant, or also the other participants of the condition
+MODEL_SCOPES = ['recording', 'subject', 'condition']
+
+
+def get_model_files(save_folder, prefix):
+    return (os.path.join(save_folder, f'{prefix}-autoreject.h5'),
+            os.path.join(save_folder, f'{prefix}-autoreject.json'))
+
+
+def get_model_params(ar, epochs, reject):
+    # Parameters of a fitted AutoReject that are needed to reuse it
+    picked = [epochs.ch_names[idx] for idx in ar.picks_]
+    return {
+        'consensus': {ch_type: float(value) for ch_type, value in ar.consensus_.items()},
+        'n_interpolate': {ch_type: int(value) for ch_type, value in ar.n_interpolate_.items()},
+        'thresholds': {ch: float(ar.threshes_[ch]) for ch in picked},
+        'reject': {key: float(value) for key, value in reject.items()},
+        'ch_names': list(epochs.ch_names),
+        'bads': list(epochs.info['bads']),
+    }
+
+
+def save_model(save_folder, prefix, ar, model_params):
+    h5_file, json_file = get_model_files(save_folder, prefix)
+    ar.save(h5_file, overwrite=True)
+    # the JSON file is written last and atomically: a model is only found once it is complete
+    tmp_file = f'{json_file}.{os.getpid()}.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(model_params, f, indent=4)
+    os.replace(tmp_file, json_file)
+
+
+def _read_model(save_folder, prefix):
+    h5_file, json_file = get_model_files(save_folder, prefix)
+    if not (os.path.exists(json_file) and os.path.exists(h5_file)):
+        return None
+    with open(json_file, 'r') as f:
+        model = json.load(f)
+    model['h5_file'] = h5_file
+    model['source'] = prefix
+    return model
+
+
+def find_model(save_folder, prefix, scope='subject'):
+    # First model found among this recording, the other weeks of the participant
+    # (same folder) and the other participants of the condition (sibling folders)
+    if scope not in MODEL_SCOPES:
+        raise ValueError(f"scope must be one of {MODEL_SCOPES}, got {scope}")
+    model = _read_model(save_folder, prefix)
+    if model is not None or scope == 'recording':
+        return model
+
+    suffix = '-autoreject.json'
+    folders = [save_folder]
+    if scope == 'condition':
+        condition_folder = os.path.dirname(save_folder)
+        folders += [os.path.join(condition_folder, name) for name in sorted(os.listdir(condition_folder))
+                    if os.path.join(condition_folder, name) != save_folder]
+    for folder in folders:
+        if not os.path.isdir(folder):
+            continue
+        for filename in sorted(os.listdir(folder)):
+            if filename.endswith(suffix) and filename[:-len(suffix)] != prefix:
+                model = _read_model(folder, filename[:-len(suffix)])
+                if model is not None:
+                    return model
+    return None
+
+
+def is_compatible(model, epochs):
+    # A stored model can be applied as is only to the same channels with the same bads,
+    # AutoReject keeps the indices of the channels it was fitted on
+    return model['ch_names'] == list(epochs.ch_names) and sorted(model['bads']) == sorted(epochs.info['bads'])
+
+
+def summarize_reject_log(reject_log):
+    # Bad epochs and, for each channel, the number of epochs in which it was bad or interpolated
+    labels = np.nan_to_num(reject_log.labels, nan=0)
+    return {
+        'bad_epochs': np.flatnonzero(reject_log.bad_epochs).tolist(),
+        'bad_by_channel': dict(zip(reject_log.ch_names, (labels == 1).sum(axis=0).tolist())),
+        'interpolated_by_channel': dict(zip(reject_log.ch_names, (labels == 2).sum(axis=0).tolist())),
+    }
+
+
+def run_autoreject(epochs, folds, random_state, n_jobs=1, mode='fit', model=None, fit_epochs=None):
+    """Fit (or reuse) AutoReject and clean the epochs.
+
+    Returns the clean epochs, the global rejection threshold, the AutoReject
+    instance and a dict describing how the model was obtained and what it rejected.
+    """
+    if mode not in AUTOREJECT_MODES:
+        raise ValueError(f"mode must be one of {AUTOREJECT_MODES}, got {mode}")
+    # imported here so that looking for a stored model does not import autoreject
+    from autoreject import AutoReject, get_rejection_threshold, read_auto_reject
+
+    start = time.perf_counter()
+    details = {'mode': 'fit', 'source': None, 'n_fit_epochs': len(epochs)}
+
+    if mode == 'fixed' and model is not None and is_compatible(model, epochs):
+        ar = read_auto_reject(model['h5_file'])
+        reject = model['reject']
+        details.update({'mode': 'fixed', 'source': model['source'], 'n_fit_epochs': 0})
+    else:
+        ar_params = {}
+        if mode in ['warm', 'fixed'] and model is not None:
+            # a single point of the (n_interpolate, consensus) grid
+            ar_params['n_interpolate'] = np.array(sorted(set(model['n_interpolate'].values())))
+            ar_params['consensus'] = np.array(sorted(set(model['consensus'].values())))
+            details.update({'mode': 'warm', 'source': model['source']})
+        fit_set = subsample_epochs(epochs, fit_epochs, random_state)
+        ar = AutoReject(thresh_method="bayesian_optimization", cv=folds, random_state=random_state,
+                        n_jobs=n_jobs, **ar_params)
+        ar.fit(fit_set)
+        reject = get_rejection_threshold(fit_set, random_state=random_state)
+        details['n_fit_epochs'] = len(fit_set)
+
+    epochs_clean, reject_log = ar.transform(epochs, return_log=True)
+    details.update({
+        'consensus': {ch_type: float(value) for ch_type, value in ar.consensus_.items()},
+        'n_interpolate': {ch_type: int(value) for ch_type, value in ar.n_interpolate_.items()},
+        'reject_log': summarize_reject_log(reject_log),
+        'time': time.perf_counter() - start,
+    })
+    return epochs_clean, reject, ar, details
@@ -0,0 +1,150 @@
+import time
+import numpy as np
+
+from joblib import Parallel, delayed, effective_n_jobs
+from pyprep import NoisyChannels
+# pyprep has no parallel RANSAC, its channel-wise steps are reused to split the channels across jobs
+from pyprep.ransac import _make_interpolation_matrices, _ransac_by_channel
+from pyprep.utils import _get_random_subset, _split_list
+
+
+"""
+Bad channel detection with PyPREP in two passes.
+
+1. The cheap criteria of find_all_bads (NaN/flat, deviation, HF noise,
+   correlation/dropout, SNR) run on the whole recording.
+2. RANSAC, which takes most of the time, runs on every channel
+   (ransac='always', the default), only on the channels the cheap criteria
+   could not decide on (ransac='auto') or not at all (ransac='never').
+
+'auto' is opt-in: a channel that only RANSAC finds bad can score below the
+margin of every cheap criterion, and is then never tested by RANSAC.
+
+RANSAC predictions are split by channel across n_jobs processes. The random
+channel subsets are drawn from the NoisyChannels random state before the split,
+so the result does not depend on n_jobs and, with ransac='always', is the same
+as NoisyChannels.find_bad_by_ransac(channel_wise=True) after the cheap criteria
+(find_all_bads of pyprep >= 0.9 also runs a PSD criterion, which is not used here).
+"""
+
+RANSAC_MODES = ['auto', 'always', 'never']
+
+# PyPREP defaults of the cheap criteria
+DEVIATION_THRESHOLD = 5.0
+HF_ZSCORE_THRESHOLD = 5.0
+CORRELATION_FRAC_BAD = 0.01
+
+
+def get_suspicious_channels(nd, margin):
+    # Channels not marked bad by the cheap criteria but with a score above margin * threshold
+    info = nd._extra_info
+    scores = {
+        'deviation': np.abs(info['bad_by_deviation']['robust_channel_deviations']) / DEVIATION_THRESHOLD,
+        'hf_noise': info['bad_by_hf_noise']['hf_noise_zscores'] / HF_ZSCORE_THRESHOLD,
+    }
+    if 'bad_window_fractions' in info['bad_by_correlation']:
+        scores['correlation'] = info['bad_by_correlation']['bad_window_fractions'] / CORRELATION_FRAC_BAD
+
+    bads = nd.get_bads()
+    suspicious = set()
+    for score in scores.values():
+        for idx in np.flatnonzero(np.nan_to_num(score) > margin):
+            ch_name = nd.ch_names_original[idx]
+            if ch_name not in bads and ch_name in nd.ch_names_new:
+                suspicious.add(ch_name)
+    return sorted(suspicious)
+
+
+def find_bad_by_ransac(nd, channels=None, n_jobs=1, n_samples=50, sample_prop=0.25, corr_thresh=0.75,
+                       frac_bad=0.4, corr_window_secs=5.0):
+    # Channel-wise RANSAC as in pyprep.ransac.find_bad_by_ransac, predicting only `channels`
+    # (None for every channel) and splitting them across n_jobs
+    data = nd.EEGFiltered if nd.EEGFiltered is not None else nd._get_filtered_data()
+    nd.EEGFiltered = data
+    ch_names = np.asarray(nd.ch_names_new)
+    chn_pos = nd.raw_mne._get_channel_positions(nd.raw_mne.ch_names)[nd.usable_idx, :]
+
+    exclude = nd.bad_by_correlation + nd.bad_by_deviation + nd.bad_by_dropout
+    good_idx = np.array([idx for idx, ch in enumerate(ch_names) if ch not in exclude], dtype=int)
+    n_pred_chns = int(np.around(sample_prop * data.shape[0]))
+    if n_pred_chns <= 3 or len(good_idx) < n_pred_chns + 1:
+        raise OSError(f"Too many noisy channels in the data to reliably perform RANSAC "
+                      f"(only {len(good_idx)} good channels remaining)")
+
+    # Same random subsets as pyprep, drawn before splitting the work
+    good_chans = np.arange(len(good_idx))
+    random_ch_picks = [_get_random_subset(good_chans, n_pred_chns, nd.random_state) for _ in range(n_samples)]
+    interp_mats = _make_interpolation_matrices(random_ch_picks, chn_pos[good_idx, :])
+
+    win_size = int(corr_window_secs * nd.sample_rate)
+    win_count = np.arange(0, data.shape[1] - corr_window_secs * nd.sample_rate,
+                          corr_window_secs * nd.sample_rate).shape[0]
+
+    # positions (in good_idx) of the channels to predict
+    to_predict = [i for i, idx in enumerate(good_idx) if channels is None or ch_names[idx] in channels]
+    n_chunks = effective_n_jobs(n_jobs)
+    chunks = _split_list(to_predict, int(np.ceil(len(to_predict) / n_chunks))) if to_predict else []
+    good_data = data[good_idx, :]
+    results = Parallel(n_jobs=n_jobs)(
+        delayed(_ransac_by_channel)(good_data, [mat[chunk, :] for mat in interp_mats], win_size, win_count,
+                                    chunk, random_ch_picks, nd.matlab_strict)
+        for chunk in chunks)
+
+    # channels that are not predicted keep a correlation of 1 (good)
+    correlations = np.ones((win_count, len(ch_names)))
+    for chunk, chunk_correlations in zip(chunks, results):
+        correlations[:, good_idx[chunk]] = chunk_correlations
+
+    bad_window_fractions = np.mean(correlations < corr_thresh, axis=0)
+    nd.bad_by_ransac = [str(ch) for ch in ch_names[bad_window_fractions > frac_bad]]
+    nd._extra_info['bad_by_ransac'] = {'ransac_correlations': correlations,
+                                       'bad_window_fractions': bad_window_fractions}
+    return nd.bad_by_ransac
+
+
+def find_bad_channels(raw_filtered, random_state=42, ransac='always', margin=0.75, n_jobs=1):
+    # Returns the bad channels, the channels found by each criterion,
+    # the time spent on each criterion and what RANSAC did
+    if ransac not in RANSAC_MODES:
+        raise ValueError(f"ransac must be one of {RANSAC_MODES}, got {ransac}")
+    timings = {}
+
+    start = time.perf_counter()
+    nd = NoisyChannels(raw_filtered, do_detrend=False, random_state=random_state)
+    timings['setup'] = time.perf_counter() - start
+
+    # 1. Cheap criteria
+    for criterion, method in [('nan_flat', nd.find_bad_by_nan_flat), ('deviation', nd.find_bad_by_deviation),
+                              ('hf_noise', nd.find_bad_by_hfnoise), ('correlation', nd.find_bad_by_correlation),
+                              ('snr', nd.find_bad_by_SNR)]:
+        start = time.perf_counter()
+        method()
+        timings[criterion] = time.perf_counter() - start
+
+    # 2. RANSAC
+    if ransac == 'never':
+        ransac_channels = []
+    elif ransac == 'always':
+        ransac_channels = None
+    else:
+        ransac_channels = get_suspicious_channels(nd, margin)
+
+    start = time.perf_counter()
+    ransac_status = 'skipped'
+    if ransac_channels is None or len(ransac_channels):
+        try:
+            find_bad_by_ransac(nd, ransac_channels, n_jobs=n_jobs)
+            ransac_status = 'all channels' if ransac_channels is None else f'{len(ransac_channels)} channels'
+        except OSError as error:
+            # too few good channels left, as pyprep we keep the other criteria
+            ransac_status = f'failed: {error}'
+    timings['ransac'] = time.perf_counter() - start
+
+    bads = nd.get_bads()
+    return {
+        'bads': bads if bads is not None else [],
+        'bads_by_criterion': nd.get_bads(as_dict=True),
+        'ransac_channels': ransac_channels,
+        'ransac_status': ransac_status,
+        'timings': timings,
+    }
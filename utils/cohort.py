@@ -0,0 +1,349 @@
+import glob
+import os
+import warnings
+import numpy as np
+import pandas as pd
+
+import mne
+from joblib import Parallel, delayed
+
+from utils.epochs_store import BINS, read_epochs_store, read_views
+from utils.log_preprocessing import query_log
+from utils.pipeline import find_raw_files, get_raw_file
+
+
+"""
+Group statistics of the preprocessed epochs of the whole cohort without
+loading the recordings.
+
+index_derivatives lists the <id>_<week>-<window>-prepro_eeg.fif files under
+results/derivatives/<condition>/<id>/ and the views of the <id>_<week>-prepro_eeg.h5
+stores (derivative_format 'hdf5', a window is then the path of its store and
+its view), and check_derivatives compares them to the preprocessing log (JSON
+or SQLite):
+
+    ok          the file has the number of epochs logged for the window
+    missing     the log has the window but there is no file
+    stale       the number of epochs differs from the log, or the raw file
+                is newer than the epochs
+    not_logged  a file of a recording that is not in the log
+    unprocessed a raw file with neither log nor epochs
+
+group_statistics reads every file as a memory map of its data on disk
+(memmap_epochs), or the epochs of a view from its store, a chunk of epochs at
+a time, in n_jobs processes. Each file
+gives per channel the number of samples, mean, sum of squared deviations and
+a histogram, which are merged per group as the files are done, so only
+n_jobs chunks and the per-group sums are ever in memory:
+
+    report = check_derivatives('results', 'logs_preprocessing_details_all_subjects.db')
+    stats = group_statistics(report[report['status'] == 'ok'], n_jobs=8)
+    stats.loc[('baseline', '1', 'dosis', 'Cz')]
+
+The quantiles are read from the histograms (bin_width, 0.1 µV by default, is
+their resolution; the values outside value_range are counted in the first or
+last bin and reported as n_clipped).
+"""
+
+STATUSES = ['ok', 'missing', 'stale', 'not_logged', 'unprocessed']
+
+GROUP_BY = ['condition', 'week', 'window']
+
+QUANTILES = [0.05, 0.25, 0.5, 0.75, 0.95]
+
+# histogram of the values in V
+VALUE_RANGE = (-500e-6, 500e-6)
+BIN_WIDTH = 0.1e-6
+
+
+def index_derivatives(root_path, windows=None, conditions=None, subjects=None):
+    """One row per <id>_<week>-<window>-prepro_eeg.fif with its size and modification time.
+
+    The windows of a <id>_<week>-prepro_eeg.h5 store are rows with the store as path and the window as view
+    (the bins are the view 'bins'), the size is the one of the store. With derivative_format 'both' the FIF
+    file of a window is listed, not the view.
+    """
+    rows = {}
+    derivatives_folder = os.path.join(root_path, 'derivatives', '*', '*')
+    for path in sorted(glob.glob(os.path.join(derivatives_folder, '*-prepro_eeg.fif'))):
+        prefix, window = os.path.basename(path)[:-len('-prepro_eeg.fif')].split('-', 1)
+        _add_row(rows, path, prefix, window, None, windows, conditions, subjects)
+    for path in sorted(glob.glob(os.path.join(derivatives_folder, '*-prepro_eeg.h5'))):
+        prefix = os.path.basename(path)[:-len('-prepro_eeg.h5')]
+        views = read_views(path)
+        names = [name for name, (kind, *_) in views.items() if kind == 'window']
+        if any(kind == 'bin' for kind, *_ in views.values()):
+            names.append(BINS)
+        for window in names:
+            _add_row(rows, path, prefix, window, window, windows, conditions, subjects)
+    return pd.DataFrame(list(rows.values()),
+                        columns=['condition', 'subject', 'week', 'window', 'path', 'view', 'size', 'mtime'])
+
+
+def _add_row(rows, path, prefix, window, view, windows, conditions, subjects):
+    # The row of a window of a recording of the selection, unless it is already listed
+    condition, id = os.path.dirname(path).split(os.sep)[-2:]
+    if not prefix.startswith(f'{id}_'):
+        return
+    if (windows is not None and window not in windows) or (conditions is not None and condition not in conditions) \
+            or (subjects is not None and id not in subjects):
+        return
+    key = (condition, id, prefix[len(id) + 1:], window)
+    if key not in rows:
+        stat = os.stat(path)
+        rows[key] = dict(zip(['condition', 'subject', 'week', 'window'], key), path=path, view=view,
+                         size=stat.st_size, mtime=stat.st_mtime)
+
+
+def read_epochs_header(path):
+    # The epochs of a file without their data (the -prepro_eeg.fif names do not end with -epo.fif)
+    with warnings.catch_warnings():
+        warnings.filterwarnings('ignore', message='.*naming conventions')
+        return mne.read_epochs(path, preload=False, verbose=False)
+
+
+def count_epochs(path, view=None):
+    # Number of epochs of a FIF file, from its header, or of a view of a store
+    if view is not None:
+        views = read_views(path)
+        if view == BINS:
+            return sum(n_epochs for kind, _, _, n_epochs in views.values() if kind == 'bin')
+        return views[view][3]
+    return len(read_epochs_header(path))
+
+
+def check_derivatives(root_path, json_path, windows=('baseline', 'dosis'), conditions=None, subjects=None):
+    """Status of every (condition, subject, week, window) of the log, the derivatives and the raw files.
+
+    windows: the windows expected for every logged recording (None for the ones in its n_epochs_windows).
+    """
+    index = index_derivatives(root_path, windows, conditions, subjects)
+    logged = query_log(json_path, 'n_epochs_windows')
+    raw_files = query_log(json_path, 'raw_file')
+    # log keys are (subject, session, task) = (id, condition, week), see utils/pipeline.preprocess_subject
+    logged = {(session, subject, task): n_epochs for (subject, session, task), n_epochs in logged.items()
+              if (conditions is None or session in conditions) and (subjects is None or subject in subjects)}
+
+    rows = []
+    files = {tuple(row[['condition', 'subject', 'week', 'window']]): row for _, row in index.iterrows()}
+    for (condition, id, week), n_epochs_windows in logged.items():
+        # the bins (<window>-<index>) are all in one file
+        expected = windows if windows is not None else [name for name in n_epochs_windows if '-' not in name]
+        raw_file = raw_files.get((id, condition, week)) or get_raw_file(root_path, condition, id, week)
+        for window in expected:
+            row = {'condition': condition, 'subject': id, 'week': week, 'window': window,
+                   'n_epochs_logged': n_epochs_windows.get(window)}
+            file = files.pop((condition, id, week, window), None)
+            if file is None:
+                rows.append({**row, 'status': 'missing', 'reason': 'no file'})
+                continue
+            row.update(path=file['path'], view=file['view'], size=file['size'],
+                       n_epochs=count_epochs(file['path'], file['view']))
+            if row['n_epochs_logged'] is not None and row['n_epochs'] != row['n_epochs_logged']:
+                rows.append({**row, 'status': 'stale',
+                             'reason': f"{row['n_epochs']} epochs, {row['n_epochs_logged']} in the log"})
+            elif os.path.exists(raw_file) and os.path.getmtime(raw_file) > file['mtime']:
+                rows.append({**row, 'status': 'stale', 'reason': 'raw file newer than the epochs'})
+            else:
+                rows.append({**row, 'status': 'ok', 'reason': ''})
+    for (condition, id, week, window), file in files.items():
+        rows.append({'condition': condition, 'subject': id, 'week': week, 'window': window, 'path': file['path'],
+                     'view': file['view'], 'size': file['size'], 'n_epochs': count_epochs(file['path'], file['view']),
+                     'status': 'not_logged', 'reason': 'recording not in the log'})
+
+    done = {(row['condition'], row['subject'], row['week']) for row in rows}
+    for recording in find_raw_files(root_path, conditions, subjects):
+        if (recording['condition'], recording['id'], recording['week']) not in done:
+            rows.append({'condition': recording['condition'], 'subject': recording['id'],
+                         'week': recording['week'], 'status': 'unprocessed', 'reason': recording['raw_file']})
+    columns = ['condition', 'subject', 'week', 'window', 'status', 'reason', 'n_epochs', 'n_epochs_logged', 'path',
+               'view', 'size']
+    return pd.DataFrame(rows, columns=columns).sort_values(['condition', 'subject', 'week', 'window'],
+                                                           ignore_index=True)
+
+
+def _pick(epochs, picks):
+    # Indices of a channel type or of a list of channel names
+    if isinstance(picks, str):
+        return mne.pick_types(epochs.info, **{picks: True}, exclude=[])
+    return mne.pick_channels(epochs.ch_names, picks, ordered=True)
+
+
+def memmap_epochs(path, picks='eeg'):
+    """The data of a FIF epochs file as memory maps, without reading it.
+
+    picks: a channel type or a list of channel names.
+    Returns the channel names and indices of picks and a list with, for each part of the file (files above 2 GB
+    are split), a read-only (n_epochs, n_channels, n_times) memory map of the data as stored and the
+    calibration (n_channels, 1) that gives the values in V (data * cals, as Epochs.get_data()).
+    The list is None when the file cannot be memory mapped (data that is not real, or a version of MNE
+    that stores the layout of the file differently), see recording_statistics.
+    """
+    epochs = read_epochs_header(path)
+    picks = _pick(epochs, picks)
+    return [epochs.ch_names[pick] for pick in picks], picks, _memmap_parts(epochs)
+
+
+def _memmap_parts(epochs):
+    # the file part, offset, shape and calibration of the data found by read_epochs, from the private
+    # attributes of the parts of mne EpochsFIF. None when they are missing or the first epoch they give
+    # is not the one of get_data
+    parts = []
+    try:
+        for part in epochs._raw:
+            if part.fmt not in ('>f4', '>f8'):
+                return None
+            data = np.memmap(part.fid.name, dtype=part.fmt, mode='r', offset=part.data_tag.pos + 16,
+                             shape=(len(part.event_samps), *part.epoch_shape))
+            parts.append((data, part.cals))
+    except (AttributeError, TypeError, ValueError):
+        return None
+    first = next((part for part in parts if len(part[0])), None)
+    if first is not None and not np.allclose(first[0][0] * first[1], epochs.get_data(item=0)[0], rtol=1e-6, atol=0):
+        return None
+    return parts
+
+
+class ChannelStatistics:
+    # Mergeable per channel sums: number of samples, mean, sum of squared deviations (Chan et al.),
+    # histogram and number of epochs
+    def __init__(self, ch_names, value_range=VALUE_RANGE, bin_width=BIN_WIDTH):
+        self.ch_names = list(ch_names)
+        self.value_range = value_range
+        self.bin_width = bin_width
+        self.n_bins = int(round((value_range[1] - value_range[0]) / bin_width))
+        self.n = np.zeros(len(self.ch_names))
+        self.mean = np.zeros(len(self.ch_names))
+        self.m2 = np.zeros(len(self.ch_names))
+        self.histogram = np.zeros((len(self.ch_names), self.n_bins), dtype=np.int64)
+        self.n_clipped = np.zeros(len(self.ch_names), dtype=np.int64)
+        self.n_epochs = 0
+        self.n_recordings = 0
+
+    def add_data(self, data):
+        # data: (n_epochs, n_channels, n_times) in V
+        values = np.moveaxis(data, 1, 0).reshape(len(self.ch_names), -1)
+        n = values.shape[1]
+        mean = values.mean(axis=1)
+        m2 = ((values - mean[:, None]) ** 2).sum(axis=1)
+        self._merge_moments(np.full(len(self.ch_names), n, dtype=float), mean, m2)
+
+        bins = np.floor((values - self.value_range[0]) / self.bin_width).astype(np.int64)
+        self.n_clipped += ((bins < 0) | (bins >= self.n_bins)).sum(axis=1)
+        np.clip(bins, 0, self.n_bins - 1, out=bins)
+        # one bincount for all the channels
+        bins += np.arange(len(self.ch_names))[:, None] * self.n_bins
+        self.histogram += np.bincount(bins.ravel(), minlength=self.histogram.size).reshape(self.histogram.shape)
+        self.n_epochs += data.shape[0]
+
+    def _merge_moments(self, n, mean, m2):
+        total = self.n + n
+        delta = mean - self.mean
+        with np.errstate(invalid='ignore', divide='ignore'):
+            self.mean = np.where(total > 0, self.mean + delta * n / total, 0.)
+            self.m2 = np.where(total > 0, self.m2 + m2 + delta ** 2 * self.n * n / total, 0.)
+        self.n = total
+
+    def merge(self, other):
+        # Add the sums of other, aligned by channel name (channels missing from self are added)
+        if (other.value_range, other.bin_width) != (self.value_range, self.bin_width):
+            raise ValueError('Statistics with different histograms cannot be merged')
+        new = [ch for ch in other.ch_names if ch not in self.ch_names]
+        if new:
+            self.ch_names += new
+            self.n, self.mean, self.m2, self.n_clipped = [np.concatenate([values, np.zeros(len(new), values.dtype)])
+                                                          for values in [self.n, self.mean, self.m2, self.n_clipped]]
+            self.histogram = np.concatenate([self.histogram, np.zeros((len(new), self.n_bins), np.int64)])
+        idx = [self.ch_names.index(ch) for ch in other.ch_names]
+        n, mean, m2 = [np.zeros(len(self.ch_names)) for _ in range(3)]
+        n[idx], mean[idx], m2[idx] = other.n, other.mean, other.m2
+        self._merge_moments(n, mean, m2)
+        self.histogram[idx] += other.histogram
+        self.n_clipped[idx] += other.n_clipped
+        self.n_epochs += other.n_epochs
+        self.n_recordings += other.n_recordings
+        return self
+
+    def quantiles(self, quantiles):
+        # (n_channels, n_quantiles) from the histograms, linear within a bin
+        cumulative = np.cumsum(self.histogram, axis=1)
+        values = np.empty((len(self.ch_names), len(quantiles)))
+        for i, counts in enumerate(cumulative):
+            if counts[-1] == 0:
+                values[i] = np.nan
+                continue
+            for j, q in enumerate(quantiles):
+                target = q * counts[-1]
+                k = min(np.searchsorted(counts, target), self.n_bins - 1)
+                below = counts[k - 1] if k > 0 else 0
+                fraction = (target - below) / max(counts[k] - below, 1)
+                values[i, j] = self.value_range[0] + (k + fraction) * self.bin_width
+        return values
+
+    def to_frame(self, quantiles=QUANTILES):
+        table = pd.DataFrame({'n_recordings': self.n_recordings, 'n_epochs': self.n_epochs,
+                              'n_samples': self.n.astype(np.int64), 'mean': self.mean,
+                              'var': self.m2 / np.maximum(self.n - 1, 1), 'n_clipped': self.n_clipped},
+                             index=pd.Index(self.ch_names, name='channel'))
+        table['std'] = np.sqrt(table['var'])
+        for q, values in zip(quantiles, self.quantiles(quantiles).T):
+            table[f'q{q * 100:g}'] = values
+        return table
+
+
+def recording_statistics(path, picks='eeg', chunk_epochs=64, value_range=VALUE_RANGE, bin_width=BIN_WIDTH,
+                         view=None):
+    # ChannelStatistics of one file, read chunk_epochs epochs at a time from its memory map
+    # (with Epochs.get_data when it cannot be memory mapped, from its store for a view)
+    if view is not None:
+        epochs = read_epochs_store(path, view)
+        return _epochs_statistics(epochs, _pick(epochs, picks), chunk_epochs, value_range, bin_width)
+    ch_names, picks, parts = memmap_epochs(path, picks)
+    if parts is None:
+        return _epochs_statistics(read_epochs_header(path), picks, chunk_epochs, value_range, bin_width)
+    statistics = ChannelStatistics(ch_names, value_range, bin_width)
+    for data, cals in parts:
+        for start in range(0, len(data), chunk_epochs):
+            chunk = np.asarray(data[start:start + chunk_epochs, picks], dtype=np.float64)
+            statistics.add_data(chunk * cals[picks])
+    statistics.n_recordings = 1
+    return statistics
+
+
+def _epochs_statistics(epochs, picks, chunk_epochs, value_range, bin_width):
+    # ChannelStatistics of the channels picks (indices) of epochs not loaded, read chunk_epochs at a time
+    statistics = ChannelStatistics([epochs.ch_names[pick] for pick in picks], value_range, bin_width)
+    for start in range(0, len(epochs), chunk_epochs):
+        statistics.add_data(epochs.get_data(picks, item=slice(start, start + chunk_epochs)))
+    statistics.n_recordings = 1
+    return statistics
+
+
+def group_statistics(files, group_by=GROUP_BY, quantiles=QUANTILES, picks='eeg', n_jobs=1, chunk_epochs=64,
+                     value_range=VALUE_RANGE, bin_width=BIN_WIDTH):
+    """Per channel statistics of every group of files, one row per (group..., channel).
+
+    files: rows of index_derivatives or check_derivatives (with a path and a view), e.g. the 'ok' ones.
+    The files are read in n_jobs processes and merged into their group as they are done.
+    """
+    files = files[files['path'].notna()] if 'path' in files else files
+    groups = {}
+    keys = [tuple(key) for key in files[list(group_by)].astype(str).itertuples(index=False)]
+    views = files['view'] if 'view' in files else [None] * len(files)
+    tasks = (delayed(_keyed)(key, recording_statistics, path, picks, chunk_epochs, value_range, bin_width,
+                             view if isinstance(view, str) else None)
+             for key, path, view in zip(keys, files['path'], views))
+    for key, statistics in Parallel(n_jobs=n_jobs, return_as='generator_unordered')(tasks):
+        if key in groups:
+            groups[key].merge(statistics)
+        else:
+            groups[key] = statistics
+    if not groups:
+        return pd.DataFrame()
+    return pd.concat({key: groups[key].to_frame(quantiles) for key in sorted(groups)},
+                     names=list(group_by))
+
+
+def _keyed(key, function, *args):
+    # the result of a parallel task with the group it belongs to
+    return key, function(*args)
@@ -0,0 +1,222 @@
+import json
+import os
+import numpy as np
+import pandas as pd
+
+import mne
+from mne._fiff.meas_info import Info
+
+from utils.pipeline import onset_indices, save_epochs
+
+
+"""
+Compressed, chunked store of the preprocessed epochs (derivative_format 'hdf5').
+
+With FIF every recording is written three times: the rereferenced epochs and
+again the baseline and the dosis (and the bins), uncompressed. Here the
+rereferenced epochs are written once to <prefix>-prepro_eeg.h5 in float32,
+one compressed chunk per epoch, and every window and bin is only the indices
+of its epochs (a view):
+
+    /data           (n_epochs, n_channels, n_times) float32, chunks of one epoch
+    /events         events of the epochs
+    /selection      their index in the epochs made from the recording
+    /info           measurement info (h5io)
+    /views/<name>   indices of the epochs of a window or a bin, with its tmin and tmax
+
+The data is the one of the FIF files written in 'single' precision. Adding a
+window to a preprocessed recording only writes its indices (write_views).
+read_epochs_store returns MNE Epochs that read the epochs of a view from the
+file when their data is needed:
+
+    epochs = read_epochs_store(get_store_file(save_folder, prefix), 'dosis')
+    epochs['1'].get_data(picks='Cz')
+    epochs_bins = read_epochs_store(path, 'bins')   # every bin, with metadata['window']
+
+export_fif writes the FIF files of a store as derivative_format 'fif' does.
+"""
+
+COMPRESSIONS = ['lzf', 'gzip', None]
+
+BINS = 'bins'
+
+
+def get_store_file(save_folder, prefix):
+    return os.path.join(save_folder, f'{prefix}-prepro_eeg.h5')
+
+
+def write_epochs_store(epochs, path, windows, bins=None, compression='lzf'):
+    """Write the epochs once and the windows and bins ({name: (tmin, tmax)}) as views.
+
+    Returns {name: number of epochs} of the windows and of the bins.
+    """
+    import h5py
+    import h5io
+
+    if compression not in COMPRESSIONS:
+        raise ValueError(f"compression must be one of {COMPRESSIONS}, got {compression}")
+    data = epochs._data
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with h5py.File(tmp_path, 'w') as f:
+        # shuffle groups the bytes of the floats, which compress better than the floats
+        store = f.create_dataset('data', shape=data.shape, dtype=np.float32, chunks=(1, *data.shape[1:]),
+                                 compression=compression, shuffle=compression is not None)
+        # a block at a time, so that there is no float32 copy of all the data
+        for start in range(0, len(data), 64):
+            store[start:start + 64] = data[start:start + 64]
+        f.create_dataset('events', data=epochs.events)
+        f.create_dataset('selection', data=epochs.selection)
+        f.attrs['tmin'] = epochs.tmin
+        f.attrs['sfreq'] = epochs.info['sfreq']
+        # an array of one value in the epochs read from FIF
+        f.attrs['raw_sfreq'] = float(np.squeeze(epochs._raw_sfreq))
+        f.attrs['baseline'] = json.dumps(epochs.baseline)
+        f.attrs['event_id'] = json.dumps({name: int(code) for name, code in epochs.event_id.items()})
+        f.attrs['drop_log'] = json.dumps(epochs.drop_log)
+        h5io.write_hdf5(f, dict(epochs.info), title='info', slash='replace')
+        n_epochs = _write_views(f, windows, bins)
+    # moved in place once complete, a reader never sees a partly written store
+    os.replace(tmp_path, path)
+    return n_epochs
+
+
+def _write_views(f, windows, bins=None):
+    # The views of an open store, replacing the previous ones
+    if 'views' in f:
+        del f['views']
+    views = f.create_group('views')
+    onsets = f['events'][:, 0] / f.attrs['sfreq']
+    n_epochs = {}
+    for kind, intervals in [('window', windows), ('bin', bins or {})]:
+        for name, (start, stop) in onset_indices(onsets, intervals).items():
+            view = views.create_dataset(name, data=np.arange(start, stop))
+            view.attrs['kind'] = kind
+            view.attrs['tmin'], view.attrs['tmax'] = intervals[name]
+            n_epochs[name] = int(stop - start)
+    return n_epochs
+
+
+def write_views(path, windows, bins=None):
+    # New windows or bins of a store, without writing its data again
+    import h5py
+
+    with h5py.File(path, 'a') as f:
+        return _write_views(f, windows, bins)
+
+
+def read_views(path):
+    # {name: (kind, tmin, tmax, number of epochs)} of the views of a store
+    import h5py
+
+    with h5py.File(path, 'r') as f:
+        return {name: (view.attrs['kind'], float(view.attrs['tmin']), float(view.attrs['tmax']), len(view))
+                for name, view in f['views'].items()}
+
+
+class _StoreFile:
+    # The open store of lazy epochs. Dropped when they are pickled and opened again on the first read
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    @property
+    def data(self):
+        if self._file is None:
+            import h5py
+
+            self._file = h5py.File(self.path, 'r')
+        return self._file['data']
+
+    def __getstate__(self):
+        return {'path': self.path, '_file': None}
+
+
+class EpochsStore(mne.BaseEpochs):
+    """The epochs of a view of a store (None for all, 'bins' for every bin), read when needed.
+
+    The events are those of the store, so that an epoch is found by its sample as in EpochsFIF.
+    """
+
+    def __init__(self, path, view=None, preload=False, verbose=None):
+        import h5py
+        import h5io
+
+        with h5py.File(path, 'r') as f:
+            all_events = f['events'][()]
+            rows, metadata = _view_rows(f, view, all_events)
+            selection = f['selection'][()][rows]
+            info = Info(**h5io.read_hdf5(f, title='info', slash='replace'))
+            n_times = f['data'].shape[2]
+            data = _read_rows(f['data'], rows) if preload else None
+            tmin = float(f.attrs['tmin'])
+            raw_sfreq = float(f.attrs['raw_sfreq'])
+            baseline = json.loads(f.attrs['baseline'])
+            event_id = json.loads(f.attrs['event_id'])
+            drop_log = json.loads(f.attrs['drop_log'])
+        # the epochs that are not in the view are IGNORED, as in epochs[start:stop]
+        kept = set(selection)
+        drop_log = tuple(tuple(reasons) if reasons or i in kept else ('IGNORED',)
+                         for i, reasons in enumerate(drop_log))
+        self._store_samples = all_events[:, 0]
+        super().__init__(info, data, all_events[rows], event_id, tmin, tmin + (n_times - 1) / info['sfreq'],
+                         baseline=None, raw=None if preload else _StoreFile(path), on_missing='ignore',
+                         selection=selection, drop_log=drop_log, filename=path, metadata=metadata,
+                         raw_sfreq=raw_sfreq, verbose=verbose)
+        # the data is stored with its baseline, which is not applied again
+        self.baseline = tuple(baseline) if baseline is not None else None
+        self._do_baseline = False
+        self._bad_dropped = True
+
+    def _get_epoch_from_raw(self, idx, verbose=None):
+        # One epoch from its chunk of the store
+        row = np.searchsorted(self._store_samples, self.events[idx, 0])
+        return self._raw.data[row].astype(np.float64)
+
+
+def _view_rows(f, view, events):
+    # Indices of the epochs of a view and their metadata (the bin and onset of every epoch for 'bins')
+    if view is None:
+        return np.arange(len(events)), None
+    if view == BINS:
+        views = f['views']
+        names = sorted((name for name in views if views[name].attrs['kind'] == 'bin'),
+                       key=lambda name: views[name].attrs['tmin'])
+        if not names:
+            raise ValueError(f'{f.filename} has no bins')
+        rows = [views[name][()] for name in names]
+        windows = np.repeat(names, [len(indices) for indices in rows])
+        rows = np.concatenate(rows)
+        if len(np.unique(rows)) != len(rows):
+            raise ValueError('The bins overlap, an epoch can only be in one bin')
+        return rows, pd.DataFrame({'window': windows, 'onset': events[rows, 0] / f.attrs['sfreq']})
+    if view not in f['views']:
+        raise ValueError(f"{f.filename} has no view {view}, only {list(f['views'])}")
+    return f['views'][view][()], None
+
+
+def _read_rows(data, rows):
+    # The epochs of rows (sorted) in float64, read as the slice that spans them: a view is a
+    # range of epochs, and selecting single chunks in HDF5 is much slower than a slice
+    if not len(rows):
+        return np.empty((0, *data.shape[1:]))
+    return data[rows[0]:rows[-1] + 1][rows - rows[0]].astype(np.float64)
+
+
+def read_epochs_store(path, view=None, preload=False):
+    return EpochsStore(path, view, preload=preload)
+
+
+def export_fif(path, save_folder, prefix):
+    """Write the FIF files of a store: <prefix>-rereferenced_eeg.fif, one per window and the bins.
+
+    Returns {name: number of epochs} of the windows.
+    """
+    save_epochs(read_epochs_store(path, preload=True), os.path.join(save_folder, f'{prefix}-rereferenced_eeg.fif'))
+    views = read_views(path)
+    n_epochs = {}
+    for name in [name for name, (kind, *_) in views.items() if kind == 'window'] + \
+            ([BINS] if any(kind == 'bin' for kind, *_ in views.values()) else []):
+        epochs = read_epochs_store(path, name, preload=True)
+        save_epochs(epochs, os.path.join(save_folder, f'{prefix}-{name}-prepro_eeg.fif'))
+        n_epochs[name] = len(epochs)
+    return n_epochs
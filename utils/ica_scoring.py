@@ -0,0 +1,223 @@
+import numpy as np
+import pandas as pd
+
+import mne
+# the outlier search and phase statistics of find_bads_eog/ecg and the sensor positions of find_bads_muscle
+# are reused as is
+from mne.channels.layout import _find_topomap_coords
+from mne.preprocessing.bads import _find_outliers
+from mne.preprocessing.ctps_ import ctps
+from mne.utils.check import _check_ch_locs
+from scipy.special import expit
+
+
+"""
+Artifact scores and exclusion of ICA components in one pass.
+
+ICA.find_bads_eog, find_bads_ecg, find_bads_muscle and ICLabel each project
+the epochs on the components again. Here the sources are computed once,
+(n_epochs, n_components, n_times), and every score is derived from them:
+
+    eog_r             Pearson correlation with the EOG channel (Fp1), thresholded
+                      by its iterated z-score (find_bads_eog)
+    ecg_ctps          cross-trial phase statistics (find_bads_ecg, 'ctps')
+    ecg_r             correlation with the ECG channel (find_bads_ecg, 'correlation')
+    muscle_slope, muscle_focus, muscle_smoothness, muscle_score
+                      find_bads_muscle criteria and their product
+    ICLabel class probabilities and label
+
+With the default rules the components found by each method and the excluded
+components are the ones of the find_bads_* calls and ICLabel:
+
+    scores = score_components(ica, epochs_clean)
+    table = decide(scores, {'muscle_threshold': 0.7})
+    table.loc[table['exclude'], ['label', 'reason']]
+"""
+
+DEFAULT_RULES = {
+    # iterated z-score of the correlation with the EOG channel above which a component is EOG
+    'eog_threshold': 3.0,
+    # 'ctps' (p-value of the cross-trial phase statistics above ecg_threshold) or
+    # 'correlation' (iterated z-score of the correlation with the ECG channel above ecg_threshold),
+    # 'auto' is the threshold of find_bads_ecg for the method (ctps_threshold, ECG_THRESHOLDS)
+    'ecg_method': 'ctps',
+    'ecg_threshold': 'auto',
+    # find_bads_muscle threshold, raised to the number of criteria
+    'muscle_threshold': 0.5,
+    # a component found by a method is excluded if ICLabel gives it one of these labels
+    'confirm_labels': ['muscle artifact', 'eye blink', 'heart beat', 'channel noise'],
+    # components with these labels are excluded whatever the methods find
+    'exclude_labels': ['channel noise'],
+    # components with these ICLabel labels count as found by the method, as in the previous code where
+    # ICLabel appended them to the lists of ica.labels_ returned by find_bads_* (so every component
+    # with a label of confirm_labels was excluded). {} for only the components the methods find
+    'label_methods': {'eye blink': 'eog', 'heart beat': 'ecg', 'muscle artifact': 'muscle'},
+}
+
+ECG_METHODS = ['ctps', 'correlation']
+
+# find_bads_ecg threshold='auto' of each method, for ctps when the scores do not give the one of their ICA
+ECG_THRESHOLDS = {'ctps': 0.3, 'correlation': 3.0}
+
+
+def ctps_threshold(ica):
+    # threshold='auto' of find_bads_ecg(method='ctps') for this ICA: the MNE versions with
+    # ICA._get_ctps_threshold derive it from the sampling frequency (0.32 at 256 Hz), the others use 0.3
+    get_threshold = getattr(ica, '_get_ctps_threshold', None)
+    return float(get_threshold()) if get_threshold is not None else ECG_THRESHOLDS['ctps']
+
+
+def get_sources(ica, epochs):
+    # The one projection of the epochs on the components, (n_epochs, n_components, n_times)
+    return ica._transform_epochs(epochs, concatenate=False)
+
+
+def correlation(sources, target):
+    # Pearson correlation of every component with the target channel over all the epochs,
+    # as ICA.score_sources(epochs, target, 'pearsonr')
+    sources = np.moveaxis(sources, 1, 0).reshape(sources.shape[1], -1)
+    sources = sources - sources.mean(axis=1, keepdims=True)
+    target = target.ravel() - target.mean()
+    return sources @ target / (np.linalg.norm(sources, axis=1) * np.linalg.norm(target))
+
+
+def ctps_scores(sources):
+    # Highest p-value of the cross-trial phase statistics of every component
+    _, p_vals, _ = ctps(sources)
+    return p_vals.max(-1)
+
+
+def muscle_criteria(ica, info, sources, l_freq=7, h_freq=45, sphere=None):
+    # Slope, focus and smoothness scores of ICA.find_bads_muscle. Focus and smoothness depend
+    # only on the topographies and are None without sensor positions
+    psds, freqs = mne.time_frequency.psd_array_multitaper(sources, info['sfreq'], fmin=l_freq, fmax=h_freq,
+                                                          verbose=False)
+    slopes = np.polyfit(np.log10(freqs), np.log10(psds.mean(axis=0)).T, 1)[0]
+    criteria = {'muscle_slope': expit((slopes + 0.5) / 0.25), 'muscle_focus': None, 'muscle_smoothness': None}
+
+    picks = mne.pick_channels(info['ch_names'], ica.ch_names, ordered=True)
+    if not _check_ch_locs(info, picks=picks):
+        return criteria
+    components = ica.get_components()
+    pos = _find_topomap_coords(info, picks=ica.ch_names, sphere=sphere, ignore_overlap=True)
+    pos -= pos.mean(axis=0)
+    dists = np.linalg.norm(pos, axis=1)
+    focus_dists = (dists / dists.max()) @ (np.abs(components) / np.abs(components).max(axis=0))
+    criteria['muscle_focus'] = expit((focus_dists - 0.65) / 0.1)
+
+    # distance between the weights of every pair of channels, for all the components at once
+    pos_dists = np.linalg.norm(pos[:, None] - pos[None], axis=-1)
+    pos_dists = 1 - pos_dists / pos_dists.max()
+    comp_dists = np.abs(components.T[:, :, None] - components.T[:, None, :])
+    comp_dists /= comp_dists.max(axis=(1, 2), keepdims=True)
+    smoothnesses = (comp_dists * pos_dists).sum(axis=(1, 2))
+    criteria['muscle_smoothness'] = 1 - expit((smoothnesses - 300) / 100)
+    return criteria
+
+
+def iclabel_activations(ica, sources):
+    # ICLabel activations, (n_components, n_times, n_epochs), from the sources: ICLabel projects the
+    # data in µV without the pre-whitening and the PCA mean, which only scale and shift the sources
+    # when the pre-whitener is the same for every channel (EEG only)
+    pre_whitener = np.asarray(ica.pre_whitener_).ravel()
+    if ica.noise_cov is not None or not np.allclose(pre_whitener, pre_whitener[0]):
+        return None
+    unmixing = ica.unmixing_matrix_ @ ica.pca_components_[:ica.n_components_]
+    mean = unmixing @ ica.pca_mean_ if ica.pca_mean_ is not None else 0.
+    return (1e6 * pre_whitener[0] * (sources + np.asarray(mean)[:, None])).transpose(1, 2, 0)
+
+
+def score_components(ica, epochs, eog_ch='Fp1', ecg_ch='ECG', ic_labels=None, sphere=None):
+    # One row per component with every score. ic_labels: output of utils.iclabel_batch.label_components_batch
+    # when the components of several recordings were classified together, otherwise ICLabel runs here.
+    # The ICLabel labels are added to ica.labels_ as label_components does
+    from utils.iclabel_batch import ICLABEL_LABELS, add_labels, label_components_batch
+
+    sources = get_sources(ica, epochs)
+    scores = pd.DataFrame(index=pd.RangeIndex(ica.n_components_, name='component'))
+    for name, ch_name in [('eog', eog_ch), ('ecg', ecg_ch)]:
+        if ch_name is not None and ch_name in epochs.ch_names:
+            scores[f'{name}_r'] = correlation(sources, epochs.get_data(picks=[ch_name]))
+    scores['ecg_ctps'] = ctps_scores(sources)
+    scores.attrs['ecg_ctps_threshold'] = ctps_threshold(ica)
+    for name, values in muscle_criteria(ica, epochs.info, sources, sphere=sphere).items():
+        if values is not None:
+            scores[name] = values
+    scores['muscle_score'] = scores.filter(like='muscle_').prod(axis=1)
+
+    if ic_labels is None:
+        ic_labels = label_components_batch([(epochs, ica, iclabel_activations(ica, sources))])[0]
+    else:
+        add_labels(ica, ic_labels['labels_pred_proba'])
+    for label, proba in zip(ICLABEL_LABELS.values(), ic_labels['labels_pred_proba'].T):
+        scores[label] = proba
+    scores['label'] = ic_labels['labels']
+    return scores
+
+
+def _outliers(scores, threshold):
+    # Components found by the iterated z-score, sorted by decreasing absolute score
+    idx = _find_outliers(scores, threshold=threshold)
+    return list(idx[np.abs(scores[idx]).argsort()[::-1]])
+
+
+def find_artifacts(scores, rules):
+    # Components found by each method, sorted by score as the find_bads_* methods
+    found = {}
+    if 'eog_r' in scores:
+        found['eog'] = _outliers(scores['eog_r'].to_numpy(), rules['eog_threshold'])
+    if rules['ecg_method'] not in ECG_METHODS:
+        raise ValueError(f"ecg_method must be one of {ECG_METHODS}, got {rules['ecg_method']}")
+    ecg_threshold = rules['ecg_threshold']
+    if ecg_threshold == 'auto' and rules['ecg_method'] == 'ctps':
+        ecg_threshold = scores.attrs.get('ecg_ctps_threshold', ECG_THRESHOLDS['ctps'])
+    elif ecg_threshold == 'auto':
+        ecg_threshold = ECG_THRESHOLDS['correlation']
+    if rules['ecg_method'] == 'ctps':
+        ctps = scores['ecg_ctps'].to_numpy()
+        idx = np.flatnonzero(ctps >= ecg_threshold)
+        found['ecg'] = list(idx[ctps[idx].argsort()[::-1]])
+    elif 'ecg_r' in scores:
+        found['ecg'] = _outliers(scores['ecg_r'].to_numpy(), ecg_threshold)
+    n_criteria = len([name for name in ['muscle_slope', 'muscle_focus', 'muscle_smoothness'] if name in scores])
+    found['muscle'] = list(np.flatnonzero(scores['muscle_score'].to_numpy() > rules['muscle_threshold'] ** n_criteria))
+    return found
+
+
+def add_label_methods(found, labels, label_methods):
+    # Components with a label of label_methods appended to the ones found by its method
+    found = {method: list(idx) for method, idx in found.items()}
+    for label, method in label_methods.items():
+        found[method] = found.get(method, []) + [idx for idx in np.flatnonzero(np.asarray(labels) == label)
+                                                 if idx not in found.get(method, [])]
+    return found
+
+
+def decide(scores, rules=None):
+    # Decision table: the scores with a column per method (found by it), the exclusion and its reason
+    rules = {**DEFAULT_RULES, **(rules or {})}
+    by_scores = find_artifacts(scores, rules)
+    found = add_label_methods(by_scores, scores['label'], rules['label_methods'])
+    table = scores.copy()
+    for method in ['eog', 'ecg', 'muscle']:
+        table[method] = table.index.isin(found.get(method, []))
+    pattern_matched = table[['eog', 'ecg', 'muscle']].any(axis=1)
+    confirmed = pattern_matched & table['label'].isin(rules['confirm_labels'])
+    by_label = table['label'].isin(rules['exclude_labels'])
+    table['exclude'] = confirmed | by_label
+    methods = table[['eog', 'ecg', 'muscle']].apply(lambda row: '+'.join(row.index[row]), axis=1)
+    table['reason'] = np.where(confirmed, methods + ' (' + table['label'] + ')',
+                               np.where(by_label, 'label (' + table['label'] + ')', ''))
+    table.attrs['found'] = found
+    table.attrs['found_by_scores'] = by_scores
+    return table
+
+
+def set_labels(ica, table, eog_ch='Fp1', ecg_ch='ECG'):
+    # ica.labels_ entries of the find_bads_* methods, for the plots of the ICA
+    found, by_scores = table.attrs['found'], table.attrs['found_by_scores']
+    if 'eog' in by_scores:
+        ica.labels_[f'eog/0/{eog_ch}'] = by_scores['eog']
+    if 'ecg' in by_scores:
+        ica.labels_[f'ecg/{ecg_ch}'] = by_scores['ecg']
+    ica.labels_.update(found)
@@ -0,0 +1,130 @@
+import numpy as np
+
+from mne_icalabel.config import ICA_LABELS_TO_MNE, ICALABEL_METHODS_NUMERICAL_TO_STRING
+from mne_icalabel.iclabel import get_iclabel_features
+# its feature functions are reused with activations computed from the ICA sources
+from mne_icalabel.iclabel.features import (_eeg_autocorr, _eeg_autocorr_fftw, _eeg_autocorr_welch, _eeg_rpsd,
+                                           _eeg_topoplot, _retrieve_eeglab_icawinv)
+# mne_icalabel loads the network on every call, its input formatting is reused with a network loaded once
+from mne_icalabel.iclabel.network.utils import _format_input
+
+
+"""
+ICLabel for many ICA decompositions with the network loaded once per process.
+
+mne_icalabel.label_components loads the ICLabel network (torch or onnxruntime)
+every time it is called. Here the network is loaded the first time it is needed
+and kept for the life of the process, so that a batch worker loads it once for
+all its recordings, and the features of several decompositions are classified
+in a single forward pass on the CPU:
+
+    results = label_components_batch([(epochs_1, ica_1), (epochs_2, ica_2)])
+    results[0]['labels'], results[0]['y_pred_proba'], results[0]['labels_pred_proba']
+
+The labels are the same as label_components(inst, ica, method='iclabel') and,
+as it does, they are added to ica.labels_ and ica.labels_scores_. A pair can
+carry the ICLabel activations already computed from the sources,
+(inst, ica, icaact), see utils/ica_scoring.py.
+"""
+
+ICLABEL_LABELS = ICALABEL_METHODS_NUMERICAL_TO_STRING['iclabel']
+
+_models = {}
+
+
+class ICLabelModel:
+    def __init__(self, backend=None):
+        # backend: 'torch', 'onnx' or None for the first one installed, as mne_icalabel
+        if backend is None:
+            try:
+                import torch  # noqa: F401
+                backend = 'torch'
+            except ImportError:
+                backend = 'onnx'
+        self.backend = backend
+
+        from importlib.resources import files
+        assets = files('mne_icalabel.iclabel.network') / 'assets'
+        if backend == 'torch':
+            import torch
+            from mne_icalabel.iclabel.network.torch import ICLabelNet
+            self.network = ICLabelNet().float()
+            self.network.load_state_dict(torch.load(assets / 'ICLabelNet.pt', weights_only=True))
+            self.network.eval()
+        elif backend == 'onnx':
+            import onnxruntime as ort
+            self.network = ort.InferenceSession(str(assets / 'ICLabelNet.onnx'),
+                                                providers=['CPUExecutionProvider'])
+        else:
+            raise ValueError(f"backend must be 'torch', 'onnx' or None, got {backend}")
+
+    def predict(self, images, psds, autocorr):
+        # Features stacked on the last axis (one entry per component), returns (n_components, n_classes)
+        images, psds, autocorr = [np.transpose(feature, (3, 2, 0, 1)).astype(np.float32)
+                                  for feature in _format_input(images, psds, autocorr)]
+        if self.backend == 'torch':
+            import torch
+            with torch.no_grad():
+                labels = self.network(torch.from_numpy(images), torch.from_numpy(psds), torch.from_numpy(autocorr))
+            return labels.numpy()
+        return self.network.run(None, {'topo': images, 'psds': psds, 'autocorr': autocorr})[0]
+
+
+def get_iclabel_model(backend=None):
+    # The network is loaded once per process and backend
+    if backend not in _models:
+        _models[backend] = ICLabelModel(backend)
+    return _models[backend]
+
+
+def add_labels(ica, labels_pred_proba):
+    # Same as the inplace update of mne_icalabel.iclabel_label_components
+    ica.labels_scores_ = labels_pred_proba
+    argmax_labels = np.argmax(labels_pred_proba, axis=1)
+    for idx, mne_label in enumerate(ICA_LABELS_TO_MNE.values()):
+        auto_labels = list(np.argwhere(argmax_labels == idx).flatten())
+        if mne_label not in ica.labels_:
+            ica.labels_[mne_label] = auto_labels
+            continue
+        for comp in auto_labels:
+            if comp not in ica.labels_[mne_label]:
+                ica.labels_[mne_label].append(comp)
+
+
+def get_features(inst, ica, icaact=None):
+    # get_iclabel_features with the activations (n_components, n_times[, n_epochs]) given,
+    # without its warnings on the reference, the filters and the ICA method
+    if icaact is None:
+        return get_iclabel_features(inst, ica)
+    icawinv, _ = _retrieve_eeglab_icawinv(ica)
+    topo = _eeg_topoplot(inst, icawinv, ica.ch_names)
+    psd = _eeg_rpsd(inst, ica, icaact)
+    if icaact.ndim == 3:
+        autocorr = _eeg_autocorr_fftw(inst, ica, icaact)
+    elif 5 < inst.times.size / inst.info['sfreq']:
+        autocorr = _eeg_autocorr_welch(inst, ica, icaact)
+    else:
+        autocorr = _eeg_autocorr(inst, ica, icaact)
+    return topo * 0.99, psd * 0.99, autocorr * 0.99
+
+
+def label_components_batch(decompositions, backend=None):
+    # decompositions: list of (inst, ica) or (inst, ica, icaact) tuples. Returns for each one a dict with
+    # the labels, the probability of each label and the probabilities of every class, as label_components
+    features = [get_features(*decomposition) for decomposition in decompositions]
+    if not features:
+        return []
+    n_components = [feature[0].shape[3] for feature in features]
+    images, psds, autocorr = [np.concatenate([feature[i] for feature in features], axis=3) for i in range(3)]
+    labels_pred_proba = get_iclabel_model(backend).predict(images, psds, autocorr)
+
+    results = []
+    for (inst, ica, *_), proba in zip(decompositions, np.split(labels_pred_proba, np.cumsum(n_components)[:-1])):
+        add_labels(ica, proba)
+        labels_pred = np.argmax(proba, axis=1)
+        results.append({
+            'labels': [ICLABEL_LABELS[label] for label in labels_pred],
+            'y_pred_proba': proba[np.arange(len(labels_pred)), labels_pred],
+            'labels_pred_proba': proba,
+        })
+    return results
@@ -1,16 +1,138 @@
 import json
 import os
+import sqlite3
 import numpy as np
 
+
+"""
+Preprocessing details per (subject, session, task).
+
+Two backends, chosen by the extension of the log path:
+    .json: the whole cohort in one JSON file, read on construction and
+           rewritten by save_preprocessing_details (used by preprocessing.py)
+    .db / .sqlite: an SQLite database with one row per (subject, session, task, key).
+           Every log_detail is written immediately, save_preprocessing_details
+           writes all the details of the recording in one transaction, and many
+           processes can write at the same time. Only the details of the recording
+           are read on construction.
+
+migrate_json_to_sqlite copies an existing JSON log into a database.
+"""
+
+SQLITE_EXTENSIONS = ['.db', '.sqlite', '.sqlite3']
+
+
+def is_sqlite_path(path):
+    return os.path.splitext(path)[1].lower() in SQLITE_EXTENSIONS
+
+
+def convert_to_serializable(obj):
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.integer):
+        return int(obj)
+    if isinstance(obj, np.floating):
+        return float(obj)
+    if isinstance(obj, np.bool_):
+        return bool(obj)
+    if isinstance(obj, tuple):
+        return [convert_to_serializable(i) for i in obj]
+    if isinstance(obj, dict):
+        return {k: convert_to_serializable(v) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [convert_to_serializable(i) for i in obj]
+    return obj
+
+
+class SQLiteLogStore:
+    def __init__(self, db_path, timeout=60):
+        # timeout: seconds to wait for the other processes writing at the same time
+        self.db_path = db_path
+        self.connection = sqlite3.connect(db_path, timeout=timeout)
+        # readers do not block the writer (the database must be on a local file system)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        with self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS details ('
+                'subject TEXT, session TEXT, task TEXT, key TEXT, value TEXT, '
+                'PRIMARY KEY (subject, session, task, key))')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS details_key ON details (key)')
+
+    def upsert(self, subject, session, task, details):
+        # Insert or replace the details (dict) of one recording in a single transaction
+        rows = [(subject, session, task, key, json.dumps(convert_to_serializable(value)))
+                for key, value in details.items()]
+        with self.connection:
+            self.connection.executemany(
+                'INSERT INTO details (subject, session, task, key, value) VALUES (?, ?, ?, ?, ?) '
+                'ON CONFLICT (subject, session, task, key) DO UPDATE SET value = excluded.value', rows)
+
+    def get(self, subject, session, task):
+        cursor = self.connection.execute('SELECT key, value FROM details WHERE subject = ? AND session = ? '
+                                         'AND task = ?', (subject, session, task))
+        return {key: json.loads(value) for key, value in cursor}
+
+    def query(self, key):
+        # {(subject, session, task): value} of one detail for every recording
+        cursor = self.connection.execute('SELECT subject, session, task, value FROM details WHERE key = ?', (key,))
+        return {(subject, session, task): json.loads(value) for subject, session, task, value in cursor}
+
+    def to_dict(self):
+        # Every detail nested as in the JSON log: {subject: {session: {task: {key: value}}}}
+        logs = {}
+        cursor = self.connection.execute('SELECT subject, session, task, key, value FROM details '
+                                         'ORDER BY subject, session, task')
+        for subject, session, task, key, value in cursor:
+            logs.setdefault(subject, {}).setdefault(session, {}).setdefault(task, {})[key] = json.loads(value)
+        return logs
+
+    def close(self):
+        self.connection.close()
+
+
+def migrate_json_to_sqlite(json_path, db_path):
+    # Copy every recording of a JSON log into the database, returns the number of recordings
+    with open(json_path, 'r') as f:
+        logs = json.load(f)
+    store = SQLiteLogStore(db_path)
+    n_recordings = 0
+    for subject, sessions in logs.items():
+        for session, tasks in sessions.items():
+            for task, details in tasks.items():
+                store.upsert(subject, session, task, details)
+                n_recordings += 1
+    store.close()
+    return n_recordings
+
+
+def query_log(json_path, key):
+    # {(subject, session, task): value} of one detail for every recording of a JSON or SQLite log
+    if is_sqlite_path(json_path):
+        store = SQLiteLogStore(json_path)
+        values = store.query(key)
+        store.close()
+        return values
+    if not os.path.exists(json_path):
+        return {}
+    with open(json_path, 'r') as f:
+        logs = json.load(f)
+    return {(subject, session, task): details[key]
+            for subject, sessions in logs.items() for session, tasks in sessions.items()
+            for task, details in tasks.items() if key in details}
+
+
 class LogPreprocessingDetails:
     def __init__(self, json_path, subject, session, task):
         self.json_path = json_path
         self.subject = subject
         self.session = session
         self.task = task
+        self.store = SQLiteLogStore(json_path) if is_sqlite_path(json_path) else None
         self.logs = self.load_preprocessing_details()
 
     def load_preprocessing_details(self):
+        if self.store is not None:
+            return {self.subject: {self.session: {self.task: self.store.get(self.subject, self.session, self.task)}}}
         if os.path.exists(self.json_path):
             with open(self.json_path, 'r') as f:
                 return json.load(f)
@@ -18,26 +140,19 @@ class LogPreprocessingDetails:
             return {}
 
     def save_preprocessing_details(self):
-        def convert_to_serializable(obj):
-            if isinstance(obj, np.ndarray):
-                return obj.tolist()
-            if isinstance(obj, np.int64):
-                return int(obj)
-            if isinstance(obj, np.float64):
-                return float(obj)
-            if isinstance(obj, tuple):
-                return list(obj)
-            if isinstance(obj, dict):
-                return {k: convert_to_serializable(v) for k, v in obj.items()}
-            if isinstance(obj, list):
-                return [convert_to_serializable(i) for i in obj]
-            return obj
+        if self.store is not None:
+            self.store.upsert(self.subject, self.session, self.task, self.get_log())
+            return
 
         serializable_logs = convert_to_serializable(self.logs)
 
-        with open(self.json_path, 'w') as f:
+        # Write to a temporary file and move it in place so that a reader
+        # never sees a half written JSON file
+        tmp_path = f"{self.json_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
             json.dump(serializable_logs, f, indent=4)
-            
+        os.replace(tmp_path, self.json_path)
+
     def initialize_log_structure(self):
         if self.subject not in self.logs:
             self.logs[self.subject] = {}
@@ -51,7 +166,9 @@ class LogPreprocessingDetails:
         if isinstance(value, np.ndarray):
             value = value.tolist()  # Convert numpy arrays to lists
         self.logs[self.subject][self.session][self.task][key] = value
+        if self.store is not None:
+            self.store.upsert(self.subject, self.session, self.task, {key: value})
 
     def get_log(self):
         self.initialize_log_structure()
-        return self.logs[self.subject][self.session][self.task]
\ No newline at end of file
+        return self.logs[self.subject][self.session][self.task]
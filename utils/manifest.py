@@ -0,0 +1,217 @@
+import hashlib
+import json
+import os
+import time
+
+from utils.pipeline import (DEFAULT_PARAMS, get_bins, get_output_prefix, get_read_span, get_save_folder,
+                            get_windows)
+from utils.stage_cache import hash_file
+
+
+"""
+What has already been preprocessed, to re-run only new or changed recordings.
+
+The manifest, results/derivatives/manifest.json, has an entry per
+(condition, id, week) written when the recording is done: the size,
+modification time and hash of the raw file, the hash of the manual decisions
+file, the parameters of every stage, the version of the pipeline code and the
+output files.
+
+plan_runs compares the raw tree to it and gives for every recording its status
+and the stages to run:
+
+    new             not in the manifest: every stage
+    raw_changed     other raw file content: every stage
+    code_changed    other pipeline code: every stage (the cached stages are not
+                    valid anymore, run_preprocessing.py invalidates them)
+    params_changed  from the first stage whose parameters changed
+    manual_changed  other manual decisions: from the bad channels
+    outputs_missing an output file was removed: the windows (the stages are cached)
+    up_to_date      nothing
+
+The raw files are only hashed when their size or modification time changed,
+so a plan over the cohort costs a stat per recording plus the hash of the new
+data. With run_preprocessing.py --incremental only the recordings that are not
+up to date run, and the stages before the first changed one come from the
+stage cache (utils/stage_cache.py).
+"""
+
+MANIFEST_FILE = 'manifest.json'
+
+# The parameters of every stage (DEFAULT_PARAMS keys), in the order of the pipeline
+STAGE_PARAMS = {
+    'read': ['read_padding'],
+    'filter': ['hpass', 'lpass'],
+    'bad_channels': ['ransac', 'ransac_margin'],
+    'epochs': ['duration_epochs', 'precision', 'streaming', 'streaming_memmap'],
+    'autoreject': ['folds', 'autoreject_mode', 'autoreject_scope', 'autoreject_fit_epochs'],
+    'ica': ['n_components', 'method', 'max_iter', 'ica_decim', 'ica_fit_epochs'],
+    'ica_selection': ['muscle_threshold', 'ica_rules', 'manual_ica_match'],
+    'windows': ['t_min_baseline', 't_max_baseline', 't_0_dosis', 't_max_dosis', 'windows', 'window_bins',
+                'binned_windows', 'derivative_format', 'derivative_compression'],
+    'spectral': ['spectral_features', 'spectral_method', 'spectral_format', 'spectral_psd'],
+    'report': ['report'],
+}
+STAGES = list(STAGE_PARAMS)
+
+# Modules whose code changes the outputs of the pipeline
+PIPELINE_MODULES = ['pipeline.py', 'preprocessing_helpers.py', 'ReadRawAkonic.py', 'streaming.py', 'bad_channels.py',
+                    'autoreject_models.py', 'ica_scoring.py', 'iclabel_batch.py', 'manual_decisions.py',
+                    'spectral_features.py', 'epochs_store.py']
+
+PLAN_STATUSES = ['new', 'raw_changed', 'code_changed', 'params_changed', 'manual_changed', 'outputs_missing',
+                 'up_to_date']
+
+
+def get_manifest_path(root_path):
+    return os.path.join(root_path, 'derivatives', MANIFEST_FILE)
+
+
+def code_version(modules=PIPELINE_MODULES):
+    # Hash of the source of the pipeline modules
+    sha1 = hashlib.sha1()
+    folder = os.path.dirname(os.path.abspath(__file__))
+    for module in sorted(modules):
+        with open(os.path.join(folder, module), 'rb') as f:
+            sha1.update(module.encode() + f.read())
+    return sha1.hexdigest()[:16]
+
+
+def stage_params(p):
+    # {stage: {param: value}} of the parameters p (completed with DEFAULT_PARAMS), as stored in the manifest
+    p = dict(DEFAULT_PARAMS, **(p or {}))
+    stages = {stage: {name: p[name] for name in names} for stage, names in STAGE_PARAMS.items()}
+    # random_state is used by every stage from the bad channels on
+    stages['bad_channels']['random_state'] = p['random_state']
+    # the windows set the part of the recording that is read
+    stages['read']['read_span'] = get_read_span(p)
+    return json.loads(json.dumps(stages, default=str))
+
+
+def output_files(root_path, condition, id, week, p):
+    # The files written for the recording with the parameters p
+    p = dict(DEFAULT_PARAMS, **(p or {}))
+    save_folder = get_save_folder(root_path, condition, id)
+    prefix = get_output_prefix(id, week)
+    files = []
+    if p['derivative_format'] != 'fif':
+        files.append(os.path.join(save_folder, f'{prefix}-prepro_eeg.h5'))
+    if p['derivative_format'] != 'hdf5':
+        names = ['rereferenced_eeg'] + [f'{name}-prepro_eeg' for name in get_windows(p)]
+        if p['window_bins'] is not None and get_bins(get_windows(p), p['window_bins'], p['binned_windows']):
+            names.append('bins-prepro_eeg')
+        files += [os.path.join(save_folder, f'{prefix}-{name}.fif') for name in names]
+    if p['spectral_features']:
+        extension = '.parquet' if p['spectral_format'] == 'parquet' else '.h5'
+        files.append(os.path.join(save_folder, f'{prefix}-spectral{extension}'))
+    if p['report'] != 'none':
+        files.append(os.path.join(save_folder, f'{prefix}-report.html'))
+    return files
+
+
+def manual_file_hash(root_path, condition, id, week):
+    # Hash of the manual decisions of the recording, None without the file
+    path = os.path.join(get_save_folder(root_path, condition, id), f'{get_output_prefix(id, week)}-manual.json')
+    return hash_file(path) if os.path.exists(path) else None
+
+
+def raw_fingerprint(raw_file, previous=None):
+    # Size, modification time and hash of the raw file. The hash of previous is reused when
+    # the size and the modification time did not change
+    stat = os.stat(raw_file)
+    fingerprint = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+    if previous is not None and all(previous.get(key) == value for key, value in fingerprint.items()):
+        fingerprint['hash'] = previous['hash']
+    else:
+        fingerprint['hash'] = hash_file(raw_file)
+    return fingerprint
+
+
+class Manifest:
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                self.entries = json.load(f)
+
+    @staticmethod
+    def key(condition, id, week):
+        return f'{condition}/{id}/{week}'
+
+    def get(self, condition, id, week):
+        return self.entries.get(self.key(condition, id, week))
+
+    def record(self, recording, params, root_path, raw=None, version=None):
+        # Entry of a recording that was preprocessed with params. raw: its fingerprint if already computed
+        condition, id, week = recording['condition'], recording['id'], recording['week']
+        previous = self.get(condition, id, week)
+        self.entries[self.key(condition, id, week)] = {
+            'raw_file': recording['raw_file'],
+            'raw': raw or raw_fingerprint(recording['raw_file'], previous and previous['raw']),
+            'manual': manual_file_hash(root_path, condition, id, week),
+            'params': stage_params(params),
+            'code_version': version or code_version(),
+            'outputs': output_files(root_path, condition, id, week, params),
+            'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+        }
+        self.save()
+
+    def remove(self, condition, id, week):
+        self.entries.pop(self.key(condition, id, week), None)
+        self.save()
+
+    def save(self):
+        # written to a temporary file and moved in place, as the JSON log
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.entries, f, indent=4, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+
+def plan_recording(entry, recording, params, root_path, version):
+    # Status, stages to run, reason and raw fingerprint of one recording against its manifest entry
+    condition, id, week = recording['condition'], recording['id'], recording['week']
+    raw = raw_fingerprint(recording['raw_file'], entry and entry['raw'])
+    if entry is None:
+        return 'new', STAGES, 'not in the manifest', raw
+    if raw['hash'] != entry['raw']['hash']:
+        return 'raw_changed', STAGES, 'raw file content changed', raw
+    if version != entry['code_version']:
+        return 'code_changed', STAGES, f"code {entry['code_version']} -> {version}", raw
+    current = stage_params(params)
+    changed = [stage for stage in STAGES if current[stage] != entry['params'].get(stage)]
+    if changed:
+        first = STAGES.index(changed[0])
+        names = sorted(name for name, value in current[changed[0]].items()
+                       if entry['params'].get(changed[0], {}).get(name) != value)
+        return 'params_changed', STAGES[first:], f"{changed[0]}: {', '.join(names)}", raw
+    if manual_file_hash(root_path, condition, id, week) != entry['manual']:
+        return 'manual_changed', STAGES[STAGES.index('bad_channels'):], 'manual decisions changed', raw
+    missing = [path for path in entry['outputs'] if not os.path.exists(path)]
+    if missing:
+        return ('outputs_missing', STAGES[STAGES.index('windows'):],
+                f'{len(missing)} missing, e.g. {os.path.basename(missing[0])}', raw)
+    return 'up_to_date', [], '', raw
+
+
+def plan_runs(recordings, manifest, params=None, root_path='results'):
+    """The plan of every recording (of utils.pipeline.find_raw_files) with the parameters params:
+    a list of dicts with the recording, its status, the stages to run, the reason and the raw fingerprint."""
+    version = code_version()
+    plan = []
+    for recording in recordings:
+        entry = manifest.get(recording['condition'], recording['id'], recording['week'])
+        status, stages, reason, raw = plan_recording(entry, recording, params, root_path, version)
+        plan.append({'recording': recording, 'status': status, 'stages': stages, 'reason': reason, 'raw': raw})
+    return plan
+
+
+def plan_to_frame(plan):
+    import pandas as pd
+
+    return pd.DataFrame([{'condition': item['recording']['condition'], 'id': item['recording']['id'],
+                          'week': item['recording']['week'], 'status': item['status'],
+                          'first_stage': item['stages'][0] if item['stages'] else '', 'reason': item['reason']}
+                         for item in plan], columns=['condition', 'id', 'week', 'status', 'first_stage', 'reason'])
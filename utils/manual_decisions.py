@@ -0,0 +1,166 @@
+import json
+import os
+import numpy as np
+
+
+"""
+Decisions taken by hand in preprocessing.py, stored next to the outputs so that
+a non-interactive run re-applies them (manual='replay'):
+
+    <prefix>-manual.json
+    {
+        'bad_channels': {'channels': [...], 'raw_key': hash of the raw file},
+        'manual_reject_epochs': {'onsets': [s, ...]},
+        'ica_components': {'exclude': [...], 'ica_key': ..., 'ch_names': [...],
+                           'fingerprints': [unit norm topography of each excluded component]},
+        'manual_reject_epochs_after_ica': {'onsets': [s, ...]},
+    }
+
+Epochs are stored by their onset in the recording, not by their index, so a
+change of the read span or of AutoReject does not move them. A decision is stale
+when what it was taken on has changed:
+    bad channels: the raw file changed
+    epochs: an onset is not the onset of an epoch anymore (e.g. other epoch duration),
+            the other epochs are still dropped
+    ICA: the ICA was refitted and an excluded component has no component of the new
+         ICA with the same topography (|correlation| >= ica_match)
+Stale decisions are not applied and are reported by the replay functions, the
+pipeline then takes the automatic decision.
+
+Without the file the decisions taken by hand are read from the preprocessing
+log (decisions_from_log). They are indices only: the ICA components are stale
+as soon as the ICA was refitted (other ica_key).
+"""
+
+DECISIONS = ['bad_channels', 'manual_reject_epochs', 'ica_components', 'manual_reject_epochs_after_ica']
+
+
+def get_decisions_file(save_folder, prefix):
+    return os.path.join(save_folder, f'{prefix}-manual.json')
+
+
+def load_decisions(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def save_decisions(path, decisions):
+    # written to a temporary file and moved in place, as the JSON log
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(decisions, f, indent=4)
+    os.replace(tmp_path, path)
+
+
+def decisions_from_log(saved):
+    # Decisions of a preprocessing log without sidecar (indices only). Only the decisions taken by hand:
+    # every decision of an interactive run (preprocessing.py does not log manual_mode) and, for the log
+    # of a replay run, the ones it re-applied as they were (manual_replayed). The automatic decisions of
+    # a replay or skip run are not replayed
+    mode = saved.get('manual_mode', 'interactive')
+    names = DECISIONS if mode == 'interactive' else saved.get('manual_replayed', [])
+    decisions = {}
+    if 'bad_channels' in saved and 'bad_channels' in names:
+        decisions['bad_channels'] = {'channels': saved['bad_channels']}
+    for name in ['manual_reject_epochs', 'manual_reject_epochs_after_ica']:
+        if saved.get(name) and name in names:
+            decisions[name] = {'indices': saved[name]}
+    if 'ica_components' in saved and 'ica_components' in names:
+        decisions['ica_components'] = {'exclude': saved['ica_components']}
+        # the components are only valid for the ICA they were chosen on
+        if saved.get('ica_key') is not None:
+            decisions['ica_components']['ica_key'] = saved['ica_key']
+    return decisions
+
+
+##################################
+#######      RECORDING     #######
+##################################
+def record_bad_channels(decisions, bads, raw_key):
+    decisions['bad_channels'] = {'channels': list(bads), 'raw_key': raw_key}
+
+
+def record_epochs(decisions, name, epochs, dropped):
+    # dropped: positions in the drop log of epochs (the epochs before AutoReject, one per onset)
+    onsets = epochs.events[np.isin(epochs.selection, dropped), 0] / epochs.info['sfreq']
+    decisions[name] = {'onsets': onsets.tolist()}
+
+
+def _fingerprints(ica, components):
+    # Unit norm topography (mixing pattern on the channels) of the components
+    topographies = ica.get_components()[:, components]
+    return (topographies / np.linalg.norm(topographies, axis=0)).T
+
+
+def record_ica(decisions, ica, ica_key):
+    decisions['ica_components'] = {'exclude': [int(idx) for idx in ica.exclude], 'ica_key': ica_key,
+                                   'ch_names': list(ica.ch_names),
+                                   'fingerprints': _fingerprints(ica, list(ica.exclude)).tolist()}
+
+
+##################################
+#######       REPLAY       #######
+##################################
+# Every replay function returns (decision or None when there is no usable decision, stale reason or None)
+def replay_bad_channels(decisions, raw_key):
+    decision = decisions.get('bad_channels')
+    if decision is None:
+        return None, None
+    if decision.get('raw_key') not in (None, raw_key):
+        return None, 'the raw file changed'
+    return list(decision['channels']), None
+
+
+def replay_epochs(decisions, name, epochs):
+    # Positions in the drop log of epochs (the epochs before AutoReject) of the dropped epochs
+    decision = decisions.get(name)
+    if decision is None:
+        return [], None
+    if 'indices' in decision:
+        return [int(idx) for idx in decision['indices']], None
+    sfreq = epochs.info['sfreq']
+    samples = np.round(np.asarray(decision['onsets'], dtype=float) * sfreq).astype(int)
+    found = np.isin(samples, epochs.events[:, 0])
+    positions = epochs.selection[np.isin(epochs.events[:, 0], samples)].tolist()
+    if not found.all():
+        return positions, f'no epoch starts at {(samples[~found] / sfreq).tolist()} s'
+    return positions, None
+
+
+def match_components(fingerprints, ch_names, ica, threshold):
+    # Component of ica with the same topography as each fingerprint (None when |r| < threshold
+    # or when two fingerprints match the same component)
+    common = [ch for ch in ch_names if ch in ica.ch_names]
+    saved = np.asarray(fingerprints)[:, [ch_names.index(ch) for ch in common]]
+    components = ica.get_components()[[ica.ch_names.index(ch) for ch in common]]
+    # correlation of the topographies, the sign of an ICA component is arbitrary
+    saved = saved - saved.mean(axis=1, keepdims=True)
+    components = components - components.mean(axis=0, keepdims=True)
+    corr = np.abs(saved @ components) / np.outer(np.linalg.norm(saved, axis=1), np.linalg.norm(components, axis=0))
+    best = corr.argmax(axis=1)
+    matches = [int(idx) if corr[i, idx] >= threshold else None for i, idx in enumerate(best)]
+    if len({idx for idx in matches if idx is not None}) < len([idx for idx in matches if idx is not None]):
+        return [None] * len(matches), corr.max(axis=1)
+    return matches, corr.max(axis=1)
+
+
+def replay_ica(decisions, ica, ica_key, threshold=0.9):
+    # Components to exclude from ica
+    decision = decisions.get('ica_components')
+    if decision is None:
+        return None, None
+    if 'ica_key' not in decision or decision['ica_key'] == ica_key:
+        return [int(idx) for idx in decision['exclude']], None
+    if 'fingerprints' not in decision:
+        # components of the log: indices only, they cannot be matched to the refitted ICA
+        return None, f"the ICA changed (ica_key {decision['ica_key']} -> {ica_key}), the logged components " \
+                     f"{decision['exclude']} cannot be matched"
+    if not decision['exclude']:
+        return [], None
+    matches, corr = match_components(decision['fingerprints'], decision['ch_names'], ica, threshold)
+    if None in matches:
+        unmatched = [idx for idx, match in zip(decision['exclude'], matches) if match is None]
+        return None, f'the ICA changed, components {unmatched} have no match (|r| {np.round(corr, 2).tolist()})'
+    return matches, None
@@ -0,0 +1,343 @@
+import json
+import os
+import socket
+import time
+import numpy as np
+
+import mne
+
+from scipy.signal import butter, iirnotch, lfilter, sosfilt, sosfilt_zi, tf2sos
+
+import utils.preprocessing_helpers as preprocessing_helpers
+from utils.autoreject_models import get_model_files
+from utils.pipeline import save_epochs
+from utils.streaming import filter_picks, get_filters
+
+
+"""
+Online preprocessing of a recording while it is acquired, to watch the signal
+quality during the dosis.
+
+A sample stream (an EDF file being written, tail_edf, or a socket, socket_stream)
+is filtered causally with a state kept between chunks, cut in the epochs of the
+pipeline and cleaned with a frozen model of a prior session of the subject
+(load_online_model): the AutoReject thresholds, consensus and n_interpolate,
+the fitted ICA with its excluded components and the bad channels.
+
+    model = load_online_model(save_folder, '022_1', log)
+    online = OnlinePreprocessor(edf_stream_info(path), model)
+    for chunk in tail_edf(path):
+        for epoch in online.push(chunk):
+            epoch['onset'], epoch['data'], epoch['flags']
+
+Filters:
+    'fir': the FIR filters of the offline pipeline (notch + band-pass, see
+           utils/streaming.get_filters) applied causally. They have a linear phase,
+           so the epochs are the offline epochs delayed by half the filter length
+           (about 5 s at 256 Hz), except the first ones ('settling')
+    'iir': Butterworth band-pass (order 4) and notch filters, no delay but the
+           phase of the signal is distorted
+The latency of an epoch is the filter delay plus the epoch duration (online.latency).
+
+The cost of an epoch does not depend on how long the stream has run: the ICA,
+the interpolation of the bad channels and the average reference are one affine
+map computed once, the per-epoch AutoReject interpolation a matrix cached for
+every set of interpolated channels. Unlike AutoReject, the channels of an epoch
+are interpolated from the channels that are not bad for the whole recording.
+The rejected epochs are emitted too, with flags['rejected'].
+"""
+
+FILTERS = ['fir', 'iir']
+
+# peak to peak below which a channel is flagged as flat (V)
+FLAT_THRESHOLD = 1e-7
+
+
+def load_online_model(save_folder, prefix, log):
+    # Frozen model of a preprocessed recording: its stored AutoReject model, its ICA with the
+    # components excluded in log (the preprocessing details of the recording) and its bad channels
+    _, json_file = get_model_files(save_folder, prefix)
+    with open(json_file, 'r') as f:
+        autoreject = json.load(f)
+    ica = mne.preprocessing.read_ica(os.path.join(save_folder, f'{prefix}-ica.fif'), verbose=False)
+    ica.exclude = [int(idx) for idx in log.get('ica_components', [])]
+    return {
+        'autoreject': autoreject,
+        'ica': ica,
+        'bads': list(log.get('bad_channels', [])),
+        'hpass': log.get('hpass_filter', 1),
+        'lpass': log.get('lpass_filter', 45),
+        'duration_epochs': log.get('duration_epochs', 2.0),
+        'source': prefix,
+    }
+
+
+def _linear_map(info, apply, scale=1e-5):
+    # (A, b) such that apply(raw) = A @ data + b for any data of the channels of info,
+    # apply being an affine MNE operation (ICA, interpolation, reference) on a Raw
+    n_channels = len(info['ch_names'])
+    basis = np.hstack([np.zeros((n_channels, 1)), scale * np.eye(n_channels)])
+    out = apply(mne.io.RawArray(basis, info.copy(), verbose=False)).get_data()
+    return (out[:, 1:] - out[:, :1]) / scale, out[:, 0]
+
+
+class CausalFilter:
+    # Notch + band-pass filter of the picked channels of consecutive chunks, the state of
+    # the filters is kept between chunks. The other channels are delayed by the same delay
+    def __init__(self, info, hpass, lpass, method='fir'):
+        if method not in FILTERS:
+            raise ValueError(f"method must be one of {FILTERS}, got {method}")
+        sfreq = info['sfreq']
+        self.method = method
+        self.picks = filter_picks(info)
+        self.others = np.setdiff1d(np.arange(len(info['ch_names'])), self.picks)
+        self.state = None
+        if method == 'fir':
+            # one kernel for the notch and the band-pass, linear phase
+            self.h = np.array([1.])
+            for h in get_filters(sfreq, hpass, lpass, info['line_freq']):
+                self.h = np.convolve(self.h, h)
+            self.delay = (len(self.h) - 1) // 2
+            # the epochs are emitted delay samples late: from delay samples on, the filtered
+            # samples only depend on samples of the stream
+            self.settling = self.delay
+        else:
+            self.sos = butter(4, [hpass, lpass], btype='bandpass', fs=sfreq, output='sos')
+            if info['line_freq'] is not None:
+                self.sos = np.vstack([tf2sos(*iirnotch(info['line_freq'], 30, fs=sfreq)), self.sos])
+            self.delay = 0
+            # about 3 time constants of the high-pass
+            self.settling = int(3 * sfreq / hpass)
+        self._other_state = np.zeros((len(self.others), self.delay))
+
+    def process(self, chunk):
+        out = np.empty_like(chunk, dtype=np.float64)
+        data = chunk[self.picks]
+        if self.method == 'fir':
+            if self.state is None:
+                self.state = np.zeros((len(self.picks), len(self.h) - 1))
+            out[self.picks], self.state = lfilter(self.h, 1., data, axis=-1, zi=self.state)
+        else:
+            if self.state is None:
+                # start from the steady state of the first sample
+                self.state = sosfilt_zi(self.sos)[:, None, :] * data[:, 0][None, :, None]
+            out[self.picks], self.state = sosfilt(self.sos, data, axis=-1, zi=self.state)
+        if len(self.others):
+            delayed = np.concatenate([self._other_state, chunk[self.others]], axis=1)
+            out[self.others] = delayed[:, :chunk.shape[1]]
+            self._other_state = delayed[:, chunk.shape[1]:]
+        return out
+
+
+class OnlinePreprocessor:
+    """Filter, epoch and clean a stream of samples with a frozen model.
+
+    info: measurement info of the stream (channel names, types, positions, sfreq,
+    line_freq), e.g. AKONIC_LAYOUT.info(ch_names, sfreq).
+    model: see load_online_model. push(chunk) takes the next (n_channels, n_times)
+    samples in V and returns the epochs completed by them, as {'onset': s, 'data':
+    (n_channels, n_samples) cleaned, 'flags': {...}}, the onset being the time in the
+    recording (first_samp is the sample of the recording the stream starts at).
+    """
+
+    def __init__(self, info, model, filter='fir', first_samp=0, max_cached=1024):
+        self.info = info
+        self.sfreq = info['sfreq']
+        self.first_samp = first_samp
+        self.n_samples = int(np.round(self.sfreq * model['duration_epochs']))
+        self.filter = CausalFilter(info, model['hpass'], model['lpass'], filter)
+        self.latency = (self.filter.delay + self.n_samples) / self.sfreq
+
+        ch_names = info['ch_names']
+        autoreject = model['autoreject']
+        missing = [ch for ch in list(autoreject['thresholds']) + model['ica'].ch_names + model['bads']
+                   if ch not in ch_names]
+        if missing:
+            raise ValueError(f"The model of {model['source']} has channels that are not in the stream: {missing}")
+        self.bads = list(model['bads'])
+        self.ar_picks = np.array([ch_names.index(ch) for ch in autoreject['thresholds']])
+        self.thresholds = np.array(list(autoreject['thresholds'].values()))
+        self.consensus = autoreject['consensus']['eeg'] * len(self.ar_picks)
+        self.n_interpolate = autoreject['n_interpolate']['eeg']
+        self.eeg_picks = mne.pick_types(info, eeg=True, exclude=self.bads)
+
+        # ICA, interpolation of the bad channels and average reference: cleaned = W @ data + c
+        info = info.copy()
+        info['bads'] = []
+        ica = model['ica']
+        A, b = _linear_map(info, lambda raw: ica.apply(raw, verbose=False))
+        M = np.eye(len(ch_names))
+        if self.bads:
+            info['bads'] = self.bads
+            M, _ = _linear_map(info, lambda raw: raw.interpolate_bads(reset_bads=True, verbose=False))
+            info['bads'] = []
+        R, _ = _linear_map(info, lambda raw: mne.set_eeg_reference(raw, 'average', copy=False, verbose=False)[0])
+        self.W = R @ M @ A
+        self.c = (R @ M @ b)[:, None]
+
+        self._interpolation = {}
+        self.max_cached = max_cached
+        self._pending = np.empty((len(ch_names), 0))
+        self._n_filtered = 0
+        self.n_epochs = 0
+
+    def _epoch_interpolation(self, channels):
+        # rows of the channels interpolated from the channels that are good for the recording
+        if channels not in self._interpolation:
+            if len(self._interpolation) >= self.max_cached:
+                self._interpolation.pop(next(iter(self._interpolation)))
+            info = self.info.copy()
+            info['bads'] = self.bads + [self.info['ch_names'][idx] for idx in channels]
+            M, _ = _linear_map(info, lambda raw: raw.interpolate_bads(reset_bads=True, verbose=False))
+            self._interpolation[channels] = M[list(channels)]
+        return self._interpolation[channels]
+
+    def _clean(self, data, onset):
+        start = time.perf_counter()
+        ch_names = self.info['ch_names']
+        # AutoReject with the frozen thresholds: channels above their threshold, the epoch is
+        # rejected when they reach the consensus, the worst n_interpolate are interpolated
+        ptp = np.ptp(data[self.ar_picks], axis=-1)
+        bad = np.flatnonzero(ptp > self.thresholds)
+        rejected = len(bad) >= self.consensus
+        interpolated = bad[np.argsort(ptp[bad])[::-1][:self.n_interpolate]]
+        interpolated = tuple(sorted(self.ar_picks[interpolated].tolist()))
+        if interpolated:
+            data = data.copy()
+            data[list(interpolated)] = self._epoch_interpolation(interpolated) @ data
+        cleaned = self.W @ data + self.c
+        eeg_ptp = np.ptp(data[self.eeg_picks], axis=-1)
+        flags = {
+            'settling': onset * self.sfreq < self.filter.settling,
+            'rejected': bool(rejected),
+            'bad_channels': [ch_names[idx] for idx in self.ar_picks[bad]],
+            'interpolated': [ch_names[idx] for idx in interpolated],
+            'flat_channels': [ch_names[idx] for idx in self.eeg_picks[eeg_ptp < FLAT_THRESHOLD]],
+            'ptp_max': float(eeg_ptp.max()),
+            'processing_time': time.perf_counter() - start,
+        }
+        return {'onset': self.first_samp / self.sfreq + onset, 'data': cleaned, 'flags': flags}
+
+    def push(self, chunk):
+        filtered = self.filter.process(np.asarray(chunk, dtype=np.float64))
+        # the first delay filtered samples are before the first sample of the stream
+        skip = max(self.filter.delay - self._n_filtered, 0)
+        self._n_filtered += filtered.shape[1]
+        if skip:
+            filtered = filtered[:, skip:]
+        self._pending = np.concatenate([self._pending, filtered], axis=1)
+
+        epochs = []
+        n_ready = self._pending.shape[1] // self.n_samples
+        for n in range(n_ready):
+            onset = self.n_epochs * self.n_samples / self.sfreq
+            data = self._pending[:, n * self.n_samples:(n + 1) * self.n_samples]
+            epochs.append(self._clean(data, onset))
+            self.n_epochs += 1
+        self._pending = self._pending[:, n_ready * self.n_samples:].copy()
+        return epochs
+
+
+class EpochsWriter:
+    """Save the epochs of OnlinePreprocessor as they arrive, max_epochs per file.
+
+    Only the epochs of the file being filled are kept in memory: every max_epochs
+    epochs (10 minutes of 2 s epochs by default) they are saved to a part of path,
+    <path without -epo.fif>-001-epo.fif, -002-epo.fif, ... (mne.concatenate_epochs
+    joins them). close() saves the last part and returns the files written.
+    """
+
+    def __init__(self, path, info, max_epochs=300):
+        if max_epochs < 1:
+            raise ValueError(f"max_epochs must be at least 1, got {max_epochs}")
+        self.stem = path[:-len('-epo.fif')] if path.endswith('-epo.fif') else os.path.splitext(path)[0]
+        self.info = info
+        self.max_epochs = max_epochs
+        self.files = []
+        self._epochs = []
+
+    def add(self, epoch):
+        self._epochs.append(epoch)
+        if len(self._epochs) >= self.max_epochs:
+            self._flush()
+
+    def close(self):
+        self._flush()
+        return self.files
+
+    def _flush(self):
+        if not self._epochs:
+            return
+        sfreq = self.info['sfreq']
+        events = np.array([[int(round(epoch['onset'] * sfreq)), 0, 1] for epoch in self._epochs])
+        epochs = mne.EpochsArray(np.stack([epoch['data'] for epoch in self._epochs]), self.info, events, tmin=0,
+                                 baseline=None, verbose=False)
+        path = f'{self.stem}-{len(self.files) + 1:03d}-epo.fif'
+        save_epochs(epochs, path)
+        self.files.append(path)
+        self._epochs = []
+
+
+##################################
+#########    SOURCES    ##########
+##################################
+def edf_stream_info(path, layout=preprocessing_helpers.AKONIC_LAYOUT):
+    # Info of the channels of layout in an EDF file being written (once its header is complete)
+    edf_header = preprocessing_helpers.read_edf_header(path)
+    picks = [i for i, ch in enumerate(edf_header['ch_names']) if ch in layout.channels]
+    preprocessing_helpers.check_channels(path, edf_header['ch_names'], layout.channels)
+    sfreq = edf_header['n_samples'][picks[0]] / edf_header['record_duration']
+    return layout.info([edf_header['ch_names'][pick] for pick in picks], sfreq)
+
+
+def tail_edf(path, layout=preprocessing_helpers.AKONIC_LAYOUT, poll=0.1, timeout=10.):
+    # (n_channels, n_times) chunks of the channels of layout of an EDF file, as its data records
+    # are written. Stops when no record was added for timeout seconds
+    channels = layout.channels
+    start = 0
+    last_update = time.monotonic()
+    while True:
+        edf_header = preprocessing_helpers.read_edf_header(path)
+        n_times = edf_header['n_records'] * int(edf_header['n_samples'][0])
+        if n_times > start:
+            data, _, _ = preprocessing_helpers.read_edf_data(path, channels, np.float64, edf_header, start, n_times)
+            start = n_times
+            last_update = time.monotonic()
+            yield data
+        elif time.monotonic() - last_update >= timeout:
+            return
+        else:
+            time.sleep(poll)
+
+
+def socket_stream(host, port, n_channels, dtype='<f4'):
+    # (n_channels, n_times) chunks of the samples received on a TCP socket, every sample being
+    # the n_channels values (V, little endian float32) one after the other. Stops when the sender closes
+    item_size = np.dtype(dtype).itemsize * n_channels
+    with socket.create_connection((host, port)) as connection:
+        buffer = b''
+        while True:
+            received = connection.recv(65536)
+            if not received:
+                return
+            buffer += received
+            n_times = len(buffer) // item_size
+            if n_times:
+                data = np.frombuffer(buffer[:n_times * item_size], dtype=dtype).reshape(n_times, n_channels)
+                buffer = buffer[n_times * item_size:]
+                yield data.T.astype(np.float64)
+
+
+def serve_edf(path, port, layout=preprocessing_helpers.AKONIC_LAYOUT, chunk_seconds=0.25, speed=1.):
+    # Stand-in for the amplifier: send the channels of layout of an EDF file to the first client
+    # of port, in the format of socket_stream, speed times faster than real time
+    raw = preprocessing_helpers.read_edf_akonic(path, layout=layout)
+    chunk = int(chunk_seconds * raw.info['sfreq'])
+    with socket.create_server(('localhost', port)) as server:
+        connection, _ = server.accept()
+        with connection:
+            start = time.monotonic()
+            for first in range(0, raw.n_times, chunk):
+                data = raw.get_data(start=first, stop=first + chunk)
+                connection.sendall(np.ascontiguousarray(data.T, dtype='<f4').tobytes())
+                time.sleep(max(0., start + (first + chunk) / raw.info['sfreq'] / speed - time.monotonic()))
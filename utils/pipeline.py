@@ -0,0 +1,878 @@
+import os
+import json
+from contextlib import contextmanager
+import numpy as np
+
+import mne
+
+import utils.preprocessing_helpers as preprocessing_helpers
+from utils.autoreject_models import find_model, get_model_params, run_autoreject, save_model
+from utils.log_preprocessing import LogPreprocessingDetails
+import utils.manual_decisions as manual_decisions
+from utils.profiling import StageProfiler
+from utils.reporting import PreprocessingReport
+from utils.stage_cache import RAW_HASHES, StageCache, file_hash
+
+
+"""
+Non-interactive version of preprocessing.py.
+Every step of the script is a function so that the full chain can run
+for one recording without a human in front of the screen:
+read -> notch/bandpass -> NoisyChannels -> epochs -> AutoReject ->
+ICA/ICLabel -> interpolate -> average reference -> baseline/dosis crop
+
+The manual inspection steps can be run in three modes:
+    'interactive': open the plots and block, exactly as in preprocessing.py
+    'replay': re-apply the decisions stored in the preprocessing log
+    'skip': keep only the automatic decisions
+
+The heavy dependencies (autoreject, pyprep, mne_icalabel with torch or
+onnxruntime, matplotlib) are imported by the stage that uses them, so a run
+that stops early or reads every stage from the cache does not import them.
+See benchmarks/bench_import.py.
+"""
+
+# Parameters used by preprocessing.py
+DEFAULT_PARAMS = {
+    'hpass': 1,
+    'lpass': 45,
+    'duration_epochs': 2.0,
+    'folds': 10,
+    'n_components': 15,
+    'method': 'picard',
+    'max_iter': 512,
+    'random_state': 42,
+    # ICA is fitted on every ica_decim-th sample (None for all) of all the epochs or of a random
+    # subsample (a fraction or a number of epochs), see benchmarks/bench_ica.py for the tradeoff
+    'ica_decim': None,
+    'ica_fit_epochs': None,
+    'muscle_threshold': 0.7,
+    # other rules of the exclusion of the ICA components (thresholds of the EOG and ECG scores,
+    # ICLabel labels), see utils/ica_scoring.DEFAULT_RULES
+    'ica_rules': {},
+    # RANSAC on every channel ('always', the bad channels of preprocessing.py), only on the channels
+    # the cheap PyPREP criteria cannot decide on ('auto', faster, but misses the channels that only
+    # RANSAC finds) or never ('never'), see utils/bad_channels.py
+    'ransac': 'always',
+    'ransac_margin': 0.75,
+    # 'fit' a new AutoReject, start from a stored model ('warm') or apply it as is ('fixed'),
+    # looking for it in this 'recording', the other weeks of the 'subject' or the whole 'condition',
+    # see utils/autoreject_models.py
+    'autoreject_mode': 'fit',
+    'autoreject_scope': 'subject',
+    # None fits AutoReject on every epoch, a fraction or a number of epochs fits on a random subsample
+    'autoreject_fit_epochs': None,
+    't_min_baseline': 60,
+    't_max_baseline': 60 + 5 * 60,
+    't_0_dosis': 700,
+    't_max_dosis': 700 + 18 * 60,
+    # Other windows {name: (tmin, tmax)} in seconds from the start of the recording, each written
+    # as <prefix>-<name>-prepro_eeg.fif like the baseline and the dosis
+    'windows': {},
+    # Length in seconds of the bins (e.g. 60 for per-minute dose-response curves) cut in the
+    # binned_windows, None for no bins. All the bins are written in <prefix>-bins-prepro_eeg.fif
+    # with the bin of every epoch in epochs.metadata['window']
+    'window_bins': None,
+    'binned_windows': ['baseline', 'dosis'],
+    # Band powers and aperiodic fit of every epoch and channel of the windows ('welch' or
+    # 'multitaper' PSD) written to <prefix>-spectral.parquet ('parquet') or .h5 ('hdf5'),
+    # see utils/spectral_features.py
+    'spectral_features': False,
+    'spectral_method': 'welch',
+    'spectral_format': 'parquet',
+    'spectral_psd': False,
+    # 'full' report as preprocessing.py, 'light' (summary plots only) or 'none', optionally
+    # rendered in a background thread after the recording is done, see utils/reporting.py
+    'report': 'full',
+    'report_deferred': False,
+    # a replayed ICA exclusion is matched to the components of a refitted ICA by the correlation
+    # of their topographies, see utils/manual_decisions.py
+    'manual_ica_match': 0.9,
+    # 'float32' keeps the epochs (and every copy made from them) in single precision, see set_precision
+    'precision': 'float64',
+    # peak memory (MB) above which a stage stops the recording with a MemoryError, None for no limit,
+    # see run_preprocessing.py --worker-memory-gb
+    'memory_budget_mb': None,
+    # With the bad channels replayed from the log, filter and epoch the recording in chunks read
+    # from the file instead of holding the raw, filtered and epoched copies (see utils/streaming.py),
+    # optionally into a memory mapped buffer
+    'streaming': False,
+    'streaming_memmap': False,
+    # None reads the full recording, a number of seconds reads only from the start of the
+    # baseline to the end of the dosis with that padding for the edge effects of the filters
+    'read_padding': None,
+    # 'fif' writes the rereferenced epochs and every window and the bins to FIF files, 'hdf5' writes the
+    # rereferenced epochs once to a compressed <prefix>-prepro_eeg.h5 with the windows and bins as views
+    # ('lzf', 'gzip' or None compression), 'both' writes both, see utils/epochs_store.py
+    'derivative_format': 'fif',
+    'derivative_compression': 'lzf',
+}
+
+MANUAL_MODES = ['interactive', 'replay', 'skip']
+
+PRECISIONS = ['float64', 'float32']
+
+DERIVATIVE_FORMATS = ['fif', 'hdf5', 'both']
+
+# ICLabel classes that can be excluded if pattern matching also flags them
+ARTIFACT_LABELS = ['muscle artifact', 'eye blink', 'heart beat', 'channel noise']
+
+
+##################################
+#########    FOLDERS    ##########
+##################################
+def get_raw_file(root_path, condition, id, week):
+    # results/raw/<condition>/<id>/<id>_<week>.EDF
+    return os.path.join(root_path, 'raw', condition, str(id), f"{id}_{str(week)}.EDF")
+
+
+def get_save_folder(root_path, condition, id):
+    # results/derivatives/<condition>/<id>
+    return os.path.join(root_path, 'derivatives', condition, str(id))
+
+
+def get_output_prefix(id, week):
+    # all the weeks of a subject share the same folder,
+    # so the week is part of the file name
+    return f"{id}_{str(week)}"
+
+
+def find_raw_files(root_path, conditions=None, subjects=None, weeks=None):
+    # Discover every results/raw/<condition>/<id>/<id>_<week>.EDF
+    raw_root = os.path.join(root_path, 'raw')
+    recordings = []
+    if not os.path.isdir(raw_root):
+        return recordings
+
+    for condition in sorted(os.listdir(raw_root)):
+        condition_folder = os.path.join(raw_root, condition)
+        if not os.path.isdir(condition_folder):
+            continue
+        if conditions is not None and condition not in conditions:
+            continue
+
+        for id in sorted(os.listdir(condition_folder)):
+            subject_folder = os.path.join(condition_folder, id)
+            if not os.path.isdir(subject_folder):
+                continue
+            if subjects is not None and id not in subjects:
+                continue
+
+            for filename in sorted(os.listdir(subject_folder)):
+                stem, ext = os.path.splitext(filename)
+                if ext.upper() != '.EDF' or not stem.startswith(f"{id}_"):
+                    continue
+                week = stem[len(id) + 1:]
+                if weeks is not None and week not in weeks:
+                    continue
+                recordings.append({
+                    'id': id,
+                    'week': week,
+                    'condition': condition,
+                    'raw_file': os.path.join(subject_folder, filename),
+                })
+
+    return recordings
+
+
+##################################
+######   MANUAL INSPECTION  ######
+##################################
+def _show_blocking():
+    # matplotlib is only needed when a human inspects the data
+    import matplotlib.pyplot as plt
+    plt.show(block=True)
+
+
+def _drop_saved_epochs(epochs, saved_epochs, reason='USER'):
+    # The log stores indices of the original epochs (positions in drop_log),
+    # map them to the positions of the epochs that are still kept
+    positions = np.flatnonzero(np.isin(epochs.selection, saved_epochs))
+    if len(positions):
+        epochs.drop(positions, reason=reason)
+    return epochs
+
+
+##################################
+#######   STAGE CHECKPOINTS  #####
+##################################
+# Writers and readers of the stage outputs stored by utils.stage_cache.StageCache.
+# Data is saved in double precision so that a cached run gives the same results.
+def _write_raw(folder, raw):
+    raw.save(os.path.join(folder, 'filtered_raw.fif'), fmt='double', verbose=False)
+
+
+def _read_raw(folder):
+    return mne.io.read_raw_fif(os.path.join(folder, 'filtered_raw.fif'), preload=True, verbose=False)
+
+
+def _write_bads(folder, bad_channels):
+    with open(os.path.join(folder, 'bad_channels.json'), 'w') as f:
+        json.dump(bad_channels, f)
+
+
+def _read_bads(folder):
+    with open(os.path.join(folder, 'bad_channels.json'), 'r') as f:
+        return json.load(f)
+
+
+@contextmanager
+def _as_float64(epochs):
+    # Epochs kept in float32 (precision='float32') in float64 for the time of a step that needs it
+    data = epochs._data
+    if data.dtype != np.float64:
+        epochs._data = data.astype(np.float64)
+    try:
+        yield epochs
+    finally:
+        epochs._data = data
+
+
+def save_epochs(epochs, path, fmt='single'):
+    # Epochs.save only accepts float64 data
+    with _as_float64(epochs):
+        epochs.save(path, fmt=fmt, overwrite=True, verbose=False)
+
+
+def _write_epochs(folder, epochs):
+    # epochs in float32 are saved in single precision
+    save_epochs(epochs, os.path.join(folder, 'epochs-epo.fif'),
+                fmt='single' if epochs._data.dtype == np.float32 else 'double')
+
+
+def _read_epochs(folder):
+    return mne.read_epochs(os.path.join(folder, 'epochs-epo.fif'), preload=True, verbose=False)
+
+
+def _write_autoreject(folder, result):
+    # Only the model: the clean epochs are the epochs stage transformed again, so that the
+    # cache does not hold a second copy of the epochs
+    epochs_clean, reject, ar, details = result
+    ar.save(os.path.join(folder, 'autoreject.h5'), overwrite=True)
+    with open(os.path.join(folder, 'autoreject_threshold.json'), 'w') as f:
+        json.dump({key: float(value) for key, value in reject.items()}, f)
+    with open(os.path.join(folder, 'autoreject_details.json'), 'w') as f:
+        json.dump(details, f)
+
+
+def _read_autoreject(folder, epochs):
+    from autoreject import read_auto_reject
+
+    ar = read_auto_reject(os.path.join(folder, 'autoreject.h5'))
+    # the fitted thresholds reject and interpolate the same epochs as in the run that cached them
+    with _as_float64(epochs):
+        epochs_clean = ar.transform(epochs)
+    with open(os.path.join(folder, 'autoreject_threshold.json'), 'r') as f:
+        reject = json.load(f)
+    with open(os.path.join(folder, 'autoreject_details.json'), 'r') as f:
+        details = json.load(f)
+    return epochs_clean, reject, ar, details
+
+
+def _write_ica(folder, ica):
+    ica.save(os.path.join(folder, 'ica.fif'), overwrite=True, verbose=False)
+
+
+def _read_ica(folder):
+    return mne.preprocessing.read_ica(os.path.join(folder, 'ica.fif'), verbose=False)
+
+
+def _save_ica(save_folder, prefix, ica, key, params):
+    # The fitted ICA is kept with the derivatives, with the hash of what it was fitted on
+    ica.save(os.path.join(save_folder, f'{prefix}-ica.fif'), overwrite=True, verbose=False)
+    with open(os.path.join(save_folder, f'{prefix}-ica.json'), 'w') as f:
+        json.dump({'key': key, 'params': params}, f)
+
+
+def _load_ica(save_folder, prefix, key):
+    # The saved ICA if it was fitted with the same parameters on the same epochs, otherwise None
+    json_file = os.path.join(save_folder, f'{prefix}-ica.json')
+    ica_file = os.path.join(save_folder, f'{prefix}-ica.fif')
+    if not (os.path.exists(json_file) and os.path.exists(ica_file)):
+        return None
+    with open(json_file, 'r') as f:
+        if json.load(f)['key'] != key:
+            return None
+    return mne.preprocessing.read_ica(ica_file, verbose=False)
+
+
+def _run_stage(cache, condition, id, week, stage, key, compute, writer, reader):
+    # Without a cache every stage is computed
+    if cache is None:
+        return compute()
+    return cache.cached(condition, id, str(week), stage, key, compute, writer, reader)
+
+
+##################################
+#########    STAGES     ##########
+##################################
+def read_raw(raw_file, tmin=None, tmax=None):
+    # Read the raw EEG data file with the channel names, types and montage (electrode positions)
+    # of the Akonic layout in one step, as read_edf_akonic + set_chs_montage
+    return preprocessing_helpers.read_edf_akonic(raw_file, tmin=tmin, tmax=tmax,
+                                                 layout=preprocessing_helpers.AKONIC_LAYOUT)
+
+
+def filter_raw(raw, hpass, lpass):
+    # notch filter to eliminate power line noise
+    raw_filtered = raw.copy().notch_filter(freqs=raw.info['line_freq'])
+    # band-pass filter to keep frequencies between hpass and lpass
+    raw_filtered.filter(l_freq=hpass, h_freq=lpass)
+    return raw_filtered
+
+
+def set_precision(epochs, precision):
+    # MNE reads, filters and creates Raw and Epochs in float64 only (RawArray, EpochsArray and
+    # filter_data upcast or refuse float32), so the data is converted once the epochs are made.
+    # The following stages keep the dtype of the epochs (drop, interpolation, ICA apply,
+    # rereference work in place or on copies). The ICA fit gives the same components in float32,
+    # AutoReject runs on a float64 copy (see autoreject_epochs).
+    if precision not in PRECISIONS:
+        raise ValueError(f"precision must be one of {PRECISIONS}, got {precision}")
+    epochs._data = epochs._data.astype(precision, copy=False)
+    return epochs
+
+
+def make_epochs(raw_filtered, duration_epochs):
+    # Segment the continuous data into non-overlapping epochs
+    return mne.make_fixed_length_epochs(raw_filtered, duration=duration_epochs, preload=True, verbose=False)
+
+
+def stream_epochs(raw_file, info, hpass, lpass, duration_epochs, tmin=None, tmax=None, buffer_file=None):
+    # Same epochs as make_epochs(filter_raw(read_raw(raw_file, tmin, tmax), hpass, lpass), duration_epochs)
+    # without holding the recording or its filtered copy in memory. info: measurement info with the bads
+    from utils.streaming import allocate_epochs, edf_source, filter_epochs_streaming, raw_source
+
+    try:
+        source = edf_source(raw_file, info, tmin, tmax)
+        source.get_data(0, 1)
+    except preprocessing_helpers.UnsupportedEDF:
+        # files the memory mapped EDF reader does not handle
+        source = raw_source(read_raw(raw_file, tmin, tmax))
+    out = None
+    if buffer_file is not None:
+        out = allocate_epochs(source.n_times, len(info['ch_names']), int(np.round(info['sfreq'] * duration_epochs)),
+                              buffer_file)
+    return filter_epochs_streaming(source, info, hpass, lpass, duration_epochs, out=out)
+
+
+def autoreject_epochs(epochs, folds, random_state, n_jobs=1, mode='fit', model=None, fit_epochs=None):
+    # Automatically reject bad epochs using AutoReject, fitted here or reused from a stored model.
+    # Run in double precision: the per-channel thresholds are taken from the peak-to-peak values
+    # of the epochs, in float32 other channels end up interpolated
+    with _as_float64(epochs):
+        return run_autoreject(epochs, folds, random_state, n_jobs, mode, model, fit_epochs)
+
+
+def check_ica_decim(decim, sfreq, lpass):
+    # Keeping every decim-th sample does not alias the data low-passed at lpass as long as
+    # sfreq / decim >= 2 * lpass (decim up to 2 for 256 Hz recordings low-passed at 45 Hz)
+    if decim is None or decim == 1:
+        return
+    max_decim = sfreq / (2 * lpass)
+    if int(decim) != decim or not 1 <= decim <= max_decim:
+        raise ValueError(f'ica_decim must be an integer from 1 to sfreq / (2 * lpass) = {max_decim:.2f} '
+                         f'({sfreq:g} Hz low-passed at {lpass:g} Hz), got {decim}')
+
+
+def fit_ica(epochs_clean, n_components, method, max_iter, random_state, decim=None, fit_epochs=None):
+    # Fit the ICA model to the cleaned epochs, or to a random subsample of them, keeping every decim-th sample
+    check_ica_decim(decim, epochs_clean.info['sfreq'], epochs_clean.info['lowpass'])
+    ica = mne.preprocessing.ICA(n_components=n_components, method=method, max_iter=max_iter,
+                                random_state=random_state)
+    ica.fit(preprocessing_helpers.subsample_epochs(epochs_clean, fit_epochs, random_state), decim=decim)
+    return ica
+
+
+def select_ica_components(ica, epochs_clean, muscle_threshold, ic_labels=None, rules=None):
+    # ic_labels: output of utils.iclabel_batch.label_components_batch when the components
+    # of several recordings were classified together, otherwise ICLabel runs here
+    # (requires pytorch or onnxruntime).
+    # The EOG (Fp1), ECG and muscle scores and the ICLabel probabilities are computed from one
+    # projection of the epochs on the components and the rules (see utils/ica_scoring.py) only
+    # exclude components found via pattern matching that ICLabel also tags as artifacts,
+    # plus every 'channel noise' component found by ICLabel
+    from utils.ica_scoring import decide, score_components, set_labels
+
+    scores = score_components(ica, epochs_clean, eog_ch='Fp1', ecg_ch='ECG', ic_labels=ic_labels)
+    table = decide(scores, {'muscle_threshold': muscle_threshold, 'confirm_labels': ARTIFACT_LABELS,
+                            **(rules or {})})
+    # as in preprocessing.py, the components found by each method are added to ica.labels_
+    set_labels(ica, table, eog_ch='Fp1', ecg_ch='ECG')
+
+    return table.index[table['exclude']].tolist(), table['label'].tolist(), table
+
+
+def interpolate(epochs_ica):
+    # Interpolate bad channels
+    return epochs_ica.copy().interpolate_bads()
+
+
+def rereference(epochs_interpolate):
+    # Rereference to the grand average
+    epochs_rereferenced, ref_data = mne.set_eeg_reference(inst=epochs_interpolate, ref_channels='average',
+                                                          copy=True)
+    return epochs_rereferenced
+
+
+def interpolate_and_rereference(epochs_ica):
+    return rereference(interpolate(epochs_ica))
+
+
+def get_read_span(p):
+    # Part of the recording that is read: from the start of the baseline to the end of the dosis
+    # plus the padding, starting on a multiple of the epoch duration so that the epochs
+    # have the same onsets as with the full recording
+    if p['read_padding'] is None:
+        return None, None
+    windows = list(get_windows(p).values())
+    window = (min(tmin for tmin, tmax in windows), max(tmax for tmin, tmax in windows))
+    return preprocessing_helpers.merge_windows([window], p['read_padding'], p['duration_epochs'])[0]
+
+
+def get_windows(p):
+    # Named windows {name: (tmin, tmax)} in seconds from the start of the recording
+    windows = {'baseline': (p['t_min_baseline'], p['t_max_baseline']),
+               'dosis': (p['t_0_dosis'], p['t_max_dosis'])}
+    windows.update({name: tuple(window) for name, window in p['windows'].items()})
+    return windows
+
+
+def get_bins(windows, bin_duration, names=None):
+    # Consecutive bins of bin_duration seconds of the windows (the last one can be shorter),
+    # named <window>-<index>: {'dosis-00': (700, 760), 'dosis-01': (760, 820), ...}
+    bins = {}
+    for name in (names if names is not None else windows):
+        tmin, tmax = windows[name]
+        starts = np.arange(tmin, tmax, bin_duration)
+        for i, start in enumerate(starts):
+            bins[f'{name}-{i:02d}'] = (float(start), float(min(start + bin_duration, tmax)))
+    return bins
+
+
+def window_indices(epochs, windows):
+    # Indices [start, stop) of the epochs with tmin <= onset < tmax for every window, by their onset
+    # in the recording: the epoch index is not time / duration once epochs are dropped or when only
+    # part of the recording is read
+    return onset_indices(epochs.events[:, 0] / epochs.info['sfreq'], windows)
+
+
+def onset_indices(onsets, windows):
+    # window_indices of the epochs with these onsets in seconds
+    if np.any(np.diff(onsets) < 0):
+        raise ValueError('The epochs are not sorted by onset')
+    bounds = np.array(list(windows.values()), dtype=float).reshape(-1, 2)
+    starts = np.searchsorted(onsets, bounds[:, 0], side='left')
+    stops = np.searchsorted(onsets, bounds[:, 1], side='left')
+    return {name: (start, stop) for name, start, stop in zip(windows, starts, stops)}
+
+
+def select_windows(epochs, windows):
+    # {name: epochs of the window}
+    return {name: epochs[start:stop] for name, (start, stop) in window_indices(epochs, windows).items()}
+
+
+def select_bins(epochs, bins):
+    # The epochs of every bin in a single Epochs, with the bin of each epoch in metadata['window']
+    import pandas as pd
+
+    indices = window_indices(epochs, bins)
+    names = [name for name, (start, stop) in indices.items() for _ in range(start, stop)]
+    selection = np.concatenate([np.arange(start, stop) for start, stop in indices.values()] + [np.array([], int)])
+    if len(np.unique(selection)) != len(selection):
+        raise ValueError('The bins overlap, an epoch can only be in one bin')
+    epochs_bins = epochs[selection]
+    epochs_bins.metadata = pd.DataFrame({'window': names,
+                                         'onset': epochs_bins.events[:, 0] / epochs.info['sfreq']})
+    return epochs_bins
+
+
+def crop_baseline_dosis(epochs_rereferenced, t_min_baseline, t_max_baseline, t_0_dosis, t_max_dosis):
+    windows = select_windows(epochs_rereferenced, {'baseline': (t_min_baseline, t_max_baseline),
+                                                   'dosis': (t_0_dosis, t_max_dosis)})
+    return windows['baseline'], windows['dosis']
+
+
+def write_windows(epochs_rereferenced, save_folder, prefix, p):
+    # Write every named window and the bins of the rereferenced epochs (in FIF files and/or as views of
+    # the store of derivative_format 'hdf5'), returns {name: number of epochs} of the windows and of the bins
+    p = dict(DEFAULT_PARAMS, **(p or {}))
+    windows = get_windows(p)
+    bins = get_bins(windows, p['window_bins'], p['binned_windows']) if p['window_bins'] is not None else None
+    n_epochs = {}
+    if p['derivative_format'] in ('hdf5', 'both'):
+        from utils.epochs_store import get_store_file, write_epochs_store
+
+        n_epochs = write_epochs_store(epochs_rereferenced, get_store_file(save_folder, prefix), windows, bins,
+                                      p['derivative_compression'])
+    if p['derivative_format'] in ('fif', 'both'):
+        n_epochs = write_fif_windows(epochs_rereferenced, save_folder, prefix, windows, bins)
+    return n_epochs
+
+
+def write_fif_windows(epochs_rereferenced, save_folder, prefix, windows, bins=None):
+    # Every window in <prefix>-<name>-prepro_eeg.fif and all the bins in <prefix>-bins-prepro_eeg.fif
+    n_epochs = {}
+    for name, epochs in select_windows(epochs_rereferenced, windows).items():
+        save_epochs(epochs, os.path.join(save_folder, f'{prefix}-{name}-prepro_eeg.fif'))
+        n_epochs[name] = len(epochs)
+    if bins is not None:
+        epochs_bins = select_bins(epochs_rereferenced, bins)
+        save_epochs(epochs_bins, os.path.join(save_folder, f'{prefix}-bins-prepro_eeg.fif'))
+        counts = epochs_bins.metadata['window'].value_counts()
+        n_epochs.update({name: int(counts.get(name, 0)) for name in bins})
+    return n_epochs
+
+
+def compute_window_psd(epochs_rereferenced, p):
+    # PSD of the rereferenced epochs shared by the spectral features and the report
+    from utils.spectral_features import compute_psd
+
+    return compute_psd(epochs_rereferenced, p['spectral_method'], p['hpass'], p['lpass'])
+
+
+def write_spectral_features(epochs_rereferenced, save_folder, prefix, p, id, week, condition, psd=None):
+    # Band powers and aperiodic fit of the windows, returns the file they are written to
+    from utils import spectral_features
+
+    p = dict(DEFAULT_PARAMS, **(p or {}))
+    windows = get_windows(p)
+    bins = get_bins(windows, p['window_bins'], p['binned_windows']) if p['window_bins'] is not None else None
+    table = spectral_features.spectral_features(epochs_rereferenced, windows, id, week, condition, bins=bins,
+                                                method=p['spectral_method'], fmin=p['hpass'], fmax=p['lpass'],
+                                                store_psd=p['spectral_psd'], psd=psd)
+    spectral_file = spectral_features.get_spectral_file(save_folder, prefix, p['spectral_format'])
+    spectral_features.write_spectral_features(table, spectral_file)
+    return spectral_file
+
+
+def write_windows_from_file(save_folder, prefix, p=None):
+    # Cut new windows or bins from <prefix>-rereferenced_eeg.fif of a preprocessed recording. With
+    # derivative_format 'hdf5' only their views are written to its store
+    p = dict(DEFAULT_PARAMS, **(p or {}))
+    if p['derivative_format'] == 'hdf5':
+        from utils.epochs_store import get_store_file, write_views
+
+        windows = get_windows(p)
+        bins = get_bins(windows, p['window_bins'], p['binned_windows']) if p['window_bins'] is not None else None
+        return write_views(get_store_file(save_folder, prefix), windows, bins)
+    epochs_rereferenced = mne.read_epochs(os.path.join(save_folder, f'{prefix}-rereferenced_eeg.fif'),
+                                          preload=True, verbose=False)
+    return write_windows(epochs_rereferenced, save_folder, prefix, p)
+
+
+##################################
+######   FULL PREPROCESSING  #####
+##################################
+def preprocess_subject(raw_file, id, week, condition, params=None, manual='replay',
+                       root_path='results', json_path='logs_preprocessing_details_all_subjects.db',
+                       n_jobs=1, cache=None, raw_hash=None):
+    """Run the full preprocessing chain of preprocessing.py for one recording.
+
+    The details are returned as a dict. With a JSON log they are only kept in
+    memory and the caller is in charge of writing them (see run_preprocessing.py),
+    with an SQLite log (.db) they are written as they are logged.
+    With a utils.stage_cache.StageCache the stages whose input and
+    parameters did not change are read from disk instead of recomputed.
+    raw_hash is the hash of raw_file when the caller already has it (the plan of
+    run_preprocessing.py --incremental), otherwise the one stored in
+    derivatives/raw_hashes.json is used and the file is only hashed when it changed.
+    """
+    if manual not in MANUAL_MODES:
+        raise ValueError(f"manual must be one of {MANUAL_MODES}, got {manual}")
+    p = dict(DEFAULT_PARAMS)
+    if params is not None:
+        p.update(params)
+    if p['derivative_format'] not in DERIVATIVE_FORMATS:
+        raise ValueError(f"derivative_format must be one of {DERIVATIVE_FORMATS}, got {p['derivative_format']}")
+
+    save_folder = get_save_folder(root_path, condition, id)
+    os.makedirs(save_folder, exist_ok=True)
+    prefix = get_output_prefix(id, week)
+
+    report = PreprocessingReport(f'Preprocessing Subject {id}, for condition {condition} in week {week}',
+                                 level=p['report'], deferred=p['report_deferred'] and manual != 'interactive')
+
+    log_preprocessing = LogPreprocessingDetails(json_path, id, condition, str(week))
+    # wall time, CPU time and peak memory of every stage, see utils/profiling.py
+    profiler = StageProfiler(log=log_preprocessing.log_detail, max_rss=p['memory_budget_mb'])
+    # decisions taken by hand in a previous run: the sidecar written by the interactive runs
+    # or, without one, the indices of the preprocessing log
+    decisions_file = manual_decisions.get_decisions_file(save_folder, prefix)
+    decisions = {}
+    if manual == 'replay':
+        decisions = (manual_decisions.load_decisions(decisions_file)
+                     or manual_decisions.decisions_from_log(log_preprocessing.get_log()))
+    # decisions of this run (interactive) and the ones that could not be replayed
+    new_decisions = {}
+    stale = {}
+
+    raw_key = raw_hash or file_hash(raw_file, os.path.join(root_path, 'derivatives', RAW_HASHES))
+    replayed_bads, stale['bad_channels'] = manual_decisions.replay_bad_channels(decisions, raw_key)
+
+    # The filtered recording is only needed to find the bad channels and to plot it
+    streaming = p['streaming'] and manual != 'interactive' and replayed_bads is not None
+    buffer_file = os.path.join(save_folder, f'{prefix}-epochs-buffer.npy') if p['streaming_memmap'] else None
+    log_preprocessing.log_detail('streaming', streaming)
+
+    # 1. READ RAW
+    read_tmin, read_tmax = get_read_span(p)
+    # with streaming only the measurement info, the epochs are read from the file in chunks
+    raw_tmin, raw_tmax = ((read_tmin or 0, (read_tmin or 0) + p['duration_epochs']) if streaming
+                          else (read_tmin, read_tmax))
+    with profiler.stage('read'):
+        raw = read_raw(raw_file, raw_tmin, raw_tmax)
+    # before the slow stages, fit_ica checks it again on the epochs
+    check_ica_decim(p['ica_decim'], raw.info['sfreq'], p['lpass'])
+    if not streaming:
+        with profiler.stage('report'):
+            report.add_raw(raw, title='Raw')
+    log_preprocessing.log_detail('info', str(raw.info))
+    log_preprocessing.log_detail('raw_file', raw_file)
+    log_preprocessing.log_detail('read_span', [read_tmin, read_tmax])
+
+    # Keys of the cached stages, each one depends on the previous stage (raw_key above)
+    # 2. FILTERING
+    filter_key = StageCache.stage_key('filter', {'hpass': p['hpass'], 'lpass': p['lpass'],
+                                                 'read_span': [read_tmin, read_tmax]}, raw_key)
+    if not streaming:
+        with profiler.stage('filter'):
+            raw_filtered = _run_stage(cache, condition, id, week, 'filter', filter_key,
+                                      lambda: filter_raw(raw, p['hpass'], p['lpass']), _write_raw, _read_raw)
+    log_preprocessing.log_detail('hpass_filter', p['hpass'])
+    log_preprocessing.log_detail('lpass_filter', p['lpass'])
+    log_preprocessing.log_detail('filter_type', 'bandpass')
+
+    # 3. BAD CHANNELS
+    info = raw.info if streaming else raw_filtered.info
+    if replayed_bads is not None:
+        info['bads'] = [ch for ch in replayed_bads if ch in info['ch_names']]
+    else:
+        from utils.bad_channels import find_bad_channels
+
+        bads_params = {'random_state': p['random_state'], 'ransac': p['ransac'], 'ransac_margin': p['ransac_margin']}
+        bads_key = StageCache.stage_key('bad_channels', bads_params, filter_key)
+        with profiler.stage('bad_channels'):
+            bad_channels = _run_stage(cache, condition, id, week, 'bad_channels', bads_key,
+                                      lambda: find_bad_channels(raw_filtered, p['random_state'], p['ransac'],
+                                                                p['ransac_margin'], n_jobs),
+                                      _write_bads, _read_bads)
+        raw_filtered.info['bads'] = bad_channels['bads']
+        log_preprocessing.log_detail('bad_channels_by_criterion', bad_channels['bads_by_criterion'])
+        log_preprocessing.log_detail('bad_channels_timing', bad_channels['timings'])
+        log_preprocessing.log_detail('ransac_channels', bad_channels['ransac_channels'])
+        log_preprocessing.log_detail('ransac_status', bad_channels['ransac_status'])
+    if manual == 'interactive':
+        raw_filtered.plot(n_channels=32)
+        _show_blocking()
+        manual_decisions.record_bad_channels(new_decisions, raw_filtered.info['bads'], raw_key)
+        manual_decisions.save_decisions(decisions_file, new_decisions)
+    if not streaming:
+        with profiler.stage('report'):
+            report.add_raw(raw_filtered, title='Filtered Raw')
+    log_preprocessing.log_detail('bad_channels', info['bads'])
+
+    # 4. EPOCHING
+    # the streamed epochs are the same, they share the cached stage
+    epochs_params = {'duration_epochs': p['duration_epochs'], 'bads': info['bads']}
+    if p['precision'] != 'float64':
+        # only in the key when it is not the default, so that the existing caches stay valid
+        epochs_params['precision'] = p['precision']
+    epochs_key = StageCache.stage_key('epochs', epochs_params, filter_key)
+    if streaming:
+        compute_epochs = lambda: stream_epochs(raw_file, info, p['hpass'], p['lpass'], p['duration_epochs'],
+                                               read_tmin, read_tmax, buffer_file)
+    else:
+        compute_epochs = lambda: make_epochs(raw_filtered, p['duration_epochs'])
+    with profiler.stage('epoching'):
+        epochs = _run_stage(cache, condition, id, week, 'epochs', epochs_key,
+                            lambda: set_precision(compute_epochs(), p['precision']), _write_epochs,
+                            lambda folder: set_precision(_read_epochs(folder), p['precision']))
+    # the continuous data is not used anymore (a deferred report keeps its own copy)
+    raw = raw_filtered = None
+    with profiler.stage('report'):
+        report.add_epochs(epochs, title='Epochs')
+    log_preprocessing.log_detail('n_epochs', len(epochs))
+    log_preprocessing.log_detail('duration_epochs', p['duration_epochs'])
+
+    # 5. REJECT EPOCHS
+    ar_model = None
+    if p['autoreject_mode'] != 'fit':
+        ar_model = find_model(save_folder, prefix, p['autoreject_scope'])
+    autoreject_params = {'folds': p['folds'], 'random_state': p['random_state'], 'mode': p['autoreject_mode'],
+                         'fit_epochs': p['autoreject_fit_epochs'], 'model': ar_model}
+    autoreject_key = StageCache.stage_key('autoreject', autoreject_params, epochs_key)
+    with profiler.stage('autoreject'):
+        epochs_clean, reject, ar, ar_details = _run_stage(
+            cache, condition, id, week, 'autoreject', autoreject_key,
+            lambda: autoreject_epochs(epochs, p['folds'], p['random_state'], n_jobs, p['autoreject_mode'],
+                                      ar_model, p['autoreject_fit_epochs']),
+            _write_autoreject, lambda folder: _read_autoreject(folder, epochs))
+    # AutoReject returns float64 epochs
+    set_precision(epochs_clean, p['precision'])
+    if ar_details['mode'] != 'fixed':
+        # the fitted model can be reused by the next runs
+        save_model(save_folder, prefix, ar, get_model_params(ar, epochs, reject))
+    ar_reject_epochs = [n_epoch for n_epoch, log in enumerate(epochs_clean.drop_log) if log == ('AUTOREJECT',)]
+    log_preprocessing.log_detail('autoreject_epochs', ar_reject_epochs)
+    log_preprocessing.log_detail('autoreject_threshold', reject)
+    log_preprocessing.log_detail('len_autoreject_epochs', len(ar_reject_epochs))
+    log_preprocessing.log_detail('autoreject_mode', ar_details['mode'])
+    log_preprocessing.log_detail('autoreject_model_source', ar_details['source'])
+    log_preprocessing.log_detail('autoreject_n_fit_epochs', ar_details['n_fit_epochs'])
+    log_preprocessing.log_detail('autoreject_consensus', ar_details['consensus'])
+    log_preprocessing.log_detail('autoreject_n_interpolate', ar_details['n_interpolate'])
+    log_preprocessing.log_detail('autoreject_reject_log', ar_details['reject_log'])
+    log_preprocessing.log_detail('autoreject_time', ar_details['time'])
+
+    if manual == 'interactive':
+        epochs_clean.plot(scalings='auto')
+        _show_blocking()
+    else:
+        saved_epochs, stale['manual_reject_epochs'] = manual_decisions.replay_epochs(
+            decisions, 'manual_reject_epochs', epochs)
+        _drop_saved_epochs(epochs_clean, saved_epochs)
+
+    manual_reject_epochs = [n_epoch for n_epoch, log in enumerate(epochs_clean.drop_log) if log == ('USER',)]
+    if manual == 'interactive':
+        manual_decisions.record_epochs(new_decisions, 'manual_reject_epochs', epochs, manual_reject_epochs)
+        manual_decisions.save_decisions(decisions_file, new_decisions)
+    log_preprocessing.log_detail('manual_reject_epochs', manual_reject_epochs)
+    log_preprocessing.log_detail('len_manual_reject_epochs', len(manual_reject_epochs))
+
+    with profiler.stage('report'):
+        report.add_epochs(epochs_clean, title='Epochs clean', psd=False)
+        report.add_drop_log(epochs_clean, title='Epochs clean')
+    epochs_clean.drop_bad()
+
+    # 6. ICA
+    ica_params = {'n_components': p['n_components'], 'method': p['method'], 'max_iter': p['max_iter'],
+                  'random_state': p['random_state'], 'decim': p['ica_decim'], 'fit_epochs': p['ica_fit_epochs'],
+                  'selection': epochs_clean.selection.tolist()}
+    ica_key = StageCache.stage_key('ica', ica_params, autoreject_key)
+    # the exclusion below is not part of the key: changing it reuses the fitted ICA
+    with profiler.stage('ica'):
+        ica = _load_ica(save_folder, prefix, ica_key)
+        if ica is None:
+            ica = _run_stage(cache, condition, id, week, 'ica', ica_key,
+                             lambda: fit_ica(epochs_clean, p['n_components'], p['method'], p['max_iter'],
+                                             p['random_state'], p['ica_decim'], p['ica_fit_epochs']),
+                             _write_ica, _read_ica)
+            _save_ica(save_folder, prefix, ica, ica_key, {key: value for key, value in ica_params.items()
+                                                          if key != 'selection'})
+    saved_exclude, stale['ica_components'] = manual_decisions.replay_ica(decisions, ica, ica_key,
+                                                                         p['manual_ica_match'])
+    if saved_exclude is not None:
+        ica.exclude = saved_exclude
+        # no labels and scores for the replayed selection, the ones of a previous run may be of another ICA
+        log_preprocessing.log_detail('ica_labels', None)
+        log_preprocessing.log_detail('ica_scores', None)
+    else:
+        with profiler.stage('iclabel'):
+            ica.exclude, label_names, ica_scores = select_ica_components(ica, epochs_clean, p['muscle_threshold'],
+                                                                         rules=p['ica_rules'])
+        log_preprocessing.log_detail('ica_labels', label_names)
+        log_preprocessing.log_detail('ica_scores', json.loads(ica_scores.reset_index().to_json(orient='records',
+                                                                                               double_precision=4)))
+    if manual == 'interactive':
+        ica.plot_sources(epochs_clean, block=True, show=True)
+        _show_blocking()
+        manual_decisions.record_ica(new_decisions, ica, ica_key)
+        manual_decisions.save_decisions(decisions_file, new_decisions)
+    with profiler.stage('report'):
+        report.add_ica(ica, title='ICA', inst=epochs_clean)
+
+    with profiler.stage('ica_apply'):
+        epochs_ica = ica.apply(inst=epochs_clean)
+    log_preprocessing.log_detail('ica_components', ica.exclude)
+    log_preprocessing.log_detail('ica_method', p['method'])
+    log_preprocessing.log_detail('ica_max_iter', p['max_iter'])
+    log_preprocessing.log_detail('ica_random_state', p['random_state'])
+    log_preprocessing.log_detail('ica_decim', p['ica_decim'])
+    log_preprocessing.log_detail('ica_fit_epochs', p['ica_fit_epochs'])
+    log_preprocessing.log_detail('ica_key', ica_key)
+
+    if manual == 'interactive':
+        epochs_ica.plot(scalings='auto')
+        _show_blocking()
+    else:
+        saved_epochs, stale['manual_reject_epochs_after_ica'] = manual_decisions.replay_epochs(
+            decisions, 'manual_reject_epochs_after_ica', epochs)
+        _drop_saved_epochs(epochs_ica, saved_epochs)
+
+    all_manual_epochs = [n_epoch for n_epoch, log in enumerate(epochs_ica.drop_log) if log == ('USER',)]
+    manual_reject_epochs_after_ica = [n_epoch for n_epoch in all_manual_epochs
+                                      if n_epoch not in manual_reject_epochs]
+    total_epochs_rejected = (len(ar_reject_epochs) + len(manual_reject_epochs)
+                             + len(manual_reject_epochs_after_ica)) / len(epochs) * 100
+    log_preprocessing.log_detail('manual_reject_epochs_after_ica', manual_reject_epochs_after_ica)
+    log_preprocessing.log_detail('len_manual_reject_epochs_after_ica', len(manual_reject_epochs_after_ica))
+    log_preprocessing.log_detail('total_epochs_rejected', total_epochs_rejected)
+    log_preprocessing.log_detail('epochs_drop_log', epochs_ica.drop_log)
+    log_preprocessing.log_detail('manual_mode', manual)
+    if manual == 'interactive':
+        manual_decisions.record_epochs(new_decisions, 'manual_reject_epochs_after_ica', epochs,
+                                       manual_reject_epochs_after_ica)
+        manual_decisions.save_decisions(decisions_file, new_decisions)
+    log_preprocessing.log_detail('manual_replayed', [name for name in manual_decisions.DECISIONS
+                                                     if name in decisions and not stale.get(name)])
+    # decisions that were not (or only partly) re-applied and have to be inspected again
+    log_preprocessing.log_detail('manual_stale', {name: reason for name, reason in stale.items() if reason})
+
+    # 7. INTERPOLATE AND REREFERENCE
+    with profiler.stage('interpolation'):
+        epochs_interpolate = interpolate(epochs_ica)
+    with profiler.stage('reref'):
+        epochs_rereferenced = rereference(epochs_interpolate)
+    del epochs_interpolate
+    log_preprocessing.log_detail('interpolated_channels', epochs_ica.info['bads'])
+    if p['derivative_format'] != 'hdf5':
+        # with 'hdf5' the rereferenced epochs are the store written with the windows
+        save_epochs(epochs_rereferenced, os.path.join(save_folder, f'{prefix}-rereferenced_eeg.fif'))
+    with profiler.stage('report'):
+        # the PSD is plotted from the one of the spectral features below
+        report.add_epochs(epochs_rereferenced, title='Epochs interpolated and rereferenced', psd=False)
+    log_preprocessing.log_detail('rereference', 'grand_average')
+
+    # 8. CROP signal into Baseline and Active
+    # (and the other windows and bins)
+    with profiler.stage('crop'):
+        n_epochs_windows = write_windows(epochs_rereferenced, save_folder, prefix, p)
+    log_preprocessing.log_detail('t_min_baseline', p['t_min_baseline'])
+    log_preprocessing.log_detail('t_max_baseline', p['t_max_baseline'])
+    log_preprocessing.log_detail('t_0_dosis', p['t_0_dosis'])
+    log_preprocessing.log_detail('t_max_dosis', p['t_max_dosis'])
+    log_preprocessing.log_detail('windows', get_windows(p))
+    log_preprocessing.log_detail('window_bins', p['window_bins'])
+    log_preprocessing.log_detail('n_epochs_windows', n_epochs_windows)
+    log_preprocessing.log_detail('derivative_format', p['derivative_format'])
+
+    # 9. SPECTRAL FEATURES of the windows
+    psd = None
+    if p['spectral_features'] or p['report'] != 'none':
+        with profiler.stage('psd'):
+            psd = compute_window_psd(epochs_rereferenced, p)
+    with profiler.stage('report'):
+        if psd is not None:
+            report.add_psd(psd, epochs_rereferenced.events[:, 0] / epochs_rereferenced.info['sfreq'],
+                           get_windows(p), title='PSD of the windows')
+    if p['spectral_features']:
+        with profiler.stage('spectral'):
+            spectral_file = write_spectral_features(epochs_rereferenced, save_folder, prefix, p, id, week,
+                                                    condition, psd)
+        log_preprocessing.log_detail('spectral_file', spectral_file)
+        log_preprocessing.log_detail('spectral_method', p['spectral_method'])
+
+    # the time of the report save itself is only in the log (a deferred report is saved later)
+    report_file = os.path.join(save_folder, f'{prefix}-report.html') if p['report'] != 'none' else None
+    with profiler.stage('report'):
+        report.add_html(profiler.to_html(), title='Timing')
+        report.save(report_file)
+    log_preprocessing.log_detail('precision', p['precision'])
+    log_preprocessing.log_detail('report', p['report'])
+    log_preprocessing.log_detail('report_deferred', report.deferred)
+    log_preprocessing.log_detail('report_file', report_file)
+    if buffer_file is not None and os.path.exists(buffer_file):
+        os.remove(buffer_file)
+
+    return log_preprocessing.get_log()
@@ -1,8 +1,250 @@
+import datetime
+import os
 import numpy as np
 import mne
 
 
-def read_edf_akonic(path):
+# Channels of the Akonic EDF files kept by set_chs_montage (EEG + ECG, which is recorded on EMG-0)
+AKONIC_EDF_CHANNELS = [
+    'EEG Fp1-Ref', 'EEG Fp2-Ref', 'EEG F3-Ref', 'EEG F4-Ref', 'EEG C3-Ref', 'EEG C4-Ref',
+    'EEG P3-Ref', 'EEG P4-Ref', 'EEG O1-Ref', 'EEG O2-Ref', 'EEG F7-Ref', 'EEG F8-Ref',
+    'EEG T3-Ref', 'EEG T4-Ref', 'EEG T5-Ref', 'EEG T6-Ref', 'EEG A1-Ref', 'EEG A2-Ref',
+    'EEG Fz-Ref', 'EEG Cz-Ref', 'EEG Pz-Ref', 'EMG-0'
+]
+
+# Names given by set_chs_montage to the signals of the Akonic EDF files
+AKONIC_RENAME = {
+    'EEG Fp1-Ref': 'Fp1',
+    'EEG Fp2-Ref': 'Fp2',
+    'EEG F3-Ref': 'F3',
+    'EEG F4-Ref': 'F4',
+    'EEG C3-Ref': 'C3',
+    'EEG C4-Ref': 'C4',
+    'EEG P3-Ref': 'P3',
+    'EEG P4-Ref': 'P4',
+    'EEG O1-Ref': 'O1',
+    'EEG O2-Ref': 'O2',
+    'EEG F7-Ref': 'F7',
+    'EEG F8-Ref': 'F8',
+    'EEG T3-Ref': 'T7',
+    'EEG T4-Ref': 'T8',
+    'EEG T5-Ref': 'P7',
+    'EEG T6-Ref': 'P8',
+    'EEG A1-Ref': 'A1',
+    'EEG A2-Ref': 'A2',
+    'EEG Fz-Ref': 'Fz',
+    'EEG Cz-Ref': 'Cz',
+    'EEG Pz-Ref': 'Pz',
+    'ECG': 'ECG_muerto',
+    'Resp oro-nasal': 'Resp',
+    'TORAXIC BELT': 'Toracic',
+    'ABDOMINAL BELT': 'Abdominal',
+    'MICROPHONE': 'Microphone',
+    'EMG-0': 'ECG',
+    'EMG-1': 'EMG1',
+    'EMG-2': 'EMG2',
+    'EMG-3': 'EMG3',
+    'EXT1': 'EXT1',
+    'EXT2': 'EXT2'
+}
+
+AKONIC_CH_TYPES = {
+    'Fp1': 'eeg', 'Fp2': 'eeg',
+    'F3': 'eeg', 'F4': 'eeg',
+    'C3': 'eeg', 'C4': 'eeg',
+    'P3': 'eeg', 'P4': 'eeg',
+    'O1': 'eeg', 'O2': 'eeg',
+    'F7': 'eeg', 'F8': 'eeg',
+    'T7': 'eeg', 'T8': 'eeg',
+    'P7': 'eeg', 'P8': 'eeg',
+    'A1': 'eeg', 'A2': 'eeg',
+    'Fz': 'eeg', 'Cz': 'eeg',
+    'Pz': 'eeg',
+    'ECG': 'ecg',
+    'Resp': 'resp',
+    'Toracic': 'misc',
+    'Abdominal': 'misc',
+    'Microphone': 'misc',
+    'ECG_muerto': 'emg', 'EMG1': 'emg', 'EMG2': 'emg', 'EMG3': 'emg',
+    'EXT1': 'stim', 'EXT2': 'stim'
+}
+
+# Channels dropped by set_chs_montage
+AKONIC_DROPPED = ['Resp', 'Toracic', 'Abdominal', 'Microphone', 'ECG_muerto', 'EMG1', 'EMG2', 'EMG3', 'EXT1', 'EXT2']
+
+
+class ChannelLayout:
+    # Names, types and positions of the channels kept from the files of a recording system.
+    # The Info of the kept channels is built once per process (per channel list and sampling
+    # frequency) and copied for every recording, so a reader builds the Raw with the final
+    # channels in one step instead of renaming, retyping, dropping (a copy of the data)
+    # and setting the montage on every recording.
+    def __init__(self, rename, ch_types, dropped, montage='standard_1020', line_freq=50):
+        self.rename = rename
+        self.ch_types = ch_types
+        self.dropped = dropped
+        self.montage_name = montage
+        self.line_freq = line_freq
+        self._montage = None
+        self._infos = {}
+
+    @property
+    def channels(self):
+        # Channels of the files that are kept, the ones a reader has to read
+        return [ch for ch, name in self.rename.items() if name not in self.dropped]
+
+    @property
+    def montage(self):
+        if self._montage is None:
+            self._montage = mne.channels.make_standard_montage(self.montage_name)
+        return self._montage
+
+    def info(self, ch_names, sfreq):
+        # Info of the channels ch_names of a file (kept channels only), in the same order
+        key = (tuple(ch_names), float(sfreq))
+        if key not in self._infos:
+            names = [self.rename.get(ch, ch) for ch in ch_names]
+            info = mne.create_info(ch_names=names, sfreq=sfreq, ch_types=[self.ch_types[ch] for ch in names])
+            info['line_freq'] = self.line_freq
+            info.set_montage(self.montage.copy())
+            self._infos[key] = info
+        return self._infos[key].copy()
+
+    def apply(self, raw):
+        # Same channels on a Raw that was already built (e.g. by mne.io.read_raw_edf)
+        # Rename the channels (read_edf_akonic may have read only the channels that are kept)
+        raw.rename_channels({old: new for old, new in self.rename.items() if old in raw.ch_names})
+        raw.set_channel_types({ch: ch_type for ch, ch_type in self.ch_types.items() if ch in raw.ch_names})
+        raw.info['bads'] = [ch for ch in self.dropped if ch in raw.ch_names]
+        # dropping copies the data, even when there is nothing to drop
+        if raw.info['bads']:
+            raw.drop_channels(raw.info['bads'])
+        return raw.set_montage(self.montage.copy())
+
+
+AKONIC_LAYOUT = ChannelLayout(AKONIC_RENAME, AKONIC_CH_TYPES, AKONIC_DROPPED)
+
+# Scaling of the EDF physical dimensions to volts
+EDF_UNITS = {'uV': 1e-6, '\u00b5V': 1e-6, '\u03bcV': 1e-6, 'mV': 1e-3, 'V': 1.}
+
+
+class UnsupportedEDF(ValueError):
+    # An EDF file that read_edf_header and read_edf_data cannot decode (malformed header,
+    # discontinuous EDF+, several sampling frequencies), mne.io.read_raw_edf may read it
+    pass
+
+
+def read_edf_header(path):
+    # Parse the fixed size EDF header and the header of every signal
+    try:
+        return _parse_edf_header(path)
+    except (ValueError, IndexError) as error:
+        raise UnsupportedEDF(f'Unsupported EDF header in {path}: {error}') from error
+
+
+def _parse_edf_header(path):
+    with open(path, 'rb') as f:
+        header = f.read(256)
+        n_signals = int(header[252:256])
+        signal_header = f.read(n_signals * 256)
+
+    # The signal header stores each field for all the signals one after the other
+    fields = [('label', 16), ('transducer', 80), ('physical_dimension', 8),
+              ('physical_min', 8), ('physical_max', 8), ('digital_min', 8), ('digital_max', 8),
+              ('prefiltering', 80), ('n_samples', 8), ('reserved', 32)]
+    signals = {}
+    position = 0
+    for name, width in fields:
+        signals[name] = [signal_header[position + i * width:position + (i + 1) * width].decode('latin-1').strip()
+                         for i in range(n_signals)]
+        position += n_signals * width
+
+    edf_header = {
+        'start_date': header[168:176].decode('latin-1').strip(),
+        'start_time': header[176:184].decode('latin-1').strip(),
+        'header_bytes': int(header[184:192]),
+        'subtype': header[192:236].decode('latin-1').strip(),
+        'n_records': int(header[236:244]),
+        'record_duration': float(header[244:252]),
+        'n_signals': n_signals,
+        'ch_names': signals['label'],
+        'units': signals['physical_dimension'],
+        'physical_min': np.array(signals['physical_min'], float),
+        'physical_max': np.array(signals['physical_max'], float),
+        'digital_min': np.array(signals['digital_min'], float),
+        'digital_max': np.array(signals['digital_max'], float),
+        'n_samples': np.array(signals['n_samples'], int),
+    }
+
+    # n_records can be -1 while recording, count them from the file size
+    record_bytes = 2 * edf_header['n_samples'].sum()
+    data_bytes = os.path.getsize(path) - edf_header['header_bytes']
+    if edf_header['n_records'] < 0:
+        edf_header['n_records'] = data_bytes // record_bytes
+    edf_header['n_records'] = min(edf_header['n_records'], data_bytes // record_bytes)
+
+    # EDF dates are dd.mm.yy, with years 85-99 in the 1900s
+    day, month, year = [int(x) for x in edf_header['start_date'].split('.')]
+    hour, minute, second = [int(x) for x in edf_header['start_time'].split('.')]
+    year += 1900 if year >= 85 else 2000
+    edf_header['meas_date'] = datetime.datetime(year, month, day, hour, minute, second,
+                                                tzinfo=datetime.timezone.utc)
+    return edf_header
+
+
+def read_edf_data(path, channels=None, dtype=np.float64, edf_header=None, start=0, stop=None):
+    # Decode the selected channels of an EDF file into a preallocated array.
+    # The int16 data records are memory mapped, so only the selected channels and the
+    # records between the samples start and stop are read, and the full recording
+    # is never held in memory as int16 or float64.
+    if edf_header is None:
+        edf_header = read_edf_header(path)
+    if edf_header['subtype'].startswith('EDF+D'):
+        raise UnsupportedEDF('Discontinuous EDF+ files are not supported by read_edf_data')
+
+    ch_names = edf_header['ch_names']
+    if channels is None:
+        picks = [i for i, ch in enumerate(ch_names) if ch != 'EDF Annotations']
+    else:
+        picks = [i for i, ch in enumerate(ch_names) if ch in channels]
+    n_samples = edf_header['n_samples'][picks]
+    if len(np.unique(n_samples)) != 1:
+        raise UnsupportedEDF('The selected channels have different sampling frequencies')
+    n_per_record = int(n_samples[0])
+
+    n_records = edf_header['n_records']
+    n_times = n_records * n_per_record
+    stop = n_times if stop is None else min(stop, n_times)
+    start = max(start, 0)
+    if start >= stop:
+        raise ValueError(f'No samples between {start} and {stop}')
+    first_record = start // n_per_record
+    last_record = -(-stop // n_per_record)
+
+    records = np.memmap(path, dtype='<i2', mode='r', offset=edf_header['header_bytes'],
+                        shape=(n_records, int(edf_header['n_samples'].sum())))[first_record:last_record]
+    first = start - first_record * n_per_record
+    record_offsets = np.concatenate([[0], np.cumsum(edf_header['n_samples'])])
+
+    # physical = (digital * cal + offset) * unit, as mne.io.read_raw_edf
+    physical_range = edf_header['physical_max'] - edf_header['physical_min']
+    digital_range = edf_header['digital_max'] - edf_header['digital_min']
+    digital_range[digital_range == 0] = 1
+    cal = physical_range / digital_range
+    offsets = edf_header['physical_min'] - edf_header['digital_min'] * cal
+    units = np.array([EDF_UNITS.get(unit, 1.) for unit in edf_header['units']])
+
+    data = np.empty((len(picks), stop - start), dtype=dtype)
+    for row, pick in enumerate(picks):
+        channel = records[:, record_offsets[pick]:record_offsets[pick + 1]].reshape(-1)[first:first + stop - start]
+        np.multiply(channel, cal[pick] * units[pick], out=data[row])
+        data[row] += offsets[pick] * units[pick]
+    del records
+
+    return data, [ch_names[pick] for pick in picks], n_per_record / edf_header['record_duration']
+
+
+def read_edf_akonic_mne(path):
     # Load the original EDF file
     raw = mne.io.read_raw_edf(path, preload=True, verbose=False)
 
@@ -22,72 +264,102 @@ def read_edf_akonic(path):
 
     return new_raw
 
-def set_chs_montage(raw):
-    rename_dict = {
-        'EEG Fp1-Ref': 'Fp1',
-        'EEG Fp2-Ref': 'Fp2',
-        'EEG F3-Ref': 'F3',
-        'EEG F4-Ref': 'F4',
-        'EEG C3-Ref': 'C3',
-        'EEG C4-Ref': 'C4',
-        'EEG P3-Ref': 'P3',
-        'EEG P4-Ref': 'P4',
-        'EEG O1-Ref': 'O1',
-        'EEG O2-Ref': 'O2',
-        'EEG F7-Ref': 'F7',
-        'EEG F8-Ref': 'F8',
-        'EEG T3-Ref': 'T7',
-        'EEG T4-Ref': 'T8',
-        'EEG T5-Ref': 'P7',
-        'EEG T6-Ref': 'P8',
-        'EEG A1-Ref': 'A1',
-        'EEG A2-Ref': 'A2',
-        'EEG Fz-Ref': 'Fz',
-        'EEG Cz-Ref': 'Cz',
-        'EEG Pz-Ref': 'Pz',
-        'ECG': 'ECG_muerto',
-        'Resp oro-nasal': 'Resp',
-        'TORAXIC BELT': 'Toracic',
-        'ABDOMINAL BELT': 'Abdominal',
-        'MICROPHONE': 'Microphone',
-        'EMG-0': 'ECG',
-        'EMG-1': 'EMG1',
-        'EMG-2': 'EMG2',
-        'EMG-3': 'EMG3',
-        'EXT1': 'EXT1',
-        'EXT2': 'EXT2'
-    }
-    
-    # Rename the channels
-    raw.rename_channels(rename_dict)
-
-    channel_types = {
-        'Fp1': 'eeg', 'Fp2': 'eeg', 
-        'F3': 'eeg', 'F4': 'eeg', 
-        'C3': 'eeg', 'C4': 'eeg', 
-        'P3': 'eeg', 'P4': 'eeg', 
-        'O1': 'eeg', 'O2': 'eeg', 
-        'F7': 'eeg', 'F8': 'eeg', 
-        'T7': 'eeg', 'T8': 'eeg', 
-        'P7': 'eeg', 'P8': 'eeg', 
-        'A1': 'eeg', 'A2': 'eeg',
-        'Fz': 'eeg', 'Cz': 'eeg', 
-        'Pz': 'eeg', 
-        'ECG': 'ecg',
-        'Resp': 'resp',
-        'Toracic': 'misc',
-        'Abdominal': 'misc',
-        'Microphone': 'misc',
-        'ECG_muerto': 'emg', 'EMG1': 'emg', 'EMG2': 'emg', 'EMG3': 'emg',
-        'EXT1': 'stim', 'EXT2': 'stim'
-    }
-    raw.set_channel_types(channel_types)
 
-    raw.info['bads'] = ['Resp', 'Toracic', 'Abdominal', 'Microphone', 'ECG_muerto', 'EMG1', 'EMG2', 'EMG3', 'EXT1', 'EXT2']
-    
+def check_channels(path, ch_names, channels):
+    # A file must have at least one of the channels to read (None for all of them)
+    if channels is not None and not any(ch in channels for ch in ch_names):
+        raise ValueError(f"{path} has none of the channels {', '.join(channels)}, "
+                         f"its channels are {', '.join(ch_names)}")
+
+
+def read_edf_akonic(path, channels=AKONIC_EDF_CHANNELS, tmin=None, tmax=None, layout=None):
+    # Read only the channels kept by set_chs_montage straight into the array of the Raw,
+    # channels=None reads every channel.
+    # tmin and tmax (in seconds) read only a part of the recording, the Raw keeps the
+    # time of the recording (first_samp is the first sample read).
+    # With a ChannelLayout (AKONIC_LAYOUT) only its channels are read and the Raw is built
+    # with their final names, types and positions, as read_edf_akonic + set_chs_montage.
+    # mne.io.read_raw_edf is used for the files the fast reader does not handle (UnsupportedEDF),
+    # a span without samples is an error of the caller and is raised.
+    if layout is not None:
+        channels = layout.channels
+    try:
+        edf_header = read_edf_header(path)
+        picks = [i for i, ch in enumerate(edf_header['ch_names']) if channels is None or ch in channels]
+        if picks:
+            sfreq = edf_header['n_samples'][picks[0]] / edf_header['record_duration']
+            start = int(round(tmin * sfreq)) if tmin is not None else 0
+            stop = int(round(tmax * sfreq)) if tmax is not None else None
+            data, ch_names, sfreq = read_edf_data(path, channels, np.float64, edf_header, start, stop)
+    except UnsupportedEDF:
+        raw = read_edf_akonic_mne(path)
+        if channels is not None:
+            check_channels(path, raw.ch_names, channels)
+            raw.pick([ch for ch in raw.ch_names if ch in channels])
+        if tmin is not None or tmax is not None:
+            raw.crop(tmin or 0, min(tmax, raw.times[-1]) if tmax is not None else None)
+        return layout.apply(raw) if layout is not None else raw
+    # outside of the try, the fallback reader would not find them either
+    check_channels(path, edf_header['ch_names'], channels)
+
+    if layout is not None:
+        # copy of the Info of the layout, built on the first recording
+        new_info = layout.info(ch_names, sfreq)
+    else:
+        # New Info object without the filter settings
+        new_info = mne.create_info(ch_names=ch_names, sfreq=sfreq, ch_types=['eeg' for _ in ch_names])
+        new_info['line_freq'] = 50
+
+    # data is already float64, so RawArray does not copy it
+    new_raw = mne.io.RawArray(data, new_info, first_samp=max(start, 0), verbose=False)
+    new_raw.set_meas_date(edf_header['meas_date'])
+
+    return new_raw
+
+
+def merge_windows(windows, padding=0, step=None):
+    # Add padding (in seconds) around each (tmin, tmax) window and merge the windows that overlap.
+    # With step, the start of each window is moved back to a multiple of step (e.g. the
+    # duration of the epochs) so that epochs keep the same onsets as with the full recording.
+    padded = []
+    for tmin, tmax in sorted(windows):
+        tmin = max(tmin - padding, 0)
+        if step is not None:
+            tmin = float(np.floor(tmin / step) * step)
+        padded.append([tmin, tmax + padding])
+
+    merged = [padded[0]]
+    for tmin, tmax in padded[1:]:
+        if tmin <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], tmax)
+        else:
+            merged.append([tmin, tmax])
+    return [tuple(window) for window in merged]
+
+
+def read_edf_windows(path, windows, padding=0, channels=AKONIC_EDF_CHANNELS, layout=None):
+    # One Raw per (padded, merged) time window, reading only those samples from disk.
+    # The padding leaves room for the edge effects of the filters.
+    return [read_edf_akonic(path, channels, tmin, tmax, layout) for tmin, tmax in merge_windows(windows, padding)]
+
+
+def set_chs_montage(raw):
+    # Names, types and positions of the Akonic channels on a Raw read with every channel,
+    # see ChannelLayout.apply
+    return AKONIC_LAYOUT.apply(raw)
 
-    raw.drop_channels(raw.info['bads'])
 
-    raw = raw.set_montage('standard_1020')
-    
-    return raw
+def subsample_epochs(epochs, fit_epochs, random_state):
+    # fit_epochs: None for all the epochs, a fraction (a float <= 1, 1.0 is all of them) or a number of epochs
+    if fit_epochs is None:
+        return epochs
+    if fit_epochs <= 0:
+        raise ValueError(f'fit_epochs must be a fraction or a number of epochs above 0, got {fit_epochs}')
+    if isinstance(fit_epochs, float) and fit_epochs <= 1:
+        n_epochs = max(int(round(fit_epochs * len(epochs))), 1)
+    else:
+        n_epochs = int(fit_epochs)
+    if n_epochs >= len(epochs):
+        return epochs
+    rng = np.random.RandomState(random_state)
+    return epochs[np.sort(rng.choice(len(epochs), n_epochs, replace=False))]
@@ -0,0 +1,173 @@
+import os
+import sys
+import time
+import resource
+from contextlib import contextmanager
+
+
+"""
+Wall time, CPU time and peak memory of every stage of the preprocessing.
+
+    profiler = StageProfiler(log=log_preprocessing.log_detail)
+    with profiler.stage('ica'):
+        ica = fit_ica(...)
+    report.add_html(profiler.to_html(), title='Timing')
+
+After every stage the measures of all the stages so far are logged as
+'stage_profile': {stage: {'wall': s, 'cpu': s, 'rss_start': MB, 'peak_rss': MB,
+'peak_rss_delta': MB}}. A stage entered several times (e.g. 'report') adds up
+its times and keeps its highest peak. The CPU time is the one of this process
+(joblib workers of a stage are not counted) and on Linux the peak is the peak
+RSS during the stage (the high water mark is reset when the stage starts),
+elsewhere it is the peak of the process so far.
+
+With max_rss a stage that goes above the memory budget stops the recording
+with a MemoryError instead of letting the system kill the worker.
+workers_for_memory picks the number of workers of a batch from the budget.
+
+summarize_stage_profiles aggregates the profiles of the whole cohort from the log:
+
+    python run_preprocessing.py --profile-summary
+"""
+
+PROFILE_COLUMNS = ['wall', 'cpu', 'rss_start', 'peak_rss', 'peak_rss_delta']
+
+_STATUS_FILE = '/proc/self/status'
+_CLEAR_REFS_FILE = '/proc/self/clear_refs'
+
+
+def _read_status_mb(field):
+    with open(_STATUS_FILE) as f:
+        for line in f:
+            if line.startswith(field + ':'):
+                return int(line.split()[1]) / 1024
+    return None
+
+
+def _reset_peak_rss():
+    # Linux only: writing 5 to clear_refs resets the VmHWM high water mark of the process
+    try:
+        with open(_CLEAR_REFS_FILE, 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def current_rss():
+    # Resident memory of this process in MB (None when it cannot be read)
+    if os.path.exists(_STATUS_FILE):
+        return _read_status_mb('VmRSS')
+    return None
+
+
+def peak_rss():
+    # Peak resident memory of this process in MB (since the last reset on Linux)
+    if os.path.exists(_STATUS_FILE):
+        return _read_status_mb('VmHWM')
+    # ru_maxrss is in bytes on macOS and in kB elsewhere
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / 1024 ** 2 if sys.platform == 'darwin' else maxrss / 1024
+
+
+class StageProfiler:
+    def __init__(self, log=None, max_rss=None):
+        # log: called as log('stage_profile', profiles) after every stage, e.g. LogPreprocessingDetails.log_detail
+        # max_rss: memory budget in MB, a stage whose peak RSS goes above it raises a MemoryError
+        # once it is done (the stage is not interrupted)
+        self.log = log
+        self.max_rss = max_rss
+        self.profiles = {}
+
+    @contextmanager
+    def stage(self, name):
+        rss_start = current_rss()
+        reset = _reset_peak_rss()
+        peak_start = peak_rss()
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            wall, cpu = time.perf_counter() - wall_start, time.process_time() - cpu_start
+            peak = peak_rss()
+            if rss_start is None:
+                rss_start = peak_start
+            self._add(name, wall, cpu, rss_start, peak if reset or peak > peak_start else None)
+        if self.max_rss is not None and peak is not None and peak > self.max_rss:
+            raise MemoryError(f'The {name} stage used {peak:.0f} MB, above the budget of {self.max_rss:.0f} MB')
+
+    def _add(self, name, wall, cpu, rss_start, peak):
+        profile = self.profiles.setdefault(name, {'wall': 0., 'cpu': 0., 'rss_start': rss_start,
+                                                  'peak_rss': None, 'peak_rss_delta': None})
+        profile['wall'] += wall
+        profile['cpu'] += cpu
+        if peak is not None and (profile['peak_rss'] is None or peak > profile['peak_rss']):
+            profile['peak_rss'] = peak
+            profile['peak_rss_delta'] = peak - rss_start
+        if self.log is not None:
+            self.log('stage_profile', self.profiles)
+
+    def to_frame(self):
+        import pandas as pd
+
+        return pd.DataFrame.from_dict(self.profiles, orient='index', columns=PROFILE_COLUMNS)
+
+    def to_html(self):
+        # Table of the report: seconds and MB
+        table = self.to_frame()
+        table.loc['total', ['wall', 'cpu']] = table[['wall', 'cpu']].sum()
+        return table.to_html(float_format=lambda value: f'{value:.1f}', na_rep='')
+
+
+def load_stage_profiles(json_path):
+    # One row per (subject, session, task, stage) of every recording of the log (JSON or SQLite)
+    import pandas as pd
+    from utils.log_preprocessing import query_log
+
+    profiles = query_log(json_path, 'stage_profile')
+    rows = [{'subject': subject, 'session': session, 'task': task, 'stage': stage, **profile}
+            for (subject, session, task), stages in profiles.items() for stage, profile in stages.items()]
+    return pd.DataFrame(rows, columns=['subject', 'session', 'task', 'stage'] + PROFILE_COLUMNS)
+
+
+def summarize_stage_profiles(json_path):
+    """Median, 90th percentile and maximum of the wall time, CPU time and peak RSS delta
+    of every stage across the recordings of the log, with the share of the total wall time."""
+    profiles = load_stage_profiles(json_path)
+    if profiles.empty:
+        return profiles
+    grouped = profiles.groupby('stage', sort=False)
+    summary = grouped[['wall', 'cpu', 'peak_rss_delta']].quantile([0.5, 0.9]).unstack()
+    summary.columns = [f'{column}_{"median" if q == 0.5 else "p90"}' for column, q in summary.columns]
+    summary = summary.join(grouped[['wall', 'peak_rss_delta']].max().add_suffix('_max'))
+    summary['n_recordings'] = grouped.size()
+    summary['wall_share'] = grouped['wall'].sum() / profiles['wall'].sum()
+    return summary.sort_values('wall_share', ascending=False)
+
+
+def available_memory():
+    # Memory in MB that can be used without swapping (MemAvailable on Linux)
+    if os.path.exists('/proc/meminfo'):
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) / 1024
+    return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE') / 1024 ** 2
+
+
+def estimate_worker_memory(json_path, margin=1.2):
+    # Highest peak RSS (MB) of a stage in the log times margin, None when nothing was profiled yet
+    if not os.path.exists(json_path):
+        return None
+    profiles = load_stage_profiles(json_path)
+    if profiles['peak_rss'].isna().all():
+        return None
+    return float(profiles['peak_rss'].max()) * margin
+
+
+def workers_for_memory(n_workers, worker_memory, memory_limit=None):
+    # Number of workers (at most n_workers, at least one) that fit in memory_limit MB
+    # (default: the available memory) with worker_memory MB each
+    if memory_limit is None:
+        memory_limit = available_memory()
+    return max(1, min(n_workers, int(memory_limit // worker_memory)))
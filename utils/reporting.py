@@ -0,0 +1,158 @@
+import os
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import mne
+
+
+"""
+mne.Report of the preprocessing with a choice of cost.
+
+Levels:
+    'full': the sections of preprocessing.py (raw and filtered raw with PSD, epochs,
+            ICA with the properties of the components), except that the PSD of the
+            rereferenced epochs is plotted from the PSD computed for the spectral features
+    'light': only summary plots: the drop log, the ICA components topographies and
+             the PSD of the windows, nothing is computed from the raw data
+    'none': no report
+
+With deferred=True the sections are only recorded while the pipeline runs and
+rendered after save() in a background thread, one report at a time per process,
+so that a batch worker goes on with its next recording. MNE draws its figures
+with pyplot, so reports are not deferred while a human inspects the plots
+(manual='interactive'). A deferred 'full' report keeps copies of the epochs and
+the raw data until it is rendered. The report is moved in place once complete,
+so that it only exists when it was rendered (run_preprocessing.py only marks
+a recording done then).
+
+    report = PreprocessingReport(title, level='light', deferred=True)
+    report.add_epochs(epochs_clean, 'Epochs clean')
+    future = report.save('sub-report.html')
+"""
+
+REPORT_LEVELS = ['full', 'light', 'none']
+
+# a single thread renders the deferred reports of the process, in order
+_render_executor = None
+
+
+def _get_render_executor():
+    global _render_executor
+    if _render_executor is None:
+        _render_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='report')
+    return _render_executor
+
+
+def plot_window_psd(psds, freqs, ch_names, onsets, windows):
+    # Mean PSD (dB) of the epochs of every window: one thin line per channel, the channel mean in bold
+    from matplotlib.figure import Figure
+
+    fig = Figure(figsize=(6 * max(len(windows), 1), 4), layout='constrained')
+    axes = fig.subplots(1, max(len(windows), 1), sharey=True, squeeze=False)[0]
+    for ax, (name, (tmin, tmax)) in zip(axes, windows.items()):
+        selection = (onsets >= tmin) & (onsets < tmax)
+        ax.set_title(f'{name} ({selection.sum()} epochs)')
+        ax.set_xlabel('Frequency (Hz)')
+        if not selection.any():
+            continue
+        psd_db = 10 * np.log10(psds[selection].mean(axis=0) * 1e12)
+        ax.plot(freqs, psd_db.T, color='gray', linewidth=0.5, alpha=0.5)
+        ax.plot(freqs, psd_db.mean(axis=0), color='k', linewidth=2)
+    axes[0].set_ylabel(r'PSD ($\mu V^2$/Hz, dB)')
+    return fig
+
+
+class PreprocessingReport:
+    def __init__(self, title, level='full', deferred=False):
+        if level not in REPORT_LEVELS:
+            raise ValueError(f"level must be one of {REPORT_LEVELS}, got {level}")
+        self.title = title
+        self.level = level
+        self.deferred = deferred
+        self.sections = []
+        self.report = None if deferred else mne.Report(title=title, verbose=False)
+
+    def _add(self, section):
+        # section: called with the mne.Report, now or in the render thread
+        if self.level == 'none':
+            return
+        if self.deferred:
+            self.sections.append(section)
+        else:
+            section(self.report)
+
+    def _keep(self, inst):
+        # the pipeline changes the epochs in place after adding them (drop_bad, ica.apply)
+        return inst.copy() if self.deferred else inst
+
+    def add_raw(self, raw, title):
+        if self.level == 'full':
+            raw = self._keep(raw)
+            self._add(lambda report: report.add_raw(raw=raw, title=title, psd=True))
+
+    def add_epochs(self, epochs, title, psd=True):
+        if self.level == 'full':
+            epochs = self._keep(epochs)
+            self._add(lambda report: report.add_epochs(epochs=epochs, title=title, psd=psd))
+
+    def add_drop_log(self, epochs, title):
+        # the drop log of the epochs, the only epochs plot of the light report
+        if self.level == 'light':
+            drop_log = tuple(epochs.drop_log)
+            self._add(lambda report: report.add_figure(
+                mne.viz.plot_drop_log(drop_log, subject=self.title, show=False), title=title))
+
+    def add_ica(self, ica, title, inst):
+        if self.level == 'full':
+            inst = self._keep(inst)
+            self._add(lambda report: report.add_ica(ica, title=title, inst=inst))
+        elif self.level == 'light':
+            # the topographies only: the properties and overlays are computed from the data
+            self._add(lambda report: report.add_ica(ica, title=title, inst=None))
+
+    def add_psd(self, psd, onsets, windows, title):
+        # psd: (psds, freqs, ch_names) already computed, see utils/spectral_features.compute_psd
+        psds, freqs, ch_names = psd
+        self._add(lambda report: report.add_figure(plot_window_psd(psds, freqs, ch_names, onsets, windows),
+                                                   title=title))
+
+    def add_html(self, html, title):
+        self._add(lambda report: report.add_html(html, title=title))
+
+    def _render(self, path):
+        report = mne.Report(title=self.title, verbose=False)
+        for section in self.sections:
+            section(report)
+        self.sections = []
+        # mne.Report.save needs the .html extension
+        tmp_path = f'{os.path.splitext(path)[0]}.{os.getpid()}.tmp.html'
+        try:
+            report.save(tmp_path, overwrite=True, open_browser=False, verbose=False)
+            os.replace(tmp_path, path)
+        finally:
+            # a report that failed to save leaves nothing behind
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def save(self, path):
+        # Returns None, or with deferred=True the future of the rendering
+        if self.level == 'none':
+            return None
+        if not self.deferred:
+            self.report.save(path, overwrite=True, open_browser=False, verbose=False)
+            return None
+
+        def render():
+            try:
+                self._render(path)
+            except Exception:
+                print(f"Failed to render {path}\n{traceback.format_exc()}")
+                raise
+        return _get_render_executor().submit(render)
+
+
+def wait_for_reports():
+    # Block until every deferred report of this process is written
+    if _render_executor is not None:
+        _render_executor.submit(lambda: None).result()
@@ -0,0 +1,162 @@
+import glob
+import os
+import numpy as np
+import pandas as pd
+
+import mne
+
+from scipy.integrate import trapezoid
+from scipy.signal import welch
+
+
+"""
+Spectral features of the preprocessed epochs, computed once at the end of the
+preprocessing instead of in every analysis.
+
+For every epoch of every window and every channel: the PSD (Welch or
+multitaper, computed for all the epochs in one call), the absolute and relative
+power of each band and an aperiodic (1/f) fit, log10(psd) = offset - exponent * log10(f),
+by least squares over all the spectra at once (no periodic peaks are modelled,
+unlike FOOOF). The rows are indexed by subject, week, condition, window, epoch
+and channel and written in a columnar file next to the epochs,
+<prefix>-spectral.parquet (or .h5), so that the whole cohort is queried with one read:
+
+    features = read_spectral_features('results', columns=['alpha', 'alpha_rel'],
+                                      filters=[('window', '=', 'dosis')])
+    features.groupby(['condition', 'week', 'channel'])['alpha_rel'].mean()
+
+Powers are in V**2 (bands) and V**2 / Hz (PSD).
+"""
+
+BANDS = {
+    'delta': (1, 4),
+    'theta': (4, 8),
+    'alpha': (8, 13),
+    'beta': (13, 30),
+    'gamma': (30, 45),
+}
+
+SPECTRAL_FORMATS = ['parquet', 'hdf5']
+
+INDEX_COLUMNS = ['subject', 'week', 'condition', 'window', 'bin', 'epoch', 'onset', 'channel']
+
+
+def compute_psd(epochs, method='welch', fmin=1, fmax=45):
+    # (n_epochs, n_channels, n_freqs) PSD of the EEG channels, the frequencies and the channel names
+    if method == 'welch':
+        # Same as epochs.compute_psd(method='welch', n_fft=n_times) (one hamming window per epoch,
+        # the frequency resolution is 1 / duration of the epochs), but one call for all the epochs
+        # instead of a loop over them in MNE
+        data = epochs.get_data(picks='eeg')
+        freqs, psds = welch(data, epochs.info['sfreq'], window='hamming', nperseg=data.shape[-1], noverlap=0,
+                            detrend=False, axis=-1)
+        mask = (freqs >= fmin) & (freqs <= fmax)
+        ch_names = [epochs.ch_names[i] for i in mne.pick_types(epochs.info, eeg=True)]
+        return psds[..., mask], freqs[mask], ch_names
+    if method != 'multitaper':
+        raise ValueError(f"method must be 'welch' or 'multitaper', got {method}")
+    spectrum = epochs.compute_psd(method=method, fmin=fmin, fmax=fmax, picks='eeg', verbose=False)
+    psds, freqs = spectrum.get_data(return_freqs=True)
+    return psds, freqs, spectrum.ch_names
+
+
+def band_powers(psds, freqs, bands=None):
+    # {band: absolute power} and {band_rel: power / total power in [freqs[0], freqs[-1]]},
+    # integrated over the last axis of psds
+    bands = BANDS if bands is None else bands
+    total = trapezoid(psds, freqs, axis=-1)
+    powers = {}
+    for band, (fmin, fmax) in bands.items():
+        mask = (freqs >= fmin) & (freqs <= fmax)
+        powers[band] = trapezoid(psds[..., mask], freqs[mask], axis=-1)
+        powers[f'{band}_rel'] = powers[band] / total
+    return powers
+
+
+def fit_aperiodic(psds, freqs):
+    # offset and exponent of log10(psd) = offset - exponent * log10(f) for every spectrum
+    # on the last axis of psds, one least squares solve for all of them
+    keep = freqs > 0
+    design = np.column_stack([np.ones(keep.sum()), -np.log10(freqs[keep])])
+    log_psds = np.log10(psds[..., keep]).reshape(-1, keep.sum())
+    (offset, exponent), *_ = np.linalg.lstsq(design, log_psds.T, rcond=None)
+    return offset.reshape(psds.shape[:-1]), exponent.reshape(psds.shape[:-1])
+
+
+def get_spectral_file(save_folder, prefix, fmt='parquet'):
+    if fmt not in SPECTRAL_FORMATS:
+        raise ValueError(f"fmt must be one of {SPECTRAL_FORMATS}, got {fmt}")
+    extension = 'parquet' if fmt == 'parquet' else 'h5'
+    return os.path.join(save_folder, f'{prefix}-spectral.{extension}')
+
+
+def spectral_features(epochs, windows, subject, week, condition, bins=None, method='welch', fmin=1, fmax=45,
+                      store_psd=False, psd=None):
+    """One row per (window, epoch, channel) with the band powers and the aperiodic fit.
+
+    windows and bins are {name: (tmin, tmax)} in seconds (see utils/pipeline.get_windows
+    and get_bins), an epoch is in every window its onset falls in and in at most one bin.
+    With store_psd the PSD is added as one psd_<freq> column per frequency.
+    psd: the (psds, freqs, ch_names) of compute_psd if they are already computed.
+    """
+    onsets = epochs.events[:, 0] / epochs.info['sfreq']
+    psds, freqs, ch_names = psd if psd is not None else compute_psd(epochs, method, fmin, fmax)
+    features = band_powers(psds, freqs)
+    features['aperiodic_offset'], features['aperiodic_exponent'] = fit_aperiodic(psds, freqs)
+    if store_psd:
+        features.update({f'psd_{freq:g}': psds[..., i] for i, freq in enumerate(freqs)})
+
+    # bin of every epoch
+    epoch_bins = np.full(len(onsets), None, dtype=object)
+    for name, (tmin, tmax) in (bins or {}).items():
+        epoch_bins[(onsets >= tmin) & (onsets < tmax)] = name
+
+    n_channels = len(ch_names)
+    tables = []
+    for name, (tmin, tmax) in windows.items():
+        selection = np.flatnonzero((onsets >= tmin) & (onsets < tmax))
+        table = {
+            'window': name,
+            # string column even without bins, so that every file has the same schema
+            'bin': pd.array(np.repeat(epoch_bins[selection], n_channels), dtype='string'),
+            'epoch': np.repeat(selection, n_channels),
+            'onset': np.repeat(onsets[selection], n_channels),
+            'channel': np.tile(ch_names, len(selection)),
+        }
+        table.update({column: values[selection].ravel() for column, values in features.items()})
+        tables.append(pd.DataFrame(table))
+    table = pd.concat(tables, ignore_index=True)
+    table.insert(0, 'subject', str(subject))
+    table.insert(1, 'week', str(week))
+    table.insert(2, 'condition', str(condition))
+    return table
+
+
+def write_spectral_features(table, path):
+    # The table is written in one file per recording, so that the workers never write the same file
+    if path.endswith('.h5'):
+        # 'table' format so that read_hdf can select rows with a where condition
+        table.to_hdf(path, key='spectral', mode='w', format='table', data_columns=INDEX_COLUMNS)
+    else:
+        table.to_parquet(path, index=False)
+
+
+def read_spectral_features(root_path, columns=None, filters=None, fmt='parquet'):
+    """The spectral features of every preprocessed recording in one DataFrame.
+
+    columns: the feature columns to read (the index columns are always read),
+    filters: pyarrow filters on the rows, e.g. [('window', '=', 'dosis'), ('condition', 'in', ['a', 'b'])].
+    Only the parquet files can be filtered while reading.
+    """
+    files = sorted(glob.glob(os.path.join(get_spectral_file(os.path.join(root_path, 'derivatives', '*', '*'),
+                                                            '*', fmt))))
+    if not files:
+        return pd.DataFrame(columns=INDEX_COLUMNS)
+    if columns is not None:
+        columns = INDEX_COLUMNS + [column for column in columns if column not in INDEX_COLUMNS]
+    if fmt == 'hdf5':
+        return pd.concat([pd.read_hdf(file, 'spectral', columns=columns) for file in files], ignore_index=True)
+
+    import pyarrow.parquet as pq
+    # a single dataset over all the files, only the requested columns and row groups are read
+    return pq.ParquetDataset(files, filters=filters).read(columns=columns).to_pandas()
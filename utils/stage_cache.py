@@ -0,0 +1,209 @@
+import hashlib
+import json
+import os
+import shutil
+
+
+"""
+On-disk checkpoints of the preprocessing stages.
+
+Every stage output is stored in its own folder
+    results/derivatives/<condition>/<id>/cache/<week>/<stage>-<key>/
+where <key> is a hash of the stage parameters and of the key of the stage it
+depends on (the first stage depends on the hash of the raw file). Changing
+only the ICA parameters therefore changes only the ICA key, and every stage
+before it is read from disk.
+
+A recording caches about 160 MB (31 minutes at 256 Hz: the filtered raw and the
+epochs in float64, the AutoReject model and the ICA), the cache is bounded to
+DEFAULT_MAX_GB by default and the least recently used stages are removed above it.
+
+The workers of run_preprocessing.py share the cache without a lock: they get a
+cache without max_size and the batch evicts in the parent after every recording.
+An entry removed while it is read (evicted, or invalidated by another process)
+is a cache miss, and the walks of the eviction skip the entries that disappear.
+
+The hashes of the raw files are kept in results/derivatives/raw_hashes.json with the
+size and the modification time of the file, a recording is only read again to hash it
+when it changed (as manifest.raw_fingerprint).
+"""
+
+DEFAULT_MAX_GB = 20
+RAW_HASHES = 'raw_hashes.json'
+
+
+def hash_file(path, chunk_size=1024 * 1024):
+    # Hash of the content of a file, read in chunks
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def file_hash(path, index_file):
+    # Hash of a file, stored in index_file with its size and modification time and only
+    # computed again when they change. Two processes writing the index at the same time
+    # may lose an entry: the file is then hashed again on the next run
+    stat = os.stat(path)
+    fingerprint = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+    try:
+        with open(index_file, 'r') as f:
+            index = json.load(f)
+    except (FileNotFoundError, ValueError):
+        index = {}
+    previous = index.get(os.path.abspath(path), {})
+    if all(previous.get(key) == value for key, value in fingerprint.items()):
+        return previous['hash']
+
+    fingerprint['hash'] = hash_file(path)
+    index[os.path.abspath(path)] = fingerprint
+    os.makedirs(os.path.dirname(os.path.abspath(index_file)), exist_ok=True)
+    tmp_file = f'{index_file}.{os.getpid()}.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(index, f, indent=1)
+    os.replace(tmp_file, index_file)
+    return fingerprint['hash']
+
+
+def _folder_size(folder):
+    # the files removed during the walk are not counted
+    size = 0
+    for dirpath, dirnames, filenames in os.walk(folder):
+        for filename in filenames:
+            try:
+                size += os.path.getsize(os.path.join(dirpath, filename))
+            except FileNotFoundError:
+                pass
+    return size
+
+
+def _listdir(folder):
+    # the names in a folder, none if another process removed it
+    try:
+        return os.listdir(folder)
+    except (FileNotFoundError, NotADirectoryError):
+        return []
+
+
+def _remove(folder):
+    # a folder that another process may be removing at the same time
+    try:
+        shutil.rmtree(folder)
+    except FileNotFoundError:
+        pass
+
+
+class StageCache:
+    def __init__(self, root_path='results', max_size=None):
+        # max_size: maximum size in bytes of all the cached stages, None for no limit
+        self.root_path = root_path
+        self.max_size = max_size
+
+    def get_cache_folder(self, condition, id, week=None):
+        cache_folder = os.path.join(self.root_path, 'derivatives', condition, str(id), 'cache')
+        if week is not None:
+            cache_folder = os.path.join(cache_folder, str(week))
+        return cache_folder
+
+    def file_key(self, path):
+        # Hash of the input file, computed once per (path, size, mtime) and kept on disk
+        return file_hash(path, os.path.join(self.root_path, 'derivatives', RAW_HASHES))
+
+    @staticmethod
+    def stage_key(stage, params, parent_key):
+        # Hash of the stage name, its parameters and the key of the previous stage
+        description = json.dumps({'stage': stage, 'params': params, 'parent': parent_key},
+                                 sort_keys=True, default=str)
+        return hashlib.sha1(description.encode()).hexdigest()[:16]
+
+    def get_entry_folder(self, condition, id, week, stage, key):
+        return os.path.join(self.get_cache_folder(condition, id, week), f'{stage}-{key}')
+
+    def load(self, condition, id, week, stage, key, reader):
+        # Returns the cached output of a stage or None if it is not cached
+        entry_folder = self.get_entry_folder(condition, id, week, stage, key)
+        if not os.path.isdir(entry_folder):
+            return None
+        try:
+            # Mark the entry as recently used for the eviction
+            os.utime(entry_folder)
+            return reader(entry_folder)
+        except OSError:
+            # removed (or being removed) by another process since: computed again
+            return None
+
+    def save(self, condition, id, week, stage, key, writer, result):
+        # Write in a temporary folder and move it in place, so that an
+        # interrupted run never leaves a half written entry
+        entry_folder = self.get_entry_folder(condition, id, week, stage, key)
+        tmp_folder = f'{entry_folder}.{os.getpid()}.tmp'
+        shutil.rmtree(tmp_folder, ignore_errors=True)
+        os.makedirs(tmp_folder)
+        writer(tmp_folder, result)
+
+        # Older entries of the same stage are outdated
+        self.invalidate(condition, id, week, stage)
+        os.replace(tmp_folder, entry_folder)
+
+        if self.max_size is not None:
+            self.evict(self.max_size)
+
+    def cached(self, condition, id, week, stage, key, compute, writer, reader):
+        # Read the stage output from the cache or compute it and store it
+        result = self.load(condition, id, week, stage, key, reader)
+        if result is None:
+            result = compute()
+            self.save(condition, id, week, stage, key, writer, result)
+        return result
+
+    def invalidate(self, condition, id, week=None, stage=None):
+        # Remove the cached stages of a subject (or of one week, or only one stage)
+        cache_folder = self.get_cache_folder(condition, id, week)
+        if not os.path.isdir(cache_folder):
+            return
+        if stage is None:
+            _remove(cache_folder)
+            return
+        week_folders = [cache_folder] if week is not None else \
+            [os.path.join(cache_folder, name) for name in _listdir(cache_folder)]
+        for week_folder in week_folders:
+            for name in _listdir(week_folder):
+                if name.startswith(f'{stage}-') and not name.endswith('.tmp'):
+                    _remove(os.path.join(week_folder, name))
+
+    def list_entries(self):
+        # (last use, size, folder) of every cached stage of every subject
+        entries = []
+        derivatives_folder = os.path.join(self.root_path, 'derivatives')
+        if not os.path.isdir(derivatives_folder):
+            return entries
+        for condition in _listdir(derivatives_folder):
+            for id in _listdir(os.path.join(derivatives_folder, condition)):
+                cache_folder = self.get_cache_folder(condition, id)
+                for week in _listdir(cache_folder):
+                    week_folder = os.path.join(cache_folder, week)
+                    for name in _listdir(week_folder):
+                        entry_folder = os.path.join(week_folder, name)
+                        if name.endswith('.tmp'):
+                            continue
+                        try:
+                            last_used = os.path.getmtime(entry_folder)
+                        except FileNotFoundError:
+                            continue
+                        if os.path.isdir(entry_folder):
+                            entries.append((last_used, _folder_size(entry_folder), entry_folder))
+        return entries
+
+    def evict(self, max_size):
+        # Remove the least recently used entries until the cache fits in max_size bytes
+        entries = sorted(self.list_entries())
+        total_size = sum(size for _, size, _ in entries)
+        evicted = []
+        for last_used, size, entry_folder in entries:
+            if total_size <= max_size:
+                break
+            _remove(entry_folder)
+            total_size -= size
+            evicted.append(entry_folder)
+        return evicted
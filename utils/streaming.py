@@ -0,0 +1,139 @@
+import numpy as np
+import mne
+
+from scipy.signal import oaconvolve
+
+import utils.preprocessing_helpers as preprocessing_helpers
+
+
+"""
+Notch + band-pass filtering and fixed length epoching in chunks.
+
+filter_raw + make_epochs of utils/pipeline.py hold the raw data, the filtered
+copy and the epochs at the same time. Here the samples are read from a source
+(a Raw or the EDF file) a few epochs at a time, filtered with the same FIR
+filters as Raw.notch_filter and Raw.filter (MNE defaults, zero phase, same
+'reflect_limited' padding at the ends of the recording) and written straight
+into a preallocated epochs array, which can be a memory mapped .npy file.
+Each chunk reads the filter lengths of extra samples on both sides, so the
+result is the same as filtering the whole recording (up to float rounding).
+
+    source = edf_source(raw_file, info)
+    epochs = filter_epochs_streaming(source, info, hpass=1, lpass=45, duration=2.0)
+"""
+
+
+class _Source:
+    # Samples [start, stop) (relative to the first sample) of every channel of a recording
+    def __init__(self, get_data, n_times, first_samp):
+        self.get_data = get_data
+        self.n_times = n_times
+        self.first_samp = first_samp
+
+
+def raw_source(raw):
+    return _Source(lambda start, stop: raw.get_data(start=start, stop=stop), raw.n_times, raw.first_samp)
+
+
+def edf_source(path, info, tmin=None, tmax=None):
+    # Read the channels of info (renamed by set_chs_montage, in the same order) from the EDF file
+    edf_header = preprocessing_helpers.read_edf_header(path)
+    sfreq = info['sfreq']
+    first = int(round(tmin * sfreq)) if tmin is not None else 0
+    n_times = edf_header['n_records'] * int(round(edf_header['record_duration'] * sfreq)) - first
+    if tmax is not None:
+        n_times = min(n_times, int(round(tmax * sfreq)) - first)
+    channels = preprocessing_helpers.AKONIC_EDF_CHANNELS
+
+    def get_data(start, stop):
+        data, ch_names, _ = preprocessing_helpers.read_edf_data(path, channels, np.float64, edf_header,
+                                                                first + start, first + stop)
+        return data
+    return _Source(get_data, n_times, first)
+
+
+def filter_picks(info):
+    # the channels Raw.filter and Raw.notch_filter filter with picks=None: the data channels,
+    # bad ones included (not the ECG, respiration or misc channels)
+    return mne.pick_types(info, meg=True, ref_meg=False, eeg=True, seeg=True, ecog=True, dbs=True, fnirs=True,
+                          csd=True, exclude=[])
+
+
+def get_filters(sfreq, hpass, lpass, line_freq):
+    # FIR kernels of raw.notch_filter(freqs=line_freq) and raw.filter(l_freq=hpass, h_freq=lpass)
+    filters = []
+    if line_freq is not None:
+        # as mne.filter.notch_filter: notch width freq / 200 and a 1 Hz transition band
+        trans_bandwidth = 0.5
+        notch_width = line_freq / 200.
+        filters.append(mne.filter.create_filter(None, sfreq, [line_freq + notch_width / 2 + trans_bandwidth],
+                                                [line_freq - notch_width / 2 - trans_bandwidth],
+                                                l_trans_bandwidth=trans_bandwidth, h_trans_bandwidth=trans_bandwidth,
+                                                verbose=False))
+    filters.append(mne.filter.create_filter(None, sfreq, hpass, lpass, verbose=False))
+    return filters
+
+
+def _filtered_source(source, h, picks):
+    # Source of the samples filtered by the zero phase FIR h, as mne.filter._overlap_add_filter
+    n_times = source.n_times
+    half = (len(h) - 1) // 2
+    n_edge = len(h) - 1
+    if n_times <= n_edge:
+        raise ValueError(f'The recording ({n_times} samples) is shorter than the filter ({len(h)} samples)')
+
+    def get_data(start, stop):
+        # samples [start - half, stop + half) with the ends of the recording mirrored
+        # as the 'reflect_limited' padding of MNE: x[-i] = 2 * x[0] - x[i]
+        first, last = start - half, stop + half
+        data = source.get_data(max(first, 0), min(last, n_times))
+        if first < 0:
+            data = np.concatenate([2 * data[:, :1] - data[:, -first:0:-1], data], axis=1)
+        if last > n_times:
+            data = np.concatenate([data, 2 * data[:, -1:] - data[:, -2:n_times - last - 2:-1]], axis=1)
+        out = data[:, half:half + stop - start].copy()
+        out[picks] = oaconvolve(data[picks], h[np.newaxis], mode='valid', axes=-1)
+        return out
+    return _Source(get_data, n_times, source.first_samp)
+
+
+def filter_epochs_streaming(source, info, hpass, lpass, duration, chunk_epochs=32, out=None):
+    """Filter the recording of source and cut it in non-overlapping epochs of duration seconds.
+
+    info is the measurement info of the recording (channel names, types, sfreq,
+    line_freq), out an optional preallocated array (n_epochs, n_channels, n_samples),
+    e.g. a memory mapped file, see allocate_epochs. Returns an mne.EpochsArray with
+    the same data, events and info as make_epochs(filter_raw(raw, hpass, lpass), duration).
+    """
+    sfreq = info['sfreq']
+    picks = filter_picks(info)
+    for h in get_filters(sfreq, hpass, lpass, info['line_freq']):
+        source = _filtered_source(source, h, picks)
+
+    n_samples = int(np.round(sfreq * duration))
+    events = make_fixed_length_events(source.n_times, source.first_samp, n_samples)
+    if out is None:
+        out = np.empty((len(events), len(info['ch_names']), n_samples))
+    for first in range(0, len(events), chunk_epochs):
+        last = min(first + chunk_epochs, len(events))
+        data = source.get_data(first * n_samples, last * n_samples)
+        out[first:last] = data.reshape(len(info['ch_names']), last - first, n_samples).transpose(1, 0, 2)
+
+    info = info.copy()
+    with info._unlock():
+        info['highpass'], info['lowpass'] = float(hpass), float(lpass)
+    return mne.EpochsArray(out, info, events, tmin=0, event_id={'1': 1}, baseline=None, verbose=False)
+
+
+def make_fixed_length_events(n_times, first_samp, n_samples):
+    # as mne.make_fixed_length_events(raw, duration=n_samples / sfreq): every complete epoch
+    onsets = first_samp + np.arange(0, n_times - n_samples + 1, n_samples)
+    return np.c_[onsets, np.zeros(len(onsets), dtype=int), np.ones(len(onsets), dtype=int)]
+
+
+def allocate_epochs(n_times, n_channels, n_samples, path=None):
+    # Preallocated epochs array, memory mapped to a .npy file when path is given
+    shape = (n_times // n_samples, n_channels, n_samples)
+    if path is None:
+        return np.empty(shape)
+    return np.lib.format.open_memmap(path, mode='w+', dtype=np.float64, shape=shape)